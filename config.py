@@ -2,30 +2,46 @@
 config.py - 統一設定檔，讀取 .env 環境變數
 """
 import os
-from dotenv import load_dotenv
+from functools import lru_cache
+from dotenv import dotenv_values
 
-load_dotenv()
+
+@lru_cache(maxsize=1)
+def _env():
+    """只讀一次 .env（不寫回 os.environ），實際環境變數優先"""
+    values = {k: v for k, v in dotenv_values().items() if v is not None}
+    values.update(os.environ)
+    return values
+
+
+_ENV = _env()
 
 # --- Shioaji API ---
-SHIOAJI_API_KEY = os.getenv("SHIOAJI_API_KEY", "")
-SHIOAJI_SECRET_KEY = os.getenv("SHIOAJI_SECRET_KEY", "")
+SHIOAJI_API_KEY = _ENV.get("SHIOAJI_API_KEY", "")
+SHIOAJI_SECRET_KEY = _ENV.get("SHIOAJI_SECRET_KEY", "")
 
 # --- Google Gemini AI ---
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
+GOOGLE_API_KEY = _ENV.get("GOOGLE_API_KEY", "")
 
 # --- 交易費用 ---
-BROKER_FEE_RATE = float(os.getenv("BROKER_FEE_RATE", "0.001425"))
-BROKER_FEE_DISCOUNT = float(os.getenv("BROKER_FEE_DISCOUNT", "0.6"))
-TAX_RATE_STOCK = float(os.getenv("TAX_RATE_STOCK", "0.003"))
-TAX_RATE_ETF = float(os.getenv("TAX_RATE_ETF", "0.001"))
+BROKER_FEE_RATE = float(_ENV.get("BROKER_FEE_RATE", "0.001425"))
+BROKER_FEE_DISCOUNT = float(_ENV.get("BROKER_FEE_DISCOUNT", "0.6"))
+TAX_RATE_STOCK = float(_ENV.get("TAX_RATE_STOCK", "0.003"))
+TAX_RATE_ETF = float(_ENV.get("TAX_RATE_ETF", "0.001"))
 
 # --- Telegram ---
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
-TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
+TELEGRAM_BOT_TOKEN = _ENV.get("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_CHAT_ID = _ENV.get("TELEGRAM_CHAT_ID", "")
 
 # --- 伺服器 ---
-SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
-SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_HOST = _ENV.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(_ENV.get("SERVER_PORT", "8000"))
+
+# --- 功能開關（逗號分隔要關閉的功能：ai, margin, tdcc）---
+# 關閉的功能不載入對應的路由 / Worker 模組（例如 ai 會載入 google.generativeai），加快啟動、減少記憶體
+DISABLED_FEATURES = frozenset(
+    f.strip().lower() for f in _ENV.get("DISABLED_FEATURES", "").split(",") if f.strip()
+)
 
 # --- 交易時間 ---
 TRADING_SESSIONS = {
@@ -34,5 +50,12 @@ TRADING_SESSIONS = {
     "after_hours": ("13:40", "14:30"),
 }
 
+# --- 休市日（週末以外，逗號分隔 YYYY-MM-DD，啟動時載入一次）---
+TW_HOLIDAYS = frozenset(
+    d.strip() for d in _ENV.get("TW_HOLIDAYS", "").split(",") if d.strip()
+)
+
 # --- 資料庫 ---
-DB_PATH = os.path.join(os.path.dirname(__file__), "stock_game.db")
+# 預先轉成檔案系統 bytes，sqlite3.connect 不必每次重新編碼路徑
+DB_PATH = os.fsencode(os.path.join(os.path.dirname(os.path.abspath(__file__)), "stock_game.db"))
+SCHEMA_VERSION = 9  # 修改 database/db.py 的 SCHEMA_SQL 時請 +1（PRAGMA user_version）
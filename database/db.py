@@ -2,277 +2,477 @@
 database/db.py - SQLite 資料庫連線管理
 使用 aiosqlite 做非同步操作，避免阻塞 FastAPI
 """
+import asyncio
 import aiosqlite
 import sqlite3
 import os
-from config import DB_PATH
+from config import DB_PATH, SCHEMA_VERSION
 
+# 所有連線共用的效能 PRAGMA（WAL 之後套用）
+PERF_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",          # WAL 下只在 checkpoint 時 fsync
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",           # 約 64MB page cache
+    "PRAGMA mmap_size=268435456",         # 256MB 記憶體映射讀取
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA journal_size_limit=6144000",
+    "PRAGMA wal_autocheckpoint=1000",
+)
 
-async def get_db():
-    """取得非同步資料庫連線"""
-    db = await aiosqlite.connect(DB_PATH)
+
+# 每條連線的 prepared statement 快取數（sqlite3 預設 128）
+# 連線常駐、SQL 都是模組常數，同一字串重複執行直接命中快取、不必重新解析
+STATEMENT_CACHE_SIZE = 256
+
+
+def apply_pragmas(conn):
+    """同步連線套用 WAL + 效能 PRAGMA"""
+    # auto_vacuum 要在切 WAL（寫入檔頭）之前設定，只對全新的資料庫生效
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    for pragma in PERF_PRAGMAS:
+        conn.execute(pragma)
+
+
+def dict_factory(cursor, row):
+    """查詢結果直接組成 dict（省掉 sqlite3.Row 再轉 dict 的第二次配置）"""
+    return dict(zip([col[0] for col in cursor.description], row))
+
+
+def json_rows_sql(columns, query: str) -> str:
+    """
+    把 query 的結果在 SQLite 內組成單一 JSON 陣列字串（每列一個物件，保留 query 的排序）
+    fetchone()[0] 拿到整份結果，Python 端只做一次 JSON 解析，不必逐列建 Row / dict
+    注意 REAL 欄位以 15 位有效數字輸出，只適合比例 / 百分比這類小數位數固定的欄位
+    """
+    fields = ", ".join(f"'{col}', {col}" for col in columns)
+    return f"SELECT json_group_array(json_object({fields})) FROM ({query})"
+
+
+# 非同步連線池（需要時才開新連線，用完歸還重複使用）
+ASYNC_POOL_MAX = 4
+_async_pool = None
+_async_pool_size = 0
+
+
+async def _connect_async():
+    """建立一條新的非同步連線並設定 PRAGMA"""
+    db = await aiosqlite.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
     db.row_factory = aiosqlite.Row
+    await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
     await db.execute("PRAGMA journal_mode=WAL")  # 提升並發讀寫效能
+    for pragma in PERF_PRAGMAS:
+        await db.execute(pragma)
     await db.execute("PRAGMA foreign_keys=ON")
     return db
 
 
+async def get_db():
+    """從連線池借出非同步資料庫連線（用完請呼叫 release_db 歸還）"""
+    global _async_pool, _async_pool_size
+    if _async_pool is None:
+        _async_pool = asyncio.Queue()
+    if _async_pool.empty() and _async_pool_size < ASYNC_POOL_MAX:
+        _async_pool_size += 1
+        try:
+            return await _connect_async()
+        except Exception:
+            _async_pool_size -= 1
+            raise
+    return await _async_pool.get()
+
+
+async def release_db(db):
+    """歸還非同步連線到連線池"""
+    if _async_pool is None:
+        await db.close()
+        return
+    _async_pool.put_nowait(db)
+
+
+async def db_conn():
+    """FastAPI 依賴：每個請求借一條非同步連線，回應後自動歸還（Depends(db_conn)）"""
+    db = await get_db()
+    try:
+        yield db
+    finally:
+        await release_db(db)
+
+
+async def close_db_pool():
+    """關閉連線池內所有非同步連線（程式結束時呼叫）"""
+    global _async_pool, _async_pool_size
+    if _async_pool is None:
+        return
+    while not _async_pool.empty():
+        db = _async_pool.get_nowait()
+        try:
+            await db.close()
+        except Exception:
+            pass
+    _async_pool = None
+    _async_pool_size = 0
+
+
 def get_db_sync():
     """取得同步資料庫連線（給 Worker 用）"""
-    db = sqlite3.connect(DB_PATH)
+    db = sqlite3.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
     db.row_factory = sqlite3.Row
-    db.execute("PRAGMA journal_mode=WAL")
+    apply_pragmas(db)
     db.execute("PRAGMA foreign_keys=ON")
     return db
 
 
+def checkpoint_wal():
+    """把 WAL 內容寫回主檔並截斷，避免快照寫入讓 WAL 無限長大（排程定期呼叫）"""
+    try:
+        db = get_db_sync()
+        try:
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"[DB] WAL checkpoint 失敗: {e}")
+
+
+# ==========================================
+# 集保持股分級 → 散戶 / 中實戶 / 大戶（tdcc_data.bucket 生成欄位）
+# ==========================================
+# 取分級字串上限（去逗號空白）：「a-b」取 b（非數字視為無上限）、「以上」無上限、純數字直接用，其餘為 0
+# 上限 < 100 張為散戶、< 400 張為中實戶，其餘為大戶
+_TDCC_LEVEL = "replace(replace(level, ',', ''), ' ', '')"
+_TDCC_LEVEL_TAIL = f"substr({_TDCC_LEVEL}, length(rtrim({_TDCC_LEVEL}, replace({_TDCC_LEVEL}, '-', ''))) + 1)"
+_TDCC_UPPER = f"""CASE
+        WHEN instr({_TDCC_LEVEL}, '-') > 0 THEN
+            CASE WHEN {_TDCC_LEVEL_TAIL} <> '' AND {_TDCC_LEVEL_TAIL} NOT GLOB '*[^0-9]*'
+                 THEN CAST({_TDCC_LEVEL_TAIL} AS INTEGER) ELSE 999999 END
+        WHEN instr({_TDCC_LEVEL}, '以上') > 0 THEN 999999
+        WHEN {_TDCC_LEVEL} <> '' AND {_TDCC_LEVEL} NOT GLOB '*[^0-9]*' THEN CAST({_TDCC_LEVEL} AS INTEGER)
+        ELSE 0 END"""
+TDCC_BUCKET_SQL = f"""CASE
+        WHEN ({_TDCC_UPPER}) < 100000 THEN 'retail'
+        WHEN ({_TDCC_UPPER}) < 400000 THEN 'medium'
+        ELSE 'big' END"""
+
+
+# ==========================================
+# 資料表結構（所有 DDL 合併成一段，init_database 一次執行）
+# ==========================================
+SCHEMA_SQL = """
+-- ==========================================
+-- 1. watchlist - 關注清單（持有 + 關注）
+-- ==========================================
+CREATE TABLE IF NOT EXISTS watchlist (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stock_id TEXT NOT NULL,
+    stock_name TEXT DEFAULT '',
+    category TEXT NOT NULL DEFAULT 'watch',
+    -- category: 'hold' = 持有, 'watch' = 關注
+    notes TEXT DEFAULT '',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(stock_id)
+);
+
+-- ==========================================
+-- 2. portfolio_summary - 持倉損益彙總
+-- ==========================================
+CREATE TABLE IF NOT EXISTS portfolio_summary (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stock_id TEXT NOT NULL UNIQUE,
+    stock_name TEXT DEFAULT '',
+    total_shares INTEGER DEFAULT 0,
+    avg_cost REAL DEFAULT 0,
+    realized_profit REAL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (stock_id) REFERENCES watchlist(stock_id)
+);
+
+-- ==========================================
+-- 3. trade_log - 交易紀錄（含零股、手續費、稅）
+-- ==========================================
+CREATE TABLE IF NOT EXISTS trade_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stock_id TEXT NOT NULL,
+    stock_name TEXT DEFAULT '',
+    action TEXT NOT NULL,
+    -- action: 'buy' = 買入, 'sell' = 賣出
+    shares INTEGER NOT NULL,
+    price REAL NOT NULL,
+    total_amount REAL NOT NULL,
+    fee REAL DEFAULT 0,
+    tax REAL DEFAULT 0,
+    net_amount REAL DEFAULT 0,
+    is_odd_lot INTEGER DEFAULT 0,
+    -- is_odd_lot: 0 = 整股, 1 = 零股
+    note TEXT DEFAULT '',
+    traded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ==========================================
+-- 4. daily_diary - 每日交易日記
+-- ==========================================
+CREATE TABLE IF NOT EXISTS daily_diary (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL UNIQUE,
+    market_summary TEXT DEFAULT '',
+    ai_review TEXT DEFAULT '',
+    user_notes TEXT DEFAULT '',
+    reminders TEXT DEFAULT '',
+    win_rate_today REAL DEFAULT 0,
+    max_loss REAL DEFAULT 0,
+    emotion_tag TEXT DEFAULT '',
+    -- emotion_tag: 'calm', 'impulsive', 'panic', 'greedy', 'disciplined'
+    plan_deviation TEXT DEFAULT '',
+    tomorrow_plan TEXT DEFAULT '',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ==========================================
+-- 5. institutional_data - 個股法人籌碼
+-- ==========================================
+CREATE TABLE IF NOT EXISTS institutional_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    stock_id TEXT NOT NULL,
+    stock_name TEXT DEFAULT '',
+    foreign_buy INTEGER DEFAULT 0,
+    foreign_sell INTEGER DEFAULT 0,
+    foreign_net INTEGER DEFAULT 0,
+    trust_buy INTEGER DEFAULT 0,
+    trust_sell INTEGER DEFAULT 0,
+    trust_net INTEGER DEFAULT 0,
+    dealer_buy INTEGER DEFAULT 0,
+    dealer_sell INTEGER DEFAULT 0,
+    dealer_net INTEGER DEFAULT 0,
+    total_net INTEGER DEFAULT 0,
+    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(date, stock_id)
+);
+
+-- ==========================================
+-- 6. market_institutional - 大盤法人買賣超
+-- ==========================================
+CREATE TABLE IF NOT EXISTS market_institutional (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL UNIQUE,
+    foreign_net REAL DEFAULT 0,
+    trust_net REAL DEFAULT 0,
+    dealer_net REAL DEFAULT 0,
+    total_net REAL DEFAULT 0,
+    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ==========================================
+-- 7. stock_snapshots - 行情快照（盤中快取，只保留近一天的熱資料）
+-- ==========================================
+CREATE TABLE IF NOT EXISTS stock_snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stock_id TEXT NOT NULL,
+    stock_name TEXT DEFAULT '',
+    price REAL DEFAULT 0,
+    change_price REAL DEFAULT 0,
+    change_percent REAL DEFAULT 0,
+    volume INTEGER DEFAULT 0,
+    total_volume INTEGER DEFAULT 0,
+    amount REAL DEFAULT 0,
+    high REAL DEFAULT 0,
+    low REAL DEFAULT 0,
+    open REAL DEFAULT 0,
+    close REAL DEFAULT 0,
+    buy_price REAL DEFAULT 0,
+    sell_price REAL DEFAULT 0,
+    vwap REAL DEFAULT 0,
+    snapshot_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ==========================================
+-- 8. stock_alerts - 到價提醒
+-- ==========================================
+CREATE TABLE IF NOT EXISTS stock_alerts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stock_id TEXT NOT NULL,
+    stock_name TEXT DEFAULT '',
+    alert_type TEXT NOT NULL,
+    -- alert_type: 'above' = 突破, 'below' = 跌破
+    target_price REAL NOT NULL,
+    is_triggered INTEGER DEFAULT 0,
+    triggered_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ==========================================
+-- 9. margin_data - 融資融券
+-- ==========================================
+CREATE TABLE IF NOT EXISTS margin_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    stock_id TEXT NOT NULL,
+    margin_buy INTEGER DEFAULT 0,
+    margin_sell INTEGER DEFAULT 0,
+    margin_balance INTEGER DEFAULT 0,
+    short_buy INTEGER DEFAULT 0,
+    short_sell INTEGER DEFAULT 0,
+    short_balance INTEGER DEFAULT 0,
+    day_trade_ratio REAL DEFAULT 0,
+    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(date, stock_id)
+);
+
+-- ==========================================
+-- 10. ai_recommendations - AI 推薦紀錄
+-- ==========================================
+CREATE TABLE IF NOT EXISTS ai_recommendations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    stock_id TEXT DEFAULT '',
+    stock_name TEXT DEFAULT '',
+    reason TEXT DEFAULT '',
+    profit_potential TEXT DEFAULT '',
+    time_horizon TEXT DEFAULT '',
+    horizon_days INTEGER,
+    -- horizon_days: 寫入時由 time_horizon 換算的過期天數（短線 14 / 波段 90 / 其他 180）
+    stop_loss_price REAL DEFAULT 0,
+    target_price REAL DEFAULT 0,
+    actual_result TEXT DEFAULT '',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- date_ordinal: 與 Python date.toordinal() 相同的日序數，回測直接整數相減算經過天數
+    date_ordinal INTEGER GENERATED ALWAYS AS (CAST(julianday(date) AS INTEGER) - 1721424) STORED
+);
+
+-- ==========================================
+-- 11. app_settings - 應用程式設定（key-value）
+-- ==========================================
+CREATE TABLE IF NOT EXISTS app_settings (
+    key TEXT PRIMARY KEY,
+    value TEXT DEFAULT '',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ==========================================
+-- 12. tdcc_data - 集保大戶資料
+-- ==========================================
+CREATE TABLE IF NOT EXISTS tdcc_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    stock_id TEXT NOT NULL,
+    level TEXT NOT NULL DEFAULT '',
+    holders INTEGER DEFAULT 0,
+    shares INTEGER DEFAULT 0,
+    percent REAL DEFAULT 0,
+    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- bucket: 由 level 換算的持股分級（retail / medium / big），寫入時算好，摘要直接 GROUP BY
+    bucket TEXT GENERATED ALWAYS AS (""" + TDCC_BUCKET_SQL + """) STORED,
+    UNIQUE(date, stock_id, level)
+);
+
+-- ==========================================
+-- 13. stock_snapshots_archive - 行情快照封存（超過一天的舊快照）
+-- ==========================================
+CREATE TABLE IF NOT EXISTS stock_snapshots_archive (
+    id INTEGER PRIMARY KEY,
+    stock_id TEXT NOT NULL,
+    stock_name TEXT DEFAULT '',
+    price REAL DEFAULT 0,
+    change_price REAL DEFAULT 0,
+    change_percent REAL DEFAULT 0,
+    volume INTEGER DEFAULT 0,
+    total_volume INTEGER DEFAULT 0,
+    amount REAL DEFAULT 0,
+    high REAL DEFAULT 0,
+    low REAL DEFAULT 0,
+    open REAL DEFAULT 0,
+    close REAL DEFAULT 0,
+    buy_price REAL DEFAULT 0,
+    sell_price REAL DEFAULT 0,
+    vwap REAL DEFAULT 0,
+    snapshot_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 建立索引，加速查詢
+CREATE INDEX IF NOT EXISTS idx_trade_log_stock ON trade_log(stock_id);
+CREATE INDEX IF NOT EXISTS idx_trade_log_date ON trade_log(traded_at);
+CREATE INDEX IF NOT EXISTS idx_trade_log_stock_date ON trade_log(stock_id, traded_at DESC);
+-- 運算式索引：績效 / 日曆 API 用 strftime('%Y-%m', ...) 篩月份、DATE(...) 分組，欄位索引用不到
+CREATE INDEX IF NOT EXISTS idx_trade_log_month ON trade_log(strftime('%Y-%m', traded_at));
+CREATE INDEX IF NOT EXISTS idx_trade_log_day ON trade_log(DATE(traded_at));
+CREATE INDEX IF NOT EXISTS idx_institutional_date ON institutional_data(date);
+CREATE INDEX IF NOT EXISTS idx_institutional_stock ON institutional_data(stock_id);
+-- 運算式索引：配合 ORDER BY ABS(total_net) DESC，免排序
+CREATE INDEX IF NOT EXISTS idx_institutional_date_absnet ON institutional_data(date, ABS(total_net) DESC);
+CREATE INDEX IF NOT EXISTS idx_snapshots_stock ON stock_snapshots(stock_id);
+CREATE INDEX IF NOT EXISTS idx_snapshots_time ON stock_snapshots(snapshot_at);
+CREATE INDEX IF NOT EXISTS idx_snapshots_stock_time ON stock_snapshots(stock_id, snapshot_at DESC);
+CREATE INDEX IF NOT EXISTS idx_snapshots_archive_stock_time ON stock_snapshots_archive(stock_id, snapshot_at);
+CREATE INDEX IF NOT EXISTS idx_diary_date ON daily_diary(date);
+CREATE INDEX IF NOT EXISTS idx_diary_month ON daily_diary(strftime('%Y-%m', date));
+-- 回測 WHERE date >= ? ORDER BY date DESC, stock_id 走索引範圍掃描、免排序（取代舊的 idx_ai_rec_date）
+DROP INDEX IF EXISTS idx_ai_rec_date;
+CREATE INDEX IF NOT EXISTS idx_ai_recs_date_stock ON ai_recommendations(date DESC, stock_id);
+CREATE INDEX IF NOT EXISTS idx_tdcc_stock ON tdcc_data(stock_id);
+CREATE INDEX IF NOT EXISTS idx_tdcc_date ON tdcc_data(date);
+"""
+
+
+# 既有資料庫補欄位（CREATE TABLE IF NOT EXISTS 不會改到舊表）
+# (資料表, 欄位, ADD COLUMN 定義, 回填舊資料的 SQL 或 None)
+# 註：ALTER TABLE 只能加 VIRTUAL 生成欄位，舊資料庫的 date_ordinal / bucket 改為讀取時計算
+COLUMN_MIGRATIONS = (
+    ("ai_recommendations", "horizon_days", "horizon_days INTEGER",
+     """UPDATE ai_recommendations SET horizon_days = CASE
+            WHEN instr(time_horizon, '短線') > 0 THEN 14
+            WHEN instr(time_horizon, '波段') > 0 THEN 90
+            ELSE 180 END
+        WHERE horizon_days IS NULL"""),
+    ("ai_recommendations", "date_ordinal",
+     "date_ordinal INTEGER GENERATED ALWAYS AS (CAST(julianday(date) AS INTEGER) - 1721424) VIRTUAL",
+     None),
+    ("tdcc_data", "bucket",
+     "bucket TEXT GENERATED ALWAYS AS (" + TDCC_BUCKET_SQL + ") VIRTUAL",
+     None),
+)
+
+
+async def _pending_migrations(db):
+    """
+    找出既有資料表缺少的欄位，回傳要執行的 SQL（新資料庫由 SCHEMA_SQL 直接建好）
+    用 table_xinfo 才看得到生成欄位（table_info 會略過，導致重複 ADD COLUMN）
+    """
+    statements = []
+    for table, column, definition, backfill in COLUMN_MIGRATIONS:
+        async with db.execute(f"PRAGMA table_xinfo({table})") as cursor:
+            columns = [r[1] for r in await cursor.fetchall()]
+        if columns and column not in columns:
+            statements.append(f"ALTER TABLE {table} ADD COLUMN {definition};")
+            if backfill:
+                statements.append(backfill + ";")
+    return "\n".join(statements)
+
+
 async def init_database():
     """初始化資料庫，建立所有資料表"""
     db = await get_db()
     try:
-        # ==========================================
-        # 1. watchlist - 關注清單（持有 + 關注）
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS watchlist (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                stock_id TEXT NOT NULL,
-                stock_name TEXT DEFAULT '',
-                category TEXT NOT NULL DEFAULT 'watch',
-                -- category: 'hold' = 持有, 'watch' = 關注
-                notes TEXT DEFAULT '',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(stock_id)
-            )
-        """)
-
-        # ==========================================
-        # 2. portfolio_summary - 持倉損益彙總
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS portfolio_summary (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                stock_id TEXT NOT NULL UNIQUE,
-                stock_name TEXT DEFAULT '',
-                total_shares INTEGER DEFAULT 0,
-                avg_cost REAL DEFAULT 0,
-                realized_profit REAL DEFAULT 0,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (stock_id) REFERENCES watchlist(stock_id)
-            )
-        """)
-
-        # ==========================================
-        # 3. trade_log - 交易紀錄（含零股、手續費、稅）
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS trade_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                stock_id TEXT NOT NULL,
-                stock_name TEXT DEFAULT '',
-                action TEXT NOT NULL,
-                -- action: 'buy' = 買入, 'sell' = 賣出
-                shares INTEGER NOT NULL,
-                price REAL NOT NULL,
-                total_amount REAL NOT NULL,
-                fee REAL DEFAULT 0,
-                tax REAL DEFAULT 0,
-                net_amount REAL DEFAULT 0,
-                is_odd_lot INTEGER DEFAULT 0,
-                -- is_odd_lot: 0 = 整股, 1 = 零股
-                note TEXT DEFAULT '',
-                traded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # ==========================================
-        # 4. daily_diary - 每日交易日記
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS daily_diary (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL UNIQUE,
-                market_summary TEXT DEFAULT '',
-                ai_review TEXT DEFAULT '',
-                user_notes TEXT DEFAULT '',
-                reminders TEXT DEFAULT '',
-                win_rate_today REAL DEFAULT 0,
-                max_loss REAL DEFAULT 0,
-                emotion_tag TEXT DEFAULT '',
-                -- emotion_tag: 'calm', 'impulsive', 'panic', 'greedy', 'disciplined'
-                plan_deviation TEXT DEFAULT '',
-                tomorrow_plan TEXT DEFAULT '',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # ==========================================
-        # 5. institutional_data - 個股法人籌碼
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS institutional_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL,
-                stock_id TEXT NOT NULL,
-                stock_name TEXT DEFAULT '',
-                foreign_buy INTEGER DEFAULT 0,
-                foreign_sell INTEGER DEFAULT 0,
-                foreign_net INTEGER DEFAULT 0,
-                trust_buy INTEGER DEFAULT 0,
-                trust_sell INTEGER DEFAULT 0,
-                trust_net INTEGER DEFAULT 0,
-                dealer_buy INTEGER DEFAULT 0,
-                dealer_sell INTEGER DEFAULT 0,
-                dealer_net INTEGER DEFAULT 0,
-                total_net INTEGER DEFAULT 0,
-                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(date, stock_id)
-            )
-        """)
-
-        # ==========================================
-        # 6. market_institutional - 大盤法人買賣超
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS market_institutional (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL UNIQUE,
-                foreign_net REAL DEFAULT 0,
-                trust_net REAL DEFAULT 0,
-                dealer_net REAL DEFAULT 0,
-                total_net REAL DEFAULT 0,
-                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # ==========================================
-        # 7. stock_snapshots - 行情快照（盤中快取）
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS stock_snapshots (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                stock_id TEXT NOT NULL,
-                stock_name TEXT DEFAULT '',
-                price REAL DEFAULT 0,
-                change_price REAL DEFAULT 0,
-                change_percent REAL DEFAULT 0,
-                volume INTEGER DEFAULT 0,
-                total_volume INTEGER DEFAULT 0,
-                amount REAL DEFAULT 0,
-                high REAL DEFAULT 0,
-                low REAL DEFAULT 0,
-                open REAL DEFAULT 0,
-                close REAL DEFAULT 0,
-                buy_price REAL DEFAULT 0,
-                sell_price REAL DEFAULT 0,
-                vwap REAL DEFAULT 0,
-                snapshot_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # ==========================================
-        # 8. stock_alerts - 到價提醒
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS stock_alerts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                stock_id TEXT NOT NULL,
-                stock_name TEXT DEFAULT '',
-                alert_type TEXT NOT NULL,
-                -- alert_type: 'above' = 突破, 'below' = 跌破
-                target_price REAL NOT NULL,
-                is_triggered INTEGER DEFAULT 0,
-                triggered_at TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # ==========================================
-        # 9. margin_data - 融資融券
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS margin_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL,
-                stock_id TEXT NOT NULL,
-                margin_buy INTEGER DEFAULT 0,
-                margin_sell INTEGER DEFAULT 0,
-                margin_balance INTEGER DEFAULT 0,
-                short_buy INTEGER DEFAULT 0,
-                short_sell INTEGER DEFAULT 0,
-                short_balance INTEGER DEFAULT 0,
-                day_trade_ratio REAL DEFAULT 0,
-                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(date, stock_id)
-            )
-        """)
-
-        # ==========================================
-        # 10. ai_recommendations - AI 推薦紀錄
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS ai_recommendations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL,
-                stock_id TEXT DEFAULT '',
-                stock_name TEXT DEFAULT '',
-                reason TEXT DEFAULT '',
-                profit_potential TEXT DEFAULT '',
-                time_horizon TEXT DEFAULT '',
-                stop_loss_price REAL DEFAULT 0,
-                target_price REAL DEFAULT 0,
-                actual_result TEXT DEFAULT '',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # ==========================================
-        # 11. app_settings - 應用程式設定（key-value）
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS app_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT DEFAULT '',
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # ==========================================
-        # 12. tdcc_data - 集保大戶資料
-        # ==========================================
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS tdcc_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL,
-                stock_id TEXT NOT NULL,
-                level TEXT NOT NULL DEFAULT '',
-                holders INTEGER DEFAULT 0,
-                shares INTEGER DEFAULT 0,
-                percent REAL DEFAULT 0,
-                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(date, stock_id, level)
-            )
-        """)
-
-        # 建立索引，加速查詢
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_trade_log_stock ON trade_log(stock_id)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_trade_log_date ON trade_log(traded_at)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_institutional_date ON institutional_data(date)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_institutional_stock ON institutional_data(stock_id)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_stock ON stock_snapshots(stock_id)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_time ON stock_snapshots(snapshot_at)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_diary_date ON daily_diary(date)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_ai_rec_date ON ai_recommendations(date)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_tdcc_stock ON tdcc_data(stock_id)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_tdcc_date ON tdcc_data(date)")
-
-        await db.commit()
+        # 結構版本相同就跳過（只讀一個整數）
+        async with db.execute("PRAGMA user_version") as cursor:
+            row = await cursor.fetchone()
+        if row and row[0] == SCHEMA_VERSION:
+            print(f"[DB] 資料庫結構已是最新版本（v{SCHEMA_VERSION}），略過初始化。")
+            return
+
+        # 單一 executescript + 交易，取代逐條 await（每條都要跨執行緒來回一次）
+        migrations = await _pending_migrations(db)
+        await db.executescript(
+            "BEGIN;\n" + migrations + SCHEMA_SQL
+            + f"\nPRAGMA user_version = {SCHEMA_VERSION};\nCOMMIT;"
+            + "\nANALYZE;"  # 新索引建立後更新統計資訊，讓查詢規劃器選得到
+        )
         print("[DB] 資料庫初始化完成，所有資料表已建立。")
 
     except Exception as e:
+        await db.rollback()
         print(f"[DB] 資料庫初始化失敗: {e}")
         raise
     finally:
-        await db.close()
+        await release_db(db)
@@ -0,0 +1,99 @@
+"""
+database/db_pool.py - 同步 SQLite 連線池（給 API 路由用）
+啟動時預先開好連線（1 條寫入 + N 條讀取），每次請求借出/歸還
+不再每次請求都開檔、設 PRAGMA、重建 prepared statement 快取
+"""
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config import DB_PATH
+from database.db import apply_pragmas, STATEMENT_CACHE_SIZE
+
+# 讀取連線數（WAL 下讀取可並行，寫入只能一條）
+READ_POOL_SIZE = min(32, (os.cpu_count() or 1) * 4)
+
+_read_pool = None
+_write_conn = None
+_write_lock = threading.Lock()
+_init_lock = threading.Lock()
+
+
+def _connect():
+    """建立一條連線池用的連線（可跨執行緒借用）"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    apply_pragmas(conn)
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+def init_pool():
+    """預先建立所有連線（lifespan 啟動時呼叫，未呼叫則第一次借用時建立）"""
+    global _read_pool, _write_conn
+    with _init_lock:
+        if _read_pool is not None:
+            return
+        _write_conn = _connect()
+        pool = queue.Queue(maxsize=READ_POOL_SIZE)
+        for _ in range(READ_POOL_SIZE):
+            pool.put(_connect())
+        _read_pool = pool
+    print(f"[DB] 連線池就緒（讀 {READ_POOL_SIZE} / 寫 1）")
+
+
+def close_pool():
+    """關閉連線池內所有連線（程式結束時呼叫）"""
+    global _read_pool, _write_conn
+    with _init_lock:
+        if _read_pool is not None:
+            while not _read_pool.empty():
+                try:
+                    _read_pool.get_nowait().close()
+                except Exception:
+                    pass
+            _read_pool = None
+        if _write_conn is not None:
+            with _write_lock:
+                try:
+                    _write_conn.close()
+                except Exception:
+                    pass
+            _write_conn = None
+
+
+@contextmanager
+def acquire_read():
+    """借出一條讀取連線，離開 with 區塊自動歸還"""
+    if _read_pool is None:
+        init_pool()
+    pool = _read_pool
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
+
+@contextmanager
+def acquire_write():
+    """
+    借出唯一的寫入連線（同一時間只給一個呼叫端）
+    正常離開自動 commit，例外時 rollback
+    """
+    if _write_conn is None:
+        init_pool()
+    with _write_lock:
+        conn = _write_conn
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
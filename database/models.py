@@ -2,177 +2,289 @@
 database/models.py - 資料庫 CRUD 操作
 提供各模組統一的資料存取介面
 """
+import asyncio
+import atexit
+import functools
 import sqlite3
-from datetime import datetime, date
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 from typing import Optional
 from config import DB_PATH, BROKER_FEE_RATE, BROKER_FEE_DISCOUNT, TAX_RATE_STOCK, TAX_RATE_ETF
+from database.db import apply_pragmas, dict_factory, STATEMENT_CACHE_SIZE
+from trade_math import is_etf, calculate_fees_batch
+
+# 批次寫入時每個交易的筆數（兼顧吞吐量與寫入鎖持有時間）
+BATCH_SIZE = 500
+
+# 每個執行緒一條長駐連線（重複使用 page cache，不再每次開檔 + 設 PRAGMA）
+_local = threading.local()
+_all_conns = []
+_all_conns_lock = threading.Lock()
 
 
 def _get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
+    """取得目前執行緒專屬的共用連線（第一次呼叫時建立）"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # check_same_thread=False 只是為了讓 atexit 能統一關閉；平常只在建立它的執行緒使用
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = dict_factory
+        apply_pragmas(conn)
+        _local.conn = conn
+        with _all_conns_lock:
+            _all_conns.append(conn)
     return conn
 
 
+@contextmanager
+def _transaction(conn=None):
+    """
+    寫入交易
+    連線已在交易中（呼叫端的交易或 batch()）：直接沿用，由外層 commit
+    否則：BEGIN IMMEDIATE ... COMMIT，例外時 ROLLBACK
+    """
+    if conn is None:
+        conn = _get_conn()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def batch():
+    """
+    把多次寫入合併成一個交易、只 commit 一次（Worker 大量寫入用）
+    with batch():
+        for row in rows:
+            save_stock_institutional(*row)
+    """
+    return _transaction()
+
+
+def _with_conn(func):
+    """注入目前執行緒的共用連線作為第一個參數（呼叫端不需傳 conn）"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(_get_conn(), *args, **kwargs)
+    return wrapper
+
+
+@atexit.register
+def _close_all_conns():
+    """程式結束時關閉所有共用連線"""
+    with _all_conns_lock:
+        for conn in _all_conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _all_conns.clear()
+
+
+# ==========================================
+# 讀取快取（關注清單 / 持倉 / 大盤法人 / 個股法人 / 日記）
+# 這些資料幾分鐘才變一次，但儀表板每次請求都會讀
+# ==========================================
+CACHE_TTL = 30        # 秒
+CACHE_MAXSIZE = 128
+_cache = {}           # key -> (到期時間, 結果)
+_cache_version = {}   # prefix -> 版本號，寫入時 +1，避免把舊結果寫回快取
+_cache_lock = threading.Lock()
+
+
+def _copy_result(result):
+    """回傳複本，呼叫端修改（例如補上即時行情欄位）不會污染快取"""
+    if isinstance(result, list):
+        return [dict(r) for r in result]
+    if isinstance(result, dict):
+        return dict(result)
+    return result
+
+
+def _cached(prefix: str):
+    """TTL 快取裝飾器，寫入時用 _invalidate(prefix) 清除"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (prefix, args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            with _cache_lock:
+                hit = _cache.get(key)
+                version = _cache_version.get(prefix, 0)
+            if hit and hit[0] > now:
+                return _copy_result(hit[1])
+
+            result = func(*args, **kwargs)
+            with _cache_lock:
+                if _cache_version.get(prefix, 0) == version:
+                    if len(_cache) >= CACHE_MAXSIZE:
+                        _cache.pop(next(iter(_cache)))
+                    _cache[key] = (now + CACHE_TTL, result)
+            return _copy_result(result)
+        return wrapper
+    return decorator
+
+
+def data_version(*prefixes: str) -> tuple:
+    """回傳指定類別目前的資料版本（寫入時 +1），給上層快取判斷結果是否過期"""
+    with _cache_lock:
+        return tuple(_cache_version.get(prefix, 0) for prefix in prefixes)
+
+
+def _invalidate(*prefixes: str):
+    """清除指定類別的快取"""
+    with _cache_lock:
+        for prefix in prefixes:
+            _cache_version[prefix] = _cache_version.get(prefix, 0) + 1
+        for key in [k for k in _cache if k[0] in prefixes]:
+            del _cache[key]
+
+
 # ==========================================
 # Watchlist CRUD
 # ==========================================
 
-def get_watchlist(category: Optional[str] = None):
+@_cached("watchlist")
+@_with_conn
+def get_watchlist(conn, category: Optional[str] = None):
     """取得關注清單，可篩選 hold/watch"""
-    conn = _get_conn()
-    try:
-        if category:
-            rows = conn.execute(
-                "SELECT * FROM watchlist WHERE category = ? ORDER BY created_at",
-                (category,)
-            ).fetchall()
-        else:
-            rows = conn.execute(
-                "SELECT * FROM watchlist ORDER BY category DESC, created_at"
-            ).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
-
-
-def add_to_watchlist(stock_id: str, stock_name: str = "", category: str = "watch", notes: str = ""):
-    """新增股票到關注清單"""
-    conn = _get_conn()
+    if category:
+        rows = conn.execute(
+            "SELECT * FROM watchlist WHERE category = ? ORDER BY created_at",
+            (category,)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT * FROM watchlist ORDER BY category DESC, created_at"
+        ).fetchall()
+    return rows
+
+
+def add_to_watchlist(stock_id: str, stock_name: str = "", category: str = "watch", notes: str = "",
+                     conn: Optional[sqlite3.Connection] = None):
+    """新增股票到關注清單（傳入 conn 時併入呼叫端交易）"""
     try:
-        conn.execute(
-            """INSERT INTO watchlist (stock_id, stock_name, category, notes)
-               VALUES (?, ?, ?, ?)
-               ON CONFLICT(stock_id) DO UPDATE SET
-                   category = excluded.category,
-                   stock_name = excluded.stock_name,
-                   notes = excluded.notes,
-                   updated_at = CURRENT_TIMESTAMP""",
-            (stock_id, stock_name, category, notes)
-        )
-        conn.commit()
+        with _transaction(conn) as c:
+            c.execute(
+                """INSERT INTO watchlist (stock_id, stock_name, category, notes)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT(stock_id) DO UPDATE SET
+                       category = excluded.category,
+                       stock_name = excluded.stock_name,
+                       notes = excluded.notes,
+                       updated_at = CURRENT_TIMESTAMP""",
+                (stock_id, stock_name, category, notes)
+            )
+        _invalidate("watchlist", "portfolio")
         return True
     except Exception as e:
+        if conn is not None:
+            raise
         print(f"[DB] 新增 watchlist 失敗: {e}")
         return False
-    finally:
-        conn.close()
 
 
-def remove_from_watchlist(stock_id: str):
+@_with_conn
+def remove_from_watchlist(conn, stock_id: str):
     """從關注清單移除"""
-    conn = _get_conn()
-    try:
+    with _transaction(conn):
         conn.execute("DELETE FROM watchlist WHERE stock_id = ?", (stock_id,))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    _invalidate("watchlist", "portfolio")
+    return True
 
 
-def update_watchlist_category(stock_id: str, category: str):
-    """切換持有/關注狀態"""
-    conn = _get_conn()
-    try:
-        conn.execute(
+def update_watchlist_category(stock_id: str, category: str,
+                              conn: Optional[sqlite3.Connection] = None):
+    """切換持有/關注狀態（傳入 conn 時併入呼叫端交易）"""
+    with _transaction(conn) as c:
+        c.execute(
             "UPDATE watchlist SET category = ?, updated_at = CURRENT_TIMESTAMP WHERE stock_id = ?",
             (category, stock_id)
         )
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    _invalidate("watchlist")
+    return True
 
 
 # ==========================================
 # Portfolio (持倉) CRUD
 # ==========================================
 
-def get_portfolio():
+@_cached("portfolio")
+@_with_conn
+def get_portfolio(conn):
     """取得所有持倉"""
-    conn = _get_conn()
-    try:
-        rows = conn.execute(
-            """SELECT p.*, w.notes FROM portfolio_summary p
-               LEFT JOIN watchlist w ON p.stock_id = w.stock_id
-               ORDER BY p.stock_id"""
-        ).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+    rows = conn.execute(
+        """SELECT p.*, w.notes FROM portfolio_summary p
+           LEFT JOIN watchlist w ON p.stock_id = w.stock_id
+           ORDER BY p.stock_id"""
+    ).fetchall()
+    return rows
 
 
-def update_portfolio_after_trade(stock_id: str, stock_name: str, action: str, shares: int, price: float, net_amount: float):
+def update_portfolio_after_trade(stock_id: str, stock_name: str, action: str, shares: int, price: float, net_amount: float,
+                                 conn: Optional[sqlite3.Connection] = None):
     """
     交易後自動更新持倉摘要
     買入：重新計算加權平均成本
     賣出：計算已實現損益，更新剩餘持股
+    傳入 conn 時併入呼叫端交易，錯誤直接往上拋讓呼叫端整筆 rollback
     """
-    conn = _get_conn()
     try:
-        existing = conn.execute(
-            "SELECT * FROM portfolio_summary WHERE stock_id = ?", (stock_id,)
-        ).fetchone()
-
-        if action == "buy":
-            if existing:
-                old_shares = existing["total_shares"]
-                old_cost = existing["avg_cost"]
-                new_total_shares = old_shares + shares
-                # 加權平均成本 = (舊成本×舊股數 + 新淨額) / 新總股數
-                new_avg_cost = (old_cost * old_shares + net_amount) / new_total_shares if new_total_shares > 0 else 0
-                conn.execute(
-                    """UPDATE portfolio_summary
-                       SET total_shares = ?, avg_cost = ?, stock_name = ?, updated_at = CURRENT_TIMESTAMP
-                       WHERE stock_id = ?""",
-                    (new_total_shares, round(new_avg_cost, 4), stock_name, stock_id)
-                )
-            else:
-                avg_cost = net_amount / shares if shares > 0 else price
-                conn.execute(
+        with _transaction(conn) as c:
+            if action == "buy":
+                # 單一 UPSERT：加權平均成本 = (舊成本×舊股數 + 新淨額) / 新總股數
+                first_cost = net_amount / shares if shares > 0 else price
+                c.execute(
                     """INSERT INTO portfolio_summary (stock_id, stock_name, total_shares, avg_cost)
-                       VALUES (?, ?, ?, ?)""",
-                    (stock_id, stock_name, shares, round(avg_cost, 4))
-                )
-            # 確保在 watchlist 中標記為持有
-            add_to_watchlist(stock_id, stock_name, "hold")
-
-        elif action == "sell":
-            if existing:
-                old_shares = existing["total_shares"]
-                old_cost = existing["avg_cost"]
-                sell_shares = min(shares, old_shares)
-                # 已實現損益 = 賣出淨額 - (均價成本 × 賣出股數)
-                realized = net_amount - (old_cost * sell_shares)
-                new_total = old_shares - sell_shares
-                old_realized = existing["realized_profit"] or 0
-
-                if new_total <= 0:
-                    # 全部賣出，清空持倉但保留紀錄
-                    conn.execute(
-                        """UPDATE portfolio_summary
-                           SET total_shares = 0, realized_profit = ?, updated_at = CURRENT_TIMESTAMP
-                           WHERE stock_id = ?""",
-                        (round(old_realized + realized, 2), stock_id)
-                    )
-                    # 從持有改為關注
-                    update_watchlist_category(stock_id, "watch")
-                else:
-                    conn.execute(
-                        """UPDATE portfolio_summary
-                           SET total_shares = ?, realized_profit = ?, updated_at = CURRENT_TIMESTAMP
-                           WHERE stock_id = ?""",
-                        (new_total, round(old_realized + realized, 2), stock_id)
-                    )
-
-        conn.commit()
+                       VALUES (?, ?, ?, ?)
+                       ON CONFLICT(stock_id) DO UPDATE SET
+                           avg_cost = CASE
+                               WHEN portfolio_summary.total_shares + excluded.total_shares > 0
+                               THEN ROUND((portfolio_summary.avg_cost * portfolio_summary.total_shares + ?)
+                                          / (portfolio_summary.total_shares + excluded.total_shares), 4)
+                               ELSE 0 END,
+                           total_shares = portfolio_summary.total_shares + excluded.total_shares,
+                           stock_name = excluded.stock_name,
+                           updated_at = CURRENT_TIMESTAMP
+                       RETURNING total_shares, avg_cost""",
+                    (stock_id, stock_name, shares, round(first_cost, 4), net_amount)
+                ).fetchone()
+                # 確保在 watchlist 中標記為持有
+                add_to_watchlist(stock_id, stock_name, "hold", conn=c)
+
+            elif action == "sell":
+                # 單一 UPDATE（SET 右側皆為更新前的值）：
+                # 已實現損益 += 賣出淨額 - (均價成本 × 實際賣出股數)
+                row = c.execute(
+                    """UPDATE portfolio_summary SET
+                           realized_profit = ROUND(COALESCE(realized_profit, 0)
+                                                   + (? - avg_cost * MIN(?, total_shares)), 2),
+                           total_shares = MAX(total_shares - ?, 0),
+                           updated_at = CURRENT_TIMESTAMP
+                       WHERE stock_id = ?
+                       RETURNING total_shares""",
+                    (net_amount, shares, shares, stock_id)
+                ).fetchone()
+                if row and row["total_shares"] <= 0:
+                    # 全部賣出，持倉歸零但保留紀錄，從持有改為關注
+                    update_watchlist_category(stock_id, "watch", conn=c)
+        _invalidate("portfolio", "watchlist")
         return True
     except Exception as e:
+        if conn is not None:
+            raise
         print(f"[DB] 更新持倉失敗: {e}")
         return False
-    finally:
-        conn.close()
 
 
 # ==========================================
@@ -184,16 +296,18 @@ def calculate_fees(action: str, shares: int, price: float, stock_id: str = ""):
     計算手續費和交易稅
     手續費 = 成交金額 × 0.1425% × 折數
     交易稅 = 賣出金額 × 0.3%（ETF: 0.1%）
+    傳入陣列時改走 calculate_fees_batch 一次算完
     """
+    if hasattr(shares, "__len__"):
+        return calculate_fees_batch(action, shares, price, stock_id)
+
     total_amount = shares * price
     fee = round(total_amount * BROKER_FEE_RATE * BROKER_FEE_DISCOUNT)
     fee = max(fee, 1)  # 最低手續費 1 元（零股也適用）
 
     tax = 0
     if action == "sell":
-        # 判斷是否為 ETF（代號以 00 開頭）
-        is_etf = stock_id.startswith("00")
-        tax_rate = TAX_RATE_ETF if is_etf else TAX_RATE_STOCK
+        tax_rate = TAX_RATE_ETF if is_etf(stock_id) else TAX_RATE_STOCK
         tax = round(total_amount * tax_rate)
 
     if action == "buy":
@@ -216,9 +330,9 @@ def add_trade(stock_id: str, stock_name: str, action: str, shares: int, price: f
     """
     fees = calculate_fees(action, shares, price, stock_id)
 
-    conn = _get_conn()
-    try:
-        trade_time = traded_at if traded_at else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    trade_time = traded_at if traded_at else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # 交易紀錄 + 持倉 + 關注清單在同一個交易內完成，只 commit 一次
+    with _transaction() as conn:
         conn.execute(
             """INSERT INTO trade_log
                (stock_id, stock_name, action, shares, price, total_amount, fee, tax, net_amount, is_odd_lot, note, traded_at)
@@ -227,116 +341,118 @@ def add_trade(stock_id: str, stock_name: str, action: str, shares: int, price: f
              fees["total_amount"], fees["fee"], fees["tax"], fees["net_amount"],
              1 if is_odd_lot else 0, note, trade_time)
         )
-        conn.commit()
-    finally:
-        conn.close()
-
-    # 更新持倉
-    update_portfolio_after_trade(stock_id, stock_name, action, shares, price, fees["net_amount"])
+        # 更新持倉
+        update_portfolio_after_trade(stock_id, stock_name, action, shares, price, fees["net_amount"], conn=conn)
+    # commit 之後再清一次，避免其他執行緒在 commit 前把舊資料放回快取
+    _invalidate("portfolio", "watchlist")
     return fees
 
 
-def get_trades(date_str: Optional[str] = None, stock_id: Optional[str] = None):
-    """查詢交易紀錄"""
-    conn = _get_conn()
-    try:
-        query = "SELECT * FROM trade_log WHERE 1=1"
-        params = []
-
-        if date_str:
-            query += " AND DATE(traded_at) = ?"
-            params.append(date_str)
-        if stock_id:
-            query += " AND stock_id = ?"
-            params.append(stock_id)
-
-        query += " ORDER BY traded_at DESC"
-        rows = conn.execute(query, params).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+def _paginate(query: str, params: list, limit: Optional[int], offset: int):
+    """在 SQL 端做分頁（limit 為 None 時回傳全部）"""
+    if limit is not None:
+        query += " LIMIT ? OFFSET ?"
+        params = list(params) + [limit, offset]
+    return query, params
+
+
+@_with_conn
+def get_trades(conn, date_str: Optional[str] = None, stock_id: Optional[str] = None,
+               limit: Optional[int] = None, offset: int = 0):
+    """查詢交易紀錄（可指定 limit/offset 分頁）"""
+    query = "SELECT * FROM trade_log WHERE 1=1"
+    params = []
+
+    if date_str:
+        # 用範圍條件取代 DATE(traded_at)，才能走 traded_at 索引
+        try:
+            next_day = (date.fromisoformat(date_str) + timedelta(days=1)).isoformat()
+        except ValueError:
+            return []
+        query += " AND traded_at >= ? AND traded_at < ?"
+        params.extend([date_str, next_day])
+    if stock_id:
+        query += " AND stock_id = ?"
+        params.append(stock_id)
+
+    query += " ORDER BY traded_at DESC"
+    query, params = _paginate(query, params, limit, offset)
+    return conn.execute(query, params).fetchall()
+
+
+@_with_conn
+def count_trades(conn, stock_id: Optional[str] = None):
+    """交易紀錄筆數"""
+    if stock_id:
+        row = conn.execute(
+            "SELECT COUNT(*) AS cnt FROM trade_log WHERE stock_id = ?", (stock_id,)
+        ).fetchone()
+    else:
+        row = conn.execute("SELECT COUNT(*) AS cnt FROM trade_log").fetchone()
+    return row["cnt"]
 
 
 # ==========================================
 # Daily Diary CRUD
 # ==========================================
 
-def get_diary(date_str: Optional[str] = None):
+@_cached("diary")
+@_with_conn
+def get_diary(conn, date_str: Optional[str] = None):
     """取得日記，若無指定日期則取今日"""
     if not date_str:
         date_str = date.today().isoformat()
-    conn = _get_conn()
-    try:
-        row = conn.execute(
-            "SELECT * FROM daily_diary WHERE date = ?", (date_str,)
-        ).fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
-
-
-def save_diary(date_str: str, ai_review: str = "", user_notes: str = "",
+    row = conn.execute(
+        "SELECT * FROM daily_diary WHERE date = ?", (date_str,)
+    ).fetchone()
+    return row
+
+
+# 日記可更新欄位；空字串代表「不覆蓋」既有內容
+_DIARY_FIELDS = ("ai_review", "user_notes", "reminders", "market_summary", "emotion_tag", "tomorrow_plan")
+
+_UPSERT_DIARY_SQL = (
+    f"INSERT INTO daily_diary (date, {', '.join(_DIARY_FIELDS)}) "
+    f"VALUES ({', '.join('?' * (len(_DIARY_FIELDS) + 1))}) "
+    "ON CONFLICT(date) DO UPDATE SET "
+    + ", ".join(
+        f"{f} = CASE WHEN excluded.{f} != '' THEN excluded.{f} ELSE daily_diary.{f} END"
+        for f in _DIARY_FIELDS
+    )
+    + ", updated_at = CASE WHEN "
+    + " OR ".join(f"excluded.{f} != ''" for f in _DIARY_FIELDS)
+    + " THEN CURRENT_TIMESTAMP ELSE daily_diary.updated_at END"
+)
+
+
+@_with_conn
+def save_diary(conn, date_str: str, ai_review: str = "", user_notes: str = "",
                reminders: str = "", market_summary: str = "",
                emotion_tag: str = "", tomorrow_plan: str = ""):
-    """儲存或更新日記"""
-    conn = _get_conn()
+    """儲存或更新日記（單一 UPSERT，只更新有值的欄位）"""
     try:
-        existing = conn.execute(
-            "SELECT id FROM daily_diary WHERE date = ?", (date_str,)
-        ).fetchone()
-
-        if existing:
-            # 只更新有值的欄位
-            updates = []
-            params = []
-            if ai_review:
-                updates.append("ai_review = ?")
-                params.append(ai_review)
-            if user_notes:
-                updates.append("user_notes = ?")
-                params.append(user_notes)
-            if reminders:
-                updates.append("reminders = ?")
-                params.append(reminders)
-            if market_summary:
-                updates.append("market_summary = ?")
-                params.append(market_summary)
-            if emotion_tag:
-                updates.append("emotion_tag = ?")
-                params.append(emotion_tag)
-            if tomorrow_plan:
-                updates.append("tomorrow_plan = ?")
-                params.append(tomorrow_plan)
-
-            if updates:
-                updates.append("updated_at = CURRENT_TIMESTAMP")
-                query = f"UPDATE daily_diary SET {', '.join(updates)} WHERE date = ?"
-                params.append(date_str)
-                conn.execute(query, params)
-        else:
+        with _transaction(conn):
             conn.execute(
-                """INSERT INTO daily_diary (date, ai_review, user_notes, reminders, market_summary, emotion_tag, tomorrow_plan)
-                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (date_str, ai_review, user_notes, reminders, market_summary, emotion_tag, tomorrow_plan)
+                _UPSERT_DIARY_SQL,
+                (date_str, ai_review or "", user_notes or "", reminders or "",
+                 market_summary or "", emotion_tag or "", tomorrow_plan or "")
             )
-        conn.commit()
+        _invalidate("diary")
         return True
     except Exception as e:
         print(f"[DB] 儲存日記失敗: {e}")
         return False
-    finally:
-        conn.close()
 
 
 # ==========================================
 # Institutional Data CRUD
 # ==========================================
 
-def save_market_institutional(date_str: str, foreign_net: float, trust_net: float, dealer_net: float):
+@_with_conn
+def save_market_institutional(conn, date_str: str, foreign_net: float, trust_net: float, dealer_net: float):
     """儲存大盤三大法人"""
-    conn = _get_conn()
-    try:
-        total_net = foreign_net + trust_net + dealer_net
+    total_net = foreign_net + trust_net + dealer_net
+    with _transaction(conn):
         conn.execute(
             """INSERT INTO market_institutional (date, foreign_net, trust_net, dealer_net, total_net)
                VALUES (?, ?, ?, ?, ?)
@@ -348,128 +464,267 @@ def save_market_institutional(date_str: str, foreign_net: float, trust_net: floa
                    fetched_at = CURRENT_TIMESTAMP""",
             (date_str, foreign_net, trust_net, dealer_net, total_net)
         )
-        conn.commit()
-    finally:
-        conn.close()
-
-
-def save_stock_institutional(date_str: str, stock_id: str, stock_name: str,
+    _invalidate("market_institutional")
+
+
+_UPSERT_STOCK_INSTITUTIONAL_SQL = """INSERT INTO institutional_data
+   (date, stock_id, stock_name, foreign_buy, foreign_sell, foreign_net,
+    trust_buy, trust_sell, trust_net, dealer_buy, dealer_sell, dealer_net, total_net)
+   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+   ON CONFLICT(date, stock_id) DO UPDATE SET
+       foreign_buy=excluded.foreign_buy, foreign_sell=excluded.foreign_sell,
+       foreign_net=excluded.foreign_net, trust_buy=excluded.trust_buy,
+       trust_sell=excluded.trust_sell, trust_net=excluded.trust_net,
+       dealer_buy=excluded.dealer_buy, dealer_sell=excluded.dealer_sell,
+       dealer_net=excluded.dealer_net, total_net=excluded.total_net,
+       fetched_at=CURRENT_TIMESTAMP"""
+
+
+def _stock_institutional_params(date_str, stock_id, stock_name,
+                                foreign_buy, foreign_sell,
+                                trust_buy, trust_sell,
+                                dealer_buy, dealer_sell):
+    """組出個股法人 UPSERT 參數（自動計算各項買賣超）"""
+    foreign_net = foreign_buy - foreign_sell
+    trust_net = trust_buy - trust_sell
+    dealer_net = dealer_buy - dealer_sell
+    total_net = foreign_net + trust_net + dealer_net
+    return (date_str, stock_id, stock_name,
+            foreign_buy, foreign_sell, foreign_net,
+            trust_buy, trust_sell, trust_net,
+            dealer_buy, dealer_sell, dealer_net, total_net)
+
+
+@_with_conn
+def save_stock_institutional(conn, date_str: str, stock_id: str, stock_name: str,
                              foreign_buy: int, foreign_sell: int,
                              trust_buy: int, trust_sell: int,
                              dealer_buy: int, dealer_sell: int):
     """儲存個股法人籌碼"""
-    conn = _get_conn()
-    try:
-        foreign_net = foreign_buy - foreign_sell
-        trust_net = trust_buy - trust_sell
-        dealer_net = dealer_buy - dealer_sell
-        total_net = foreign_net + trust_net + dealer_net
-
+    with _transaction(conn):
         conn.execute(
-            """INSERT INTO institutional_data
-               (date, stock_id, stock_name, foreign_buy, foreign_sell, foreign_net,
-                trust_buy, trust_sell, trust_net, dealer_buy, dealer_sell, dealer_net, total_net)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-               ON CONFLICT(date, stock_id) DO UPDATE SET
-                   foreign_buy=excluded.foreign_buy, foreign_sell=excluded.foreign_sell,
-                   foreign_net=excluded.foreign_net, trust_buy=excluded.trust_buy,
-                   trust_sell=excluded.trust_sell, trust_net=excluded.trust_net,
-                   dealer_buy=excluded.dealer_buy, dealer_sell=excluded.dealer_sell,
-                   dealer_net=excluded.dealer_net, total_net=excluded.total_net,
-                   fetched_at=CURRENT_TIMESTAMP""",
-            (date_str, stock_id, stock_name,
-             foreign_buy, foreign_sell, foreign_net,
-             trust_buy, trust_sell, trust_net,
-             dealer_buy, dealer_sell, dealer_net, total_net)
+            _UPSERT_STOCK_INSTITUTIONAL_SQL,
+            _stock_institutional_params(date_str, stock_id, stock_name,
+                                        foreign_buy, foreign_sell,
+                                        trust_buy, trust_sell,
+                                        dealer_buy, dealer_sell)
         )
-        conn.commit()
-    finally:
-        conn.close()
+    _invalidate("institutional")
 
 
-def get_institutional(date_str: Optional[str] = None, stock_id: Optional[str] = None):
-    """查詢法人籌碼"""
-    conn = _get_conn()
-    try:
-        if stock_id and date_str:
-            row = conn.execute(
-                "SELECT * FROM institutional_data WHERE date = ? AND stock_id = ?",
-                (date_str, stock_id)
-            ).fetchone()
-            return dict(row) if row else None
-        elif date_str:
-            rows = conn.execute(
-                "SELECT * FROM institutional_data WHERE date = ? ORDER BY ABS(total_net) DESC",
-                (date_str,)
-            ).fetchall()
-            return [dict(r) for r in rows]
-        else:
-            # 取最近一天
-            rows = conn.execute(
-                """SELECT * FROM institutional_data
-                   WHERE date = (SELECT MAX(date) FROM institutional_data)
-                   ORDER BY ABS(total_net) DESC"""
-            ).fetchall()
-            return [dict(r) for r in rows]
-    finally:
-        conn.close()
-
-
-def get_market_institutional(date_str: Optional[str] = None):
+def save_stock_institutional_bulk(rows: list):
+    """
+    批次儲存個股法人籌碼（每 BATCH_SIZE 筆一個交易）
+    rows 每筆為 (date, stock_id, stock_name, foreign_buy, foreign_sell,
+                 trust_buy, trust_sell, dealer_buy, dealer_sell)
+    """
+    for start in range(0, len(rows), BATCH_SIZE):
+        with _transaction() as conn:
+            conn.executemany(
+                _UPSERT_STOCK_INSTITUTIONAL_SQL,
+                (_stock_institutional_params(*r) for r in rows[start:start + BATCH_SIZE])
+            )
+    _invalidate("institutional")
+
+
+@_cached("institutional")
+@_with_conn
+def get_institutional(conn, date_str: Optional[str] = None, stock_id: Optional[str] = None,
+                      limit: Optional[int] = None, offset: int = 0):
+    """查詢法人籌碼（清單查詢可指定 limit/offset，依 |合計買賣超| 取前幾名）"""
+    if stock_id and date_str:
+        row = conn.execute(
+            "SELECT * FROM institutional_data WHERE date = ? AND stock_id = ?",
+            (date_str, stock_id)
+        ).fetchone()
+        return row
+    elif date_str:
+        query, params = _paginate(
+            "SELECT * FROM institutional_data WHERE date = ? ORDER BY ABS(total_net) DESC",
+            [date_str], limit, offset
+        )
+        return conn.execute(query, params).fetchall()
+    else:
+        # 取最近一天
+        query, params = _paginate(
+            """SELECT * FROM institutional_data
+               WHERE date = (SELECT MAX(date) FROM institutional_data)
+               ORDER BY ABS(total_net) DESC""",
+            [], limit, offset
+        )
+        return conn.execute(query, params).fetchall()
+
+
+@_cached("market_institutional")
+@_with_conn
+def get_market_institutional(conn, date_str: Optional[str] = None):
     """查詢大盤法人"""
-    conn = _get_conn()
-    try:
-        if date_str:
-            row = conn.execute(
-                "SELECT * FROM market_institutional WHERE date = ?", (date_str,)
-            ).fetchone()
-        else:
-            row = conn.execute(
-                "SELECT * FROM market_institutional ORDER BY date DESC LIMIT 1"
-            ).fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    if date_str:
+        row = conn.execute(
+            "SELECT * FROM market_institutional WHERE date = ?", (date_str,)
+        ).fetchone()
+    else:
+        row = conn.execute(
+            "SELECT * FROM market_institutional ORDER BY date DESC LIMIT 1"
+        ).fetchone()
+    return row
 
 
 # ==========================================
 # Snapshots CRUD
 # ==========================================
 
-def save_snapshot(stock_id: str, stock_name: str, data: dict):
+# 快照欄位順序（INSERT 與打包函式共用）
+_SNAPSHOT_COLS = ("price", "change_price", "change_percent",
+                  "volume", "total_volume", "amount",
+                  "high", "low", "open", "close",
+                  "buy_price", "sell_price", "vwap")
+
+_INSERT_SNAPSHOT_SQL = (
+    f"INSERT INTO stock_snapshots (stock_id, stock_name, {', '.join(_SNAPSHOT_COLS)}) "
+    f"VALUES ({', '.join('?' * (len(_SNAPSHOT_COLS) + 2))})"
+)
+
+
+def _build_snapshot_params():
+    """
+    啟動時依 _SNAPSHOT_COLS 產生固定順序的參數打包函式：
+    def _snapshot_params(stock_id, stock_name, data):
+        g = data.get
+        return (stock_id, stock_name, g("price", 0), g("change_price", 0), ...)
+    """
+    body = ", ".join(f"g({col!r}, 0)" for col in _SNAPSHOT_COLS)
+    namespace = {}
+    exec(
+        "def _snapshot_params(stock_id, stock_name, data):\n"
+        "    g = data.get\n"
+        f"    return (stock_id, stock_name, {body})",
+        namespace
+    )
+    func = namespace["_snapshot_params"]
+    func.__doc__ = "快照 dict 轉成 INSERT 參數（啟動時產生）"
+    return func
+
+
+_snapshot_params = _build_snapshot_params()
+
+
+@_with_conn
+def save_snapshot(conn, stock_id: str, stock_name: str, data: dict):
     """儲存行情快照"""
-    conn = _get_conn()
-    try:
-        conn.execute(
-            """INSERT INTO stock_snapshots
-               (stock_id, stock_name, price, change_price, change_percent,
-                volume, total_volume, amount, high, low, open, close,
-                buy_price, sell_price, vwap)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (stock_id, stock_name,
-             data.get("price", 0), data.get("change_price", 0), data.get("change_percent", 0),
-             data.get("volume", 0), data.get("total_volume", 0), data.get("amount", 0),
-             data.get("high", 0), data.get("low", 0), data.get("open", 0), data.get("close", 0),
-             data.get("buy_price", 0), data.get("sell_price", 0), data.get("vwap", 0))
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    with _transaction(conn):
+        conn.execute(_INSERT_SNAPSHOT_SQL, _snapshot_params(stock_id, stock_name, data))
 
 
-def get_latest_snapshots():
-    """取得所有股票的最新快照"""
-    conn = _get_conn()
+def save_snapshots_bulk(rows: list):
+    """
+    批次儲存行情快照（每 BATCH_SIZE 筆一個交易）
+    rows 每筆為 (stock_id, stock_name, data)
+    """
+    for start in range(0, len(rows), BATCH_SIZE):
+        with _transaction() as conn:
+            # 直接把產生器交給 executemany，參數邊產生邊綁定，不先組整個 list
+            conn.executemany(
+                _INSERT_SNAPSHOT_SQL,
+                (_snapshot_params(*r) for r in rows[start:start + BATCH_SIZE])
+            )
+
+
+@_with_conn
+def get_latest_snapshots(conn, limit: Optional[int] = None, offset: int = 0):
+    """取得所有股票的最新快照（可指定 limit/offset 分頁）"""
+    # 走 idx_snapshots_stock_time 依序讀取，每檔只取最新一筆
+    query, params = _paginate(
+        """SELECT * FROM (
+               SELECT *, ROW_NUMBER() OVER (
+                   PARTITION BY stock_id ORDER BY snapshot_at DESC
+               ) AS rn
+               FROM stock_snapshots
+           )
+           WHERE rn = 1
+           ORDER BY stock_id""",
+        [], limit, offset
+    )
+    rows = conn.execute(query, params).fetchall()
+    for r in rows:
+        r.pop("rn", None)
+    return rows
+
+
+@_with_conn
+def get_snapshot_history(conn, stock_id: str, limit: Optional[int] = None, offset: int = 0):
+    """取得單一股票的歷史快照（熱資料 + 封存，新到舊）"""
+    query, params = _paginate(
+        """SELECT * FROM stock_snapshots WHERE stock_id = ?
+           UNION ALL
+           SELECT * FROM stock_snapshots_archive WHERE stock_id = ?
+           ORDER BY snapshot_at DESC""",
+        [stock_id, stock_id], limit, offset
+    )
+    return conn.execute(query, params).fetchall()
+
+
+# 要封存的快照：一天前的資料，但每檔股票最新的一筆留在熱資料表
+# （週末、連假期間 get_latest_snapshots 仍查得到最後報價）
+_ARCHIVABLE_SNAPSHOTS_WHERE = """snapshot_at < date('now', '-1 day')
+   AND id NOT IN (
+       SELECT id FROM (
+           SELECT id, ROW_NUMBER() OVER (
+               PARTITION BY stock_id ORDER BY snapshot_at DESC
+           ) AS rn
+           FROM stock_snapshots
+       )
+       WHERE rn = 1
+   )"""
+_ARCHIVE_SNAPSHOTS_SQL = ("INSERT OR IGNORE INTO stock_snapshots_archive "
+                          "SELECT * FROM stock_snapshots WHERE " + _ARCHIVABLE_SNAPSHOTS_WHERE)
+_DELETE_ARCHIVED_SNAPSHOTS_SQL = "DELETE FROM stock_snapshots WHERE " + _ARCHIVABLE_SNAPSHOTS_WHERE
+
+
+def archive_old_snapshots():
+    """
+    把一天前的快照搬到 stock_snapshots_archive（排程每日執行）
+    熱資料表維持小而密的索引，get_latest_snapshots 只需掃這張表
+    每檔股票最新一筆不搬，休市期間仍能取得最後報價
+    """
     try:
-        rows = conn.execute(
-            """SELECT s.* FROM stock_snapshots s
-               INNER JOIN (
-                   SELECT stock_id, MAX(snapshot_at) as max_time
-                   FROM stock_snapshots
-                   GROUP BY stock_id
-               ) latest ON s.stock_id = latest.stock_id AND s.snapshot_at = latest.max_time
-               ORDER BY s.stock_id"""
-        ).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+        with _transaction() as conn:
+            conn.execute(_ARCHIVE_SNAPSHOTS_SQL)
+            moved = conn.execute(_DELETE_ARCHIVED_SNAPSHOTS_SQL).rowcount
+        # 歸還刪除後的空頁（僅 auto_vacuum=INCREMENTAL 的資料庫有作用）
+        # 需逐步執行到結束才會清空 freelist；execute() 只 step 一次（只釋放 1 頁），改用 executescript
+        _get_conn().executescript("PRAGMA incremental_vacuum;")
+        print(f"[DB] 已封存 {moved} 筆舊快照")
+        return moved
+    except Exception as e:
+        print(f"[DB] 封存快照失敗: {e}")
+        return 0
+
+
+# ==========================================
+# 非同步版本（給 FastAPI 路由 await）
+# 整個函式一次丟到執行緒池執行，不阻塞 event loop；
+# 每條執行緒沿用自己的長駐連線，多個查詢可用 asyncio.gather 並行
+# ==========================================
+
+def _to_async(func):
+    """把同步 CRUD 包成 async 版本"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return wrapper
+
+
+get_watchlist_async = _to_async(get_watchlist)
+add_to_watchlist_async = _to_async(add_to_watchlist)
+remove_from_watchlist_async = _to_async(remove_from_watchlist)
+update_watchlist_category_async = _to_async(update_watchlist_category)
+get_portfolio_async = _to_async(get_portfolio)
+add_trade_async = _to_async(add_trade)
+get_trades_async = _to_async(get_trades)
+count_trades_async = _to_async(count_trades)
+get_diary_async = _to_async(get_diary)
+save_diary_async = _to_async(save_diary)
+get_institutional_async = _to_async(get_institutional)
+get_market_institutional_async = _to_async(get_market_institutional)
+get_latest_snapshots_async = _to_async(get_latest_snapshots)
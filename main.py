@@ -13,6 +13,7 @@ if sys.platform == "win32":
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding="utf-8", errors="replace")
 
 import asyncio
+import importlib
 import uvicorn
 import webbrowser
 import threading
@@ -22,34 +23,49 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import ORJSONResponse
 
-from config import SERVER_HOST, SERVER_PORT
-from database.db import init_database
+from config import SERVER_HOST, SERVER_PORT, DISABLED_FEATURES
+from market_calendar import is_trading_day
+from database.db import init_database, close_db_pool, checkpoint_wal
+from database.db_pool import init_pool, close_pool, acquire_read
+from database.models import archive_old_snapshots
 from workers.shioaji_worker import worker as shioaji_worker
 from workers.institutional_worker import institutional_worker
-from workers.ai_analyzer import ai_analyzer
 from workers.alert_manager import alert_manager
-from workers.margin_worker import margin_worker
 from workers.telegram_bot import telegram_bot
-from workers.tdcc_worker import tdcc_worker
+# ai_analyzer / margin_worker / tdcc_worker 在用到時才 import（功能關閉時完全不載入）
+
+# 路由模組與所屬功能（None = 核心功能，一律載入）
+ROUTERS = (
+    # --- 第一階段路由 ---
+    ("routes.routes_stock", None),
+    ("routes.routes_watchlist", None),
+    ("routes.routes_trade", None),
+    ("routes.routes_institutional", None),
+    ("routes.routes_diary", None),
+    # --- 第二階段路由 ---
+    ("routes.routes_ai", "ai"),
+    ("routes.routes_alert", None),
+    ("routes.routes_margin", "margin"),
+    # --- 第三階段路由 ---
+    ("routes.routes_performance", None),
+    ("routes.routes_settings", None),
+    ("routes.routes_tdcc", "tdcc"),
+)
+
 
-# --- 第一階段路由 ---
-from routes.routes_stock import router as stock_router
-from routes.routes_watchlist import router as watchlist_router
-from routes.routes_trade import router as trade_router
-from routes.routes_institutional import router as institutional_router
-from routes.routes_diary import router as diary_router
+def feature_enabled(feature) -> bool:
+    """功能是否啟用（None 代表核心功能）"""
+    return feature is None or feature not in DISABLED_FEATURES
 
-# --- 第二階段路由 ---
-from routes.routes_ai import router as ai_router
-from routes.routes_alert import router as alert_router
-from routes.routes_margin import router as margin_router
 
-# --- 第三階段路由 ---
-from routes.routes_performance import router as performance_router
-from routes.routes_settings import router as settings_router
-from routes.routes_tdcc import router as tdcc_router
+def _ai_analyzer():
+    """取得 AI 引擎（AI 功能關閉時回傳 None，不載入 google.generativeai）"""
+    if not feature_enabled("ai"):
+        return None
+    from workers.ai_analyzer import ai_analyzer
+    return ai_analyzer
 
 
 # ==========================================
@@ -64,6 +80,7 @@ async def lifespan(app):
 
     # 1. 初始化資料庫
     await init_database()
+    init_pool()  # API 路由用的同步連線池（預先開好連線）
 
     # 2. 啟動 Shioaji Worker（背景行情引擎）
     shioaji_worker.start()
@@ -72,83 +89,65 @@ async def lifespan(app):
     institutional_worker.start()
 
     # 4. 啟動 AI 分析引擎（每日 18:15 自動檢討）
-    ai_analyzer.start()
+    ai_analyzer = _ai_analyzer()
+    if ai_analyzer:
+        ai_analyzer.start()
 
     # 5. 融資融券排程（掛到法人 Worker 的排程器裡，18:10 抓取）
+    if feature_enabled("margin"):
+        from workers.margin_worker import margin_worker
+        institutional_worker.scheduler.add_job(
+            margin_worker.fetch_margin_data,
+            trigger="cron",
+            day_of_week="mon-fri",
+            hour=18,
+            minute=10,
+            id="fetch_margin",
+            replace_existing=True
+        )
+
+    # 6. 到價提醒 - 註冊到 Shioaji Worker 的快照 hook（含 Telegram 推播）
+    shioaji_worker.post_fetch_hooks.append(_on_snapshots)
+
+    # 7. Telegram 通知 - 法人抓完後推播
+    institutional_worker.post_fetch_hooks.append(_on_institutional_done)
+
+    # 8. Telegram 通知 - AI 檢討完後推播
+    if ai_analyzer:
+        ai_analyzer.post_review_hooks.append(_on_ai_review_done)
+
+    # 9. 集保大戶排程（每週五 18:30）
+    if feature_enabled("tdcc"):
+        institutional_worker.scheduler.add_job(
+            _tdcc_weekly_fetch,
+            trigger="cron",
+            day_of_week="fri",
+            hour=18,
+            minute=30,
+            id="fetch_tdcc",
+            replace_existing=True
+        )
+
+    # 10. SQLite WAL 定期 checkpoint（每 5 分鐘，防止 WAL 檔無限成長）
     institutional_worker.scheduler.add_job(
-        margin_worker.fetch_margin_data,
-        trigger="cron",
-        hour=18,
-        minute=10,
-        id="fetch_margin",
+        checkpoint_wal,
+        trigger="interval",
+        minutes=5,
+        id="wal_checkpoint",
         replace_existing=True
     )
 
-    # 6. 到價提醒 - 掛載到 Shioaji Worker 的快取更新回呼（含 Telegram 推播）
-    _original_fetch = shioaji_worker.fetch_snapshots
-
-    def fetch_with_alerts(stock_ids):
-        results = _original_fetch(stock_ids)
-        if results:
-            triggered = alert_manager.check_alerts(results)
-            # Telegram 推播到價提醒
-            if triggered and telegram_bot.is_ready():
-                for t in triggered:
-                    telegram_bot.notify_alert_triggered(
-                        t.get("stock_id", ""),
-                        t.get("stock_name", ""),
-                        t.get("alert_type", ""),
-                        t.get("target_price", 0),
-                        t.get("current_price", 0)
-                    )
-        return results
-
-    shioaji_worker.fetch_snapshots = fetch_with_alerts
-
-    # 7. Telegram 通知掛載 - 法人抓完後推播
-    _original_inst_fetch = institutional_worker.scheduled_fetch
-
-    def inst_fetch_with_tg():
-        _original_inst_fetch()
-        if telegram_bot.is_ready():
-            from database.models import get_market_institutional
-            market_data = get_market_institutional()
-            if market_data:
-                telegram_bot.notify_institutional_done(
-                    market_data.get("date", ""),
-                    market_data
-                )
-
-    institutional_worker.scheduled_fetch = inst_fetch_with_tg
-
-    # 8. Telegram 通知掛載 - AI 檢討完後推播
-    _original_ai_review = ai_analyzer.scheduled_daily_review
-
-    def ai_review_with_tg():
-        _original_ai_review()
-        if telegram_bot.is_ready() and ai_analyzer.last_review_date:
-            from database.models import get_diary
-            diary = get_diary(ai_analyzer.last_review_date)
-            review_text = diary.get("ai_review", "") if diary else ""
-            telegram_bot.notify_ai_review_done(
-                ai_analyzer.last_review_date,
-                review_text
-            )
-
-    ai_analyzer.scheduled_daily_review = ai_review_with_tg
-
-    # 9. 集保大戶排程（每週五 18:30）
+    # 11. 舊快照封存（每日 18:00，熱資料表只留近一天）
     institutional_worker.scheduler.add_job(
-        _tdcc_weekly_fetch,
+        archive_old_snapshots,
         trigger="cron",
-        day_of_week="fri",
         hour=18,
-        minute=30,
-        id="fetch_tdcc",
+        minute=0,
+        id="archive_snapshots",
         replace_existing=True
     )
 
-    # 10. 初始化 Telegram Chat ID（從 DB 讀取）
+    # 12. 初始化 Telegram Chat ID（從 DB 讀取）
     _init_telegram_chat_id()
 
     print("=" * 50)
@@ -169,13 +168,49 @@ async def lifespan(app):
     print("\n正在關閉服務...")
     shioaji_worker.stop()
     institutional_worker.stop()
-    ai_analyzer.stop()
+    if ai_analyzer:
+        ai_analyzer.stop()
+    await telegram_bot.aclose()
+    await close_db_pool()
+    close_pool()
     print("[OK] 所有服務已安全關閉")
 
 
+def _on_snapshots(results: dict):
+    """快照抓完：檢查到價提醒，觸發的合併成一則 Telegram 推播"""
+    triggered = alert_manager.check_alerts(results)
+    if triggered and telegram_bot.ready_event.is_set():
+        telegram_bot.notify_alerts_batch(triggered)
+
+
+def _on_institutional_done(date_str: str):
+    """法人資料抓完：推播大盤法人摘要"""
+    if telegram_bot.ready_event.is_set():
+        from database.models import get_market_institutional
+        market_data = get_market_institutional()
+        if market_data:
+            telegram_bot.notify_institutional_done(
+                market_data.get("date", ""),
+                market_data
+            )
+
+
+def _on_ai_review_done(date_str: str):
+    """AI 檢討生成完：推播檢討摘要"""
+    if telegram_bot.ready_event.is_set():
+        from database.models import get_diary
+        diary = get_diary(date_str)
+        review_text = diary.get("ai_review", "") if diary else ""
+        telegram_bot.notify_ai_review_done(date_str, review_text)
+
+
 def _tdcc_weekly_fetch():
     """每週五抓取集保大戶資料"""
+    if not is_trading_day():
+        print("[TDCC] 今天休市，跳過抓取")
+        return
     from database.models import get_watchlist
+    from workers.tdcc_worker import tdcc_worker
     watchlist = get_watchlist()
     stock_ids = [w["stock_id"] for w in watchlist]
     if stock_ids:
@@ -185,24 +220,12 @@ def _tdcc_weekly_fetch():
 def _init_telegram_chat_id():
     """從 DB 讀取 Telegram Chat ID（如果有）"""
     try:
-        from database.db import get_db_sync
-        conn = get_db_sync()
-        try:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS app_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT DEFAULT '',
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.commit()
+        with acquire_read() as conn:
             row = conn.execute(
                 "SELECT value FROM app_settings WHERE key = 'telegram_chat_id'"
             ).fetchone()
-            if row and dict(row)["value"]:
-                telegram_bot.set_chat_id(dict(row)["value"])
-        finally:
-            conn.close()
+        if row and row["value"]:
+            telegram_bot.set_chat_id(row["value"])
     except Exception as e:
         print(f"[TG] 初始化 Chat ID 失敗: {e}")
 
@@ -214,30 +237,41 @@ app = FastAPI(
     title="台股戰情室",
     description="即時行情 + 交易紀錄 + 法人籌碼 + AI分析 + 到價提醒 + 績效總覽 + 日曆 + TG通知 + 集保大戶",
     version="3.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # orjson 序列化，比標準 json 快數倍
 )
 
-# 掛載靜態檔案
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# ==========================================
+# 靜態檔案（帶 Cache-Control，過期後瀏覽器用 ETag 重新驗證、回 304）
+# ==========================================
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles + 固定的 Cache-Control 標頭"""
+
+    def __init__(self, *args, cache_control: str = "no-cache", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers["Cache-Control"] = self.cache_control
+        return resp
+
+
+# app.js / style.css 檔名沒有版本 hash，不能設 immutable，只快取 1 小時
+app.mount(
+    "/static",
+    CachedStaticFiles(directory="static", cache_control="public, max-age=3600"),
+    name="static"
+)
 
-# --- 註冊所有路由 ---
-app.include_router(stock_router)
-app.include_router(watchlist_router)
-app.include_router(trade_router)
-app.include_router(institutional_router)
-app.include_router(diary_router)
-app.include_router(ai_router)
-app.include_router(alert_router)
-app.include_router(margin_router)
-app.include_router(performance_router)
-app.include_router(settings_router)
-app.include_router(tdcc_router)
+# --- 註冊所有路由（關閉的功能不 import）---
+for _module_name, _feature in ROUTERS:
+    if feature_enabled(_feature):
+        app.include_router(importlib.import_module(_module_name).router)
 
 
-# 首頁
-@app.get("/")
-async def index():
-    return FileResponse("static/index.html")
+# 首頁（最後掛載，放在所有 API 路由之後；index.html 每次都向伺服器驗證）
+app.mount("/", CachedStaticFiles(directory="static", html=True), name="index")
 
 
 # ==========================================
@@ -247,7 +281,9 @@ def signal_handler(sig, frame):
     print("\n收到中斷信號，正在關閉...")
     shioaji_worker.stop()
     institutional_worker.stop()
-    ai_analyzer.stop()
+    ai_analyzer = _ai_analyzer()
+    if ai_analyzer:
+        ai_analyzer.stop()
     sys.exit(0)
 
 
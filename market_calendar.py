@@ -0,0 +1,13 @@
+"""
+market_calendar.py - 台股交易日判斷
+週末與 TW_HOLIDAYS（.env 設定的休市日）不開盤，盤後排程直接跳過，不發無謂的 HTTP 請求
+"""
+from datetime import date
+
+from config import TW_HOLIDAYS
+
+
+def is_trading_day(day: date = None) -> bool:
+    """判斷是否為台股交易日（預設今天）"""
+    day = day or date.today()
+    return day.weekday() < 5 and day.isoformat() not in TW_HOLIDAYS
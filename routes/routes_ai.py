@@ -2,14 +2,19 @@
 routes/routes_ai.py - AI 分析 API 路由
 推薦股票 + 每日檢討 + 市場總結 + 推薦回測
 """
+import asyncio
+import orjson
+from collections import Counter
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
 from datetime import date, datetime, timedelta
 
 from workers.ai_analyzer import ai_analyzer
 from workers.shioaji_worker import worker as shioaji_worker
-from database.db import get_db_sync
+from database.db import dict_factory
+from database.db_pool import acquire_read, acquire_write
 
 router = APIRouter(prefix="/api/ai", tags=["AI 分析"])
 
@@ -18,44 +23,77 @@ router = APIRouter(prefix="/api/ai", tags=["AI 分析"])
 async def ai_recommend():
     """AI 推薦值得關注的股票"""
     try:
-        result = ai_analyzer.recommend_stocks()
+        result = await asyncio.to_thread(ai_analyzer.recommend_stocks)
 
         # 儲存推薦到 DB（供回測用）
         if result.get("recommendations"):
-            _save_recommendations(result["recommendations"])
+            await asyncio.to_thread(_save_recommendations, result["recommendations"])
 
         return {"status": "ok", "data": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI 推薦失敗: {e}")
 
 
+@router.get("/recommend/stream")
+async def ai_recommend_stream():
+    """
+    AI 推薦（Server-Sent Events）：每完成一檔推薦就推一個 recommendation 事件，最後推 done（完整結果）
+    不必等模型整段輸出完才顯示第一檔
+    """
+    return StreamingResponse(_stream_recommendations(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+def _stream_recommendations():
+    """推薦串流主體（同步產生器，StreamingResponse 會在執行緒池中迭代）"""
+    try:
+        for event, data in ai_analyzer.recommend_stocks_stream():
+            if event == "done" and data.get("recommendations"):
+                _save_recommendations(data["recommendations"])
+            yield b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+    except Exception as e:
+        yield b"event: error\ndata: " + orjson.dumps({"detail": f"AI 推薦失敗: {e}"}) + b"\n\n"
+
+
+_INSERT_RECOMMENDATION_SQL = """
+    INSERT INTO ai_recommendations
+    (date, stock_id, stock_name, reason, profit_potential,
+     time_horizon, horizon_days, stop_loss_price, target_price)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# 推薦週期 → 幾天後視為過期（寫入時換算好存進 horizon_days，回測只比整數）
+HORIZON_DAYS = {"短線": 14, "波段": 90}
+DEFAULT_HORIZON_DAYS = 180
+
+
+def _horizon_days(time_horizon: str) -> int:
+    """推薦週期文字換算成過期天數"""
+    return next((d for k, d in HORIZON_DAYS.items() if k in time_horizon), DEFAULT_HORIZON_DAYS)
+
+
 def _save_recommendations(recommendations: list):
     """儲存 AI 推薦紀錄（供回測追蹤）"""
-    conn = get_db_sync()
     today = date.today().isoformat()
+    rows = [(
+        today,
+        r.get("stock_id", ""),
+        r.get("stock_name", ""),
+        r.get("reason", ""),
+        r.get("profit_potential", ""),
+        r.get("time_horizon", ""),
+        _horizon_days(r.get("time_horizon") or ""),
+        r.get("stop_loss_price", 0),
+        r.get("target_price", 0)
+    ) for r in recommendations]
     try:
-        for r in recommendations:
-            conn.execute("""
-                INSERT INTO ai_recommendations
-                (date, stock_id, stock_name, reason, profit_potential,
-                 time_horizon, stop_loss_price, target_price)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                today,
-                r.get("stock_id", ""),
-                r.get("stock_name", ""),
-                r.get("reason", ""),
-                r.get("profit_potential", ""),
-                r.get("time_horizon", ""),
-                r.get("stop_loss_price", 0),
-                r.get("target_price", 0)
-            ))
-        conn.commit()
-        print(f"[AI] 已儲存 {len(recommendations)} 筆推薦紀錄")
+        with acquire_write() as conn:
+            # 一次 executemany + 單一交易，SQL 只解析一次
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(_INSERT_RECOMMENDATION_SQL, rows)
+        print(f"[AI] 已儲存 {len(rows)} 筆推薦紀錄")
     except Exception as e:
         print(f"[AI] 儲存推薦失敗: {e}")
-    finally:
-        conn.close()
 
 
 @router.post("/review")
@@ -64,7 +102,7 @@ async def ai_daily_review(date_str: Optional[str] = None):
     if not date_str:
         date_str = date.today().isoformat()
     try:
-        review = ai_analyzer.generate_daily_review(date_str)
+        review = await asyncio.to_thread(ai_analyzer.generate_daily_review, date_str)
         return {"status": "ok", "date": date_str, "review": review}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成檢討失敗: {e}")
@@ -76,7 +114,7 @@ async def ai_market_summary(date_str: Optional[str] = None):
     if not date_str:
         date_str = date.today().isoformat()
     try:
-        summary = ai_analyzer.generate_market_summary(date_str)
+        summary = await asyncio.to_thread(ai_analyzer.generate_market_summary, date_str)
         return {"status": "ok", "date": date_str, "summary": summary}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成市場總結失敗: {e}")
@@ -92,113 +130,123 @@ async def ai_backtest(days: int = 30):
     AI 推薦回測：追蹤歷史推薦的實際表現
     比對推薦時的目標價/停損價 vs 現在的實際結果
     """
-    conn = get_db_sync()
-    try:
-        start_date = (date.today() - timedelta(days=days)).isoformat()
-
-        rows = conn.execute("""
-            SELECT * FROM ai_recommendations
-            WHERE date >= ?
-            ORDER BY date DESC, stock_id
-        """, (start_date,)).fetchall()
-
-        recommendations = [dict(r) for r in rows]
-
-        # 取得最新快取行情
-        cache = shioaji_worker.cache if shioaji_worker else {}
-
-        # 計算每筆推薦的結果
-        hit_target = 0
-        hit_stoploss = 0
-        pending = 0
-        expired = 0
-        total = len(recommendations)
-
-        results = []
-        for rec in recommendations:
-            stock_id = rec["stock_id"]
-            target = rec.get("target_price", 0) or 0
-            stoploss = rec.get("stop_loss_price", 0) or 0
-            rec_date = rec.get("date", "")
-
-            # 取得目前價格（從快取或 DB）
-            current_price = 0
-            if stock_id in cache:
-                current_price = cache[stock_id].get("price", 0)
-
-            # 判斷推薦結果
-            status = "pending"
-            actual_result = rec.get("actual_result", "")
-
-            if actual_result:
-                # 已有手動/自動標記
-                status = actual_result
-            elif current_price > 0 and target > 0 and current_price >= target:
-                status = "hit_target"
-                hit_target += 1
-            elif current_price > 0 and stoploss > 0 and current_price <= stoploss:
-                status = "hit_stoploss"
-                hit_stoploss += 1
-            else:
-                # 檢查是否過期（超過時間週期）
-                time_horizon = rec.get("time_horizon", "")
-                days_passed = (date.today() - date.fromisoformat(rec_date)).days if rec_date else 0
-
-                if "短線" in time_horizon and days_passed > 14:
-                    status = "expired"
-                    expired += 1
-                elif "波段" in time_horizon and days_passed > 90:
-                    status = "expired"
-                    expired += 1
-                elif days_passed > 180:
-                    status = "expired"
-                    expired += 1
-                else:
-                    pending += 1
-
-            # 計算報酬率（如果有現價和推薦日的 current_price）
-            rec_price = 0
-            # 嘗試從 reason 或其他欄位推斷推薦時的價格
-            # 或直接用 ai_recommendations 表中可能存的 current_price
-            # 目前簡化：用 target 和 stoploss 推算中位數
-            if target > 0 and stoploss > 0:
-                rec_price = (target + stoploss) / 2  # 粗估推薦時價格
-            pnl_percent = 0
-            if rec_price > 0 and current_price > 0:
-                pnl_percent = round((current_price - rec_price) / rec_price * 100, 1)
-
-            results.append({
-                "id": rec.get("id"),
-                "date": rec_date,
-                "stock_id": stock_id,
-                "stock_name": rec.get("stock_name", ""),
-                "target_price": target,
-                "stop_loss_price": stoploss,
-                "current_price": current_price,
-                "status": status,
-                "pnl_percent": pnl_percent,
-                "time_horizon": rec.get("time_horizon", ""),
-                "reason": rec.get("reason", "")[:50]  # 截短
-            })
-
-        # 統計
-        decided = hit_target + hit_stoploss
-        accuracy = round(hit_target / decided * 100, 1) if decided > 0 else 0
-
-        return {
-            "status": "ok",
-            "summary": {
-                "total": total,
-                "hit_target": hit_target,
-                "hit_stoploss": hit_stoploss,
-                "pending": pending,
-                "expired": expired,
-                "accuracy": accuracy
-            },
-            "data": results
-        }
-    finally:
-        conn.close()
+    return StreamingResponse(_stream_backtest(days), media_type="application/json")
+
+
+# 推薦結果分類全部在 SQL 內完成（現價先寫進連線的 TEMP 表 live_prices 再 JOIN）
+# auto_status：依現價 / 時間週期自動判斷；status：有手動標記時以標記為準
+_LIVE_PRICES_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS live_prices (
+        stock_id TEXT PRIMARY KEY,
+        price REAL
+    )
+"""
+_CLEAR_LIVE_PRICES_SQL = "DELETE FROM live_prices"
+_INSERT_LIVE_PRICE_SQL = "INSERT INTO live_prices VALUES (?, ?)"
+
+_BACKTEST_CTE = """
+    WITH recs AS (
+        SELECT r.id, r.date, r.stock_id, r.stock_name,
+               COALESCE(r.target_price, 0) AS target_price,
+               COALESCE(r.stop_loss_price, 0) AS stop_loss_price,
+               COALESCE(lp.price, 0) AS current_price,
+               COALESCE(r.time_horizon, '') AS time_horizon,
+               r.horizon_days,
+               substr(COALESCE(r.reason, ''), 1, 50) AS reason,
+               COALESCE(r.actual_result, '') AS actual_result,
+               ? - r.date_ordinal AS days_passed
+        FROM ai_recommendations r
+        LEFT JOIN live_prices lp ON lp.stock_id = r.stock_id
+        WHERE r.date >= ?
+    ),
+    bt AS (
+        SELECT *,
+               CASE
+                   WHEN current_price > 0 AND target_price > 0 AND current_price >= target_price
+                       THEN 'hit_target'
+                   WHEN current_price > 0 AND stop_loss_price > 0 AND current_price <= stop_loss_price
+                       THEN 'hit_stoploss'
+                   WHEN days_passed > horizon_days THEN 'expired'
+                   ELSE 'pending'
+               END AS auto_status
+        FROM recs
+    )
+"""
+
+# 報酬率：推薦時價格粗估為 (目標價 + 停損價) / 2
+# counted_status：統計只計入自動判斷的結果（手動標記的為空字串，不列入各項計數）
+_BACKTEST_ROWS_SQL = _BACKTEST_CTE + """
+    SELECT id, date, stock_id, stock_name, target_price, stop_loss_price, current_price,
+           CASE WHEN actual_result != '' THEN actual_result ELSE auto_status END AS status,
+           CASE
+               WHEN target_price > 0 AND stop_loss_price > 0 AND current_price > 0
+               THEN ROUND((current_price - (target_price + stop_loss_price) / 2.0)
+                          / ((target_price + stop_loss_price) / 2.0) * 100, 1)
+               ELSE 0
+           END AS pnl_percent,
+           time_horizon,
+           reason,
+           CASE WHEN actual_result = '' THEN auto_status ELSE '' END AS counted_status
+    FROM bt
+    ORDER BY date DESC, stock_id
+"""
+
+
+BACKTEST_STREAM_BATCH = 500  # 每次從游標取出並輸出的筆數
+
+
+def _stream_backtest(days: int):
+    """
+    回測主體（同步產生器，StreamingResponse 會在執行緒池中迭代，不卡 event loop）
+    逐批 fetchmany 逐批輸出 JSON，結果再多也不會整包留在記憶體；統計邊輸出邊累計，放在最後
+    """
+    today = date.today()
+    start_date = (today - timedelta(days=days)).isoformat()
+
+    # 取得最新快取行情
+    cache = shioaji_worker.cache if shioaji_worker else {}
+    price_map = {sid: q.get("price", 0) for sid, q in list(cache.items())}
+    params = (today.toordinal(), start_date)
+
+    counts = Counter()
+    total = 0
+    with acquire_read() as conn:
+        # TEMP 表只存在這條連線，歸還連線池時 rollback 即清空
+        conn.execute(_LIVE_PRICES_DDL)
+        conn.execute(_CLEAR_LIVE_PRICES_SQL)
+        conn.executemany(_INSERT_LIVE_PRICE_SQL, price_map.items())
+
+        cur = conn.cursor()
+        cur.row_factory = dict_factory
+        cur.execute(_BACKTEST_ROWS_SQL, params)
+
+        yield b'{"status":"ok","data":['
+        while True:
+            batch = cur.fetchmany(BACKTEST_STREAM_BATCH)
+            if not batch:
+                break
+            for r in batch:
+                counts[r.pop("counted_status")] += 1
+            chunk = b",".join(orjson.dumps(r) for r in batch)
+            yield b"," + chunk if total else chunk
+            total += len(batch)
+
+    hit_target = counts["hit_target"]
+    hit_stoploss = counts["hit_stoploss"]
+
+    # 統計
+    decided = hit_target + hit_stoploss
+    accuracy = round(hit_target / decided * 100, 1) if decided > 0 else 0
+
+    summary = {
+        "total": total,
+        "hit_target": hit_target,
+        "hit_stoploss": hit_stoploss,
+        "pending": counts["pending"],
+        "expired": counts["expired"],
+        "accuracy": accuracy
+    }
+    yield b'],"summary":' + orjson.dumps(summary) + b"}"
 
 
 @router.post("/backtest/update/{rec_id}")
@@ -208,16 +256,17 @@ async def update_backtest_result(rec_id: int, result: str):
     if result not in allowed:
         raise HTTPException(status_code=400, detail=f"結果必須是: {', '.join(allowed)}")
 
-    conn = get_db_sync()
-    try:
-        conn.execute(
-            "UPDATE ai_recommendations SET actual_result = ? WHERE id = ?",
-            (result, rec_id)
-        )
-        conn.commit()
-        return {"status": "ok", "message": "已更新"}
-    finally:
-        conn.close()
+    await asyncio.to_thread(_update_backtest_result, rec_id, result)
+    return {"status": "ok", "message": "已更新"}
+
+
+_UPDATE_RESULT_SQL = "UPDATE ai_recommendations SET actual_result = ? WHERE id = ?"
+
+
+def _update_backtest_result(rec_id: int, result: str):
+    """寫入推薦結果（同步）"""
+    with acquire_write() as conn:
+        conn.execute(_UPDATE_RESULT_SQL, (result, rec_id))
 
 
 @router.get("/status")
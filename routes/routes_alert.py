@@ -2,6 +2,7 @@
 routes/routes_alert.py - 到價提醒 API 路由
 """
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
 from workers.alert_manager import alert_manager
@@ -37,7 +38,7 @@ async def add_alert(req: AddAlertRequest):
     }
 
 
-@router.get("/list")
+@router.get("/list", response_class=ORJSONResponse)
 async def list_alerts():
     """取得所有提醒"""
     alerts = alert_manager.get_all_alerts()
@@ -1,12 +1,16 @@
 """
 api/routes_diary.py - 每日日記 & 檢討 API 路由
 """
+import asyncio
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import Optional
 from datetime import date
 
-from database.models import get_diary, save_diary, get_trades
+from database.models import get_diary_async, save_diary_async, get_trades_async
+from database.db import dict_factory
+from database.db_pool import acquire_read
 
 router = APIRouter(prefix="/api/diary", tags=["每日日記"])
 
@@ -28,10 +32,11 @@ async def get_today_diary(date_str: Optional[str] = None):
     if not date_str:
         date_str = date.today().isoformat()
 
-    diary = get_diary(date_str)
-
-    # 取得當日交易紀錄
-    trades = get_trades(date_str=date_str)
+    # 日記 + 當日交易紀錄並行查詢
+    diary, trades = await asyncio.gather(
+        get_diary_async(date_str),
+        get_trades_async(date_str=date_str)
+    )
 
     return {
         "data": diary,
@@ -47,7 +52,7 @@ async def save_today_diary(req: DiaryUpdateRequest, date_str: Optional[str] = No
     if not date_str:
         date_str = date.today().isoformat()
 
-    success = save_diary(
+    success = await save_diary_async(
         date_str=date_str,
         user_notes=req.user_notes,
         reminders=req.reminders,
@@ -61,18 +66,19 @@ async def save_today_diary(req: DiaryUpdateRequest, date_str: Optional[str] = No
     return {"status": "ok", "message": f"日記已儲存 ({date_str})"}
 
 
-@router.get("/list")
+@router.get("/list", response_class=ORJSONResponse)
 async def list_diaries(limit: int = 30):
     """列出最近的日記"""
-    import sqlite3
-    from config import DB_PATH
-
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        rows = conn.execute(
-            "SELECT * FROM daily_diary ORDER BY date DESC LIMIT ?", (limit,)
-        ).fetchall()
-        return {"data": [dict(r) for r in rows], "count": len(rows)}
-    finally:
-        conn.close()
+    rows = await asyncio.to_thread(_list_diaries, limit)
+    return {"data": rows, "count": len(rows)}
+
+
+_LIST_DIARIES_SQL = "SELECT * FROM daily_diary ORDER BY date DESC LIMIT ?"
+
+
+def _list_diaries(limit: int):
+    """查詢最近的日記（同步）"""
+    with acquire_read() as conn:
+        cur = conn.cursor()
+        cur.row_factory = dict_factory  # 直接產生 dict，不經 sqlite3.Row 再複製
+        return cur.execute(_LIST_DIARIES_SQL, (limit,)).fetchall()
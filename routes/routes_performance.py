@@ -6,63 +6,170 @@ routes/routes_performance.py - 績效總覽 + 日曆視圖 API
   - 持倉分佈
   - 月曆每日盈虧
 """
-from fastapi import APIRouter
+import functools
+import hashlib
+import inspect
+import sqlite3
+import time
+
+import aiosqlite
+import numpy as np
+import orjson
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import ORJSONResponse
 from typing import Optional
-from datetime import date, datetime, timedelta
-from database.models import get_trades, get_portfolio, get_diary
-from database.db import get_db_sync
+from datetime import date, timedelta
+from database.models import get_portfolio_async, data_version
+from database.db import get_db, release_db
 
-router = APIRouter(prefix="/api/performance", tags=["績效總覽"])
+router = APIRouter(prefix="/api/performance", tags=["績效總覽"],
+                   default_response_class=ORJSONResponse)
+
+
+# ==========================================
+# 回應快取（儀表板會定時輪詢，資料只在新增交易 / 寫日記時變動）
+# 快取 key 帶上 portfolio / diary 的資料版本，add_trade、save_diary 之後自動失效
+# ==========================================
+PERF_CACHE_TTL = 30                 # 秒
+PERF_CACHE_TTL_CURRENT_MONTH = 5    # 當月資料
+PERF_CACHE_TTL_PAST_MONTH = 3600    # 過去月份不會再變
+PERF_CACHE_MAXSIZE = 256
+# 瀏覽器端最多快取 30 秒（過去月份也一樣：交易可補登過去日期），之後靠 ETag 驗證回 304
+PERF_HTTP_MAX_AGE = 30
+_perf_cache = {}  # key -> (到期時間, JSON bytes, ETag)
+
+
+def _month_ttl(year: Optional[int] = None, month: Optional[int] = None, **_) -> int:
+    """月份類 API：過去月份快取久一點，當月（或未來）短一點"""
+    today = date.today()
+    if (year or today.year, month or today.month) < (today.year, today.month):
+        return PERF_CACHE_TTL_PAST_MONTH
+    return PERF_CACHE_TTL_CURRENT_MONTH
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    """If-None-Match 是否已包含目前的 ETag"""
+    header = request.headers.get("if-none-match", "")
+    return header.strip() == "*" or etag in (t.strip() for t in header.split(","))
+
+
+def _cached_response(ttl=PERF_CACHE_TTL):
+    """
+    async 路由的 TTL 快取裝飾器（ttl 可為秒數或依查詢參數計算的函式）
+    快取的是序列化好的 JSON 與 ETag：命中時不必再序列化，瀏覽器帶 If-None-Match 相符就回 304
+    路由若有 db 參數，由裝飾器在快取未命中時才從連線池借連線（命中 / 304 不佔用非同步連線）
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        needs_db = "db" in signature.parameters
+
+        @functools.wraps(func)
+        async def wrapper(request: Request, **kwargs):
+            key = (func.__name__, tuple(sorted(kwargs.items())),
+                   data_version("portfolio", "diary"))
+            seconds = ttl(**kwargs) if callable(ttl) else ttl
+            now = time.monotonic()
+            hit = _perf_cache.get(key)
+            if hit and hit[0] > now:
+                body, etag = hit[1], hit[2]
+            else:
+                if needs_db:
+                    db = await get_db()
+                    try:
+                        result = await func(db=db, **kwargs)
+                    finally:
+                        await release_db(db)
+                else:
+                    result = await func(**kwargs)
+                body = orjson.dumps(result)
+                etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+                if len(_perf_cache) >= PERF_CACHE_MAXSIZE:
+                    _perf_cache.pop(next(iter(_perf_cache)))
+                _perf_cache[key] = (now + seconds, body, etag)
+
+            headers = {
+                "ETag": etag,
+                "Cache-Control": f"private, max-age={min(seconds, PERF_HTTP_MAX_AGE)}"
+            }
+            if _not_modified(request, etag):
+                return Response(status_code=304, headers=headers)
+            return Response(body, media_type="application/json", headers=headers)
+
+        # FastAPI 依簽章注入參數：原路由參數（db 除外）+ Request
+        wrapper.__signature__ = signature.replace(parameters=[
+            inspect.Parameter("request", inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+            *(p.replace(kind=inspect.Parameter.KEYWORD_ONLY)
+              for p in signature.parameters.values() if p.name != "db")
+        ])
+        return wrapper
+    return decorator
+
+
+# 每日損益 = 賣出淨額 - 買入淨額（簡化計算），累計損益用視窗函數、四捨五入都在 SQL 做好
+# 欄位名稱即 API 回傳格式，每列直接轉 dict
+_DAILY_PNL_SQL = """
+    WITH daily AS (
+        SELECT DATE(traded_at) AS trade_date,
+               SUM(CASE WHEN action='sell' THEN net_amount ELSE 0 END) -
+               SUM(CASE WHEN action='buy' THEN net_amount ELSE 0 END) AS daily_pnl,
+               SUM(fee) AS total_fee,
+               SUM(tax) AS total_tax,
+               COUNT(*) AS trade_count
+        FROM trade_log
+        WHERE traded_at >= ?
+        GROUP BY DATE(traded_at)
+    )
+    SELECT trade_date AS date,
+           ROUND(daily_pnl) AS daily_pnl,
+           ROUND(SUM(daily_pnl) OVER (ORDER BY trade_date ROWS UNBOUNDED PRECEDING)) AS cumulative_pnl,
+           trade_count,
+           ROUND(total_fee) AS fee,
+           ROUND(total_tax) AS tax
+    FROM daily
+    ORDER BY trade_date
+"""
 
 
 @router.get("/daily-pnl")
-async def daily_pnl(months: int = 3):
+@_cached_response()
+async def daily_pnl(months: int = 3, db: aiosqlite.Connection = None):
     """
     取得每日已實現損益（用於累計損益曲線）
     回傳最近 N 個月的每日 P&L
     """
-    conn = get_db_sync()
-    try:
-        start_date = (date.today() - timedelta(days=months * 30)).isoformat()
-
-        rows = conn.execute("""
-            SELECT DATE(traded_at) as trade_date,
-                   SUM(CASE WHEN action='sell' THEN net_amount ELSE 0 END) as total_sell,
-                   SUM(CASE WHEN action='buy' THEN net_amount ELSE 0 END) as total_buy,
-                   SUM(fee) as total_fee,
-                   SUM(tax) as total_tax,
-                   COUNT(*) as trade_count
-            FROM trade_log
-            WHERE DATE(traded_at) >= ?
-            GROUP BY DATE(traded_at)
-            ORDER BY trade_date
-        """, (start_date,)).fetchall()
-
-        daily_data = []
-        cumulative_pnl = 0
-
-        for r in rows:
-            row = dict(r)
-            # 每日損益 = 賣出淨額 - 買入淨額（簡化計算）
-            daily_pnl_val = row["total_sell"] - row["total_buy"]
-            cumulative_pnl += daily_pnl_val
-
-            daily_data.append({
-                "date": row["trade_date"],
-                "daily_pnl": round(daily_pnl_val, 0),
-                "cumulative_pnl": round(cumulative_pnl, 0),
-                "trade_count": row["trade_count"],
-                "fee": round(row["total_fee"], 0),
-                "tax": round(row["total_tax"], 0)
-            })
-
-        return {"status": "ok", "data": daily_data}
-    finally:
-        conn.close()
+    start_date = (date.today() - timedelta(days=months * 30)).isoformat()
+
+    async with db.execute(_DAILY_PNL_SQL, (start_date,)) as cursor:
+        rows = await cursor.fetchall()
+
+    daily_data = [dict(r) for r in rows]
+
+    return {"status": "ok", "data": daily_data}
+
+
+_MONTHLY_REPORT_SQL = """
+    SELECT COUNT(*) AS total_trades,
+           COUNT(CASE WHEN t.action = 'buy' THEN 1 END) AS buy_count,
+           COUNT(CASE WHEN t.action = 'sell' THEN 1 END) AS sell_count,
+           COALESCE(SUM(CASE WHEN t.action = 'buy' THEN t.net_amount END), 0) AS total_buy,
+           COALESCE(SUM(CASE WHEN t.action = 'sell' THEN t.net_amount END), 0) AS total_sell,
+           COALESCE(SUM(t.fee), 0) AS total_fee,
+           COALESCE(SUM(t.tax), 0) AS total_tax,
+           COUNT(DISTINCT DATE(t.traded_at)) AS active_days,
+           COUNT(CASE WHEN t.action = 'sell' AND p.avg_cost > 0
+                       AND t.price > p.avg_cost THEN 1 END) AS winning,
+           COUNT(CASE WHEN t.action = 'sell' AND p.avg_cost > 0
+                       AND t.price <= p.avg_cost THEN 1 END) AS losing
+    FROM trade_log t
+    LEFT JOIN portfolio_summary p ON p.stock_id = t.stock_id
+    WHERE strftime('%Y-%m', t.traded_at) = ?
+"""
 
 
 @router.get("/monthly-report")
-async def monthly_report(year: Optional[int] = None, month: Optional[int] = None):
+@_cached_response(ttl=_month_ttl)
+async def monthly_report(year: Optional[int] = None, month: Optional[int] = None,
+                         db: aiosqlite.Connection = None):
     """
     月報表：勝率、總損益、交易次數、手續費、稅
     """
@@ -73,105 +180,73 @@ async def monthly_report(year: Optional[int] = None, month: Optional[int] = None
 
     month_str = f"{year}-{month:02d}"
 
-    conn = get_db_sync()
-    try:
-        # 當月所有交易
-        rows = conn.execute("""
-            SELECT * FROM trade_log
-            WHERE strftime('%Y-%m', traded_at) = ?
-            ORDER BY traded_at
-        """, (month_str,)).fetchall()
-
-        trades = [dict(r) for r in rows]
-
-        # 統計
-        buy_trades = [t for t in trades if t["action"] == "buy"]
-        sell_trades = [t for t in trades if t["action"] == "sell"]
-        total_buy = sum(t["net_amount"] for t in buy_trades)
-        total_sell = sum(t["net_amount"] for t in sell_trades)
-        total_fee = sum(t["fee"] for t in trades)
-        total_tax = sum(t["tax"] for t in trades)
-        net_pnl = total_sell - total_buy
-
-        # 勝率（賣出交易價格 > 均價成本的比例）
-        portfolio_map = {}
-        portfolio = get_portfolio()
-        for p in portfolio:
-            portfolio_map[p["stock_id"]] = p.get("avg_cost", 0)
-
-        winning = 0
-        losing = 0
-        for t in sell_trades:
-            avg_cost = portfolio_map.get(t["stock_id"], 0)
-            if avg_cost > 0:
-                if t["price"] > avg_cost:
-                    winning += 1
-                else:
-                    losing += 1
-
-        total_decided = winning + losing
-        win_rate = (winning / total_decided * 100) if total_decided > 0 else 0
-
-        # 每日交易次數（用於活躍度統計）
-        daily_counts = {}
-        for t in trades:
-            d = t["traded_at"].split(" ")[0] if t["traded_at"] else ""
-            if d:
-                daily_counts[d] = daily_counts.get(d, 0) + 1
-
-        return {
-            "status": "ok",
-            "data": {
-                "year": year,
-                "month": month,
-                "total_trades": len(trades),
-                "buy_count": len(buy_trades),
-                "sell_count": len(sell_trades),
-                "total_buy": round(total_buy, 0),
-                "total_sell": round(total_sell, 0),
-                "net_pnl": round(net_pnl, 0),
-                "total_fee": round(total_fee, 0),
-                "total_tax": round(total_tax, 0),
-                "total_cost": round(total_fee + total_tax, 0),
-                "win_rate": round(win_rate, 1),
-                "winning_trades": winning,
-                "losing_trades": losing,
-                "active_days": len(daily_counts),
-                "avg_trades_per_day": round(len(trades) / max(len(daily_counts), 1), 1)
-            }
+    # 當月統計一次算完：買賣筆數 / 金額、費用、活躍天數、勝負場
+    # 勝率：賣出價格 > 持倉均價成本算勝（均價為 0 或無持倉紀錄的不計）
+    async with db.execute(_MONTHLY_REPORT_SQL, (month_str,)) as cursor:
+        stats = await cursor.fetchone()
+
+    total_trades = stats["total_trades"]
+    total_buy = stats["total_buy"]
+    total_sell = stats["total_sell"]
+    total_fee = stats["total_fee"]
+    total_tax = stats["total_tax"]
+    net_pnl = total_sell - total_buy
+
+    winning = stats["winning"]
+    losing = stats["losing"]
+    total_decided = winning + losing
+    win_rate = (winning / total_decided * 100) if total_decided > 0 else 0
+    active_days = stats["active_days"]
+
+    return {
+        "status": "ok",
+        "data": {
+            "year": year,
+            "month": month,
+            "total_trades": total_trades,
+            "buy_count": stats["buy_count"],
+            "sell_count": stats["sell_count"],
+            "total_buy": round(total_buy, 0),
+            "total_sell": round(total_sell, 0),
+            "net_pnl": round(net_pnl, 0),
+            "total_fee": round(total_fee, 0),
+            "total_tax": round(total_tax, 0),
+            "total_cost": round(total_fee + total_tax, 0),
+            "win_rate": round(win_rate, 1),
+            "winning_trades": winning,
+            "losing_trades": losing,
+            "active_days": active_days,
+            "avg_trades_per_day": round(total_trades / max(active_days, 1), 1)
         }
-    finally:
-        conn.close()
+    }
 
 
 @router.get("/portfolio-distribution")
+@_cached_response()
 async def portfolio_distribution():
     """
     持倉分佈（圓餅圖資料）
     """
-    portfolio = get_portfolio()
+    portfolio = await get_portfolio_async()
     active = [p for p in portfolio if p["total_shares"] > 0]
 
-    total_value = 0
-    items = []
-    for p in active:
-        # 用均價成本 * 持股數估算市值（精確值需要即時價格）
-        value = p["avg_cost"] * p["total_shares"]
-        total_value += value
-        items.append({
-            "stock_id": p["stock_id"],
-            "stock_name": p.get("stock_name", ""),
-            "shares": p["total_shares"],
-            "avg_cost": p["avg_cost"],
-            "value": round(value, 0)
-        })
-
-    # 計算百分比
-    for item in items:
-        item["percent"] = round(item["value"] / total_value * 100, 1) if total_value > 0 else 0
-
-    # 排序：市值大到小
-    items.sort(key=lambda x: x["value"], reverse=True)
+    # 用均價成本 * 持股數估算市值（精確值需要即時價格），整批向量化計算
+    costs = np.fromiter((p["avg_cost"] for p in active), dtype=np.float64, count=len(active))
+    shares = np.fromiter((p["total_shares"] for p in active), dtype=np.float64, count=len(active))
+    values = np.round(costs * shares, 0)
+    total_value = float((costs * shares).sum())
+    percents = values / total_value * 100 if total_value > 0 else np.zeros(len(active))
+
+    # 排序：市值大到小（stable，同市值維持原順序）
+    order = np.argsort(-values, kind="stable")
+    items = [{
+        "stock_id": active[i]["stock_id"],
+        "stock_name": active[i].get("stock_name", ""),
+        "shares": active[i]["total_shares"],
+        "avg_cost": active[i]["avg_cost"],
+        "value": values[i].item(),
+        "percent": round(percents[i].item(), 1)
+    } for i in order.tolist()]
 
     return {
         "status": "ok",
@@ -180,8 +255,54 @@ async def portfolio_distribution():
     }
 
 
+# 有交易或有日記的日期都要出現：兩邊做 FULL OUTER JOIN
+_CALENDAR_CTE = """
+    WITH t AS (
+        SELECT DATE(traded_at) AS trade_date,
+               SUM(CASE WHEN action='sell' THEN net_amount ELSE 0 END) -
+               SUM(CASE WHEN action='buy' THEN net_amount ELSE 0 END) AS daily_pnl,
+               COUNT(*) AS trade_count,
+               SUM(fee) + SUM(tax) AS cost
+        FROM trade_log
+        WHERE strftime('%Y-%m', traded_at) = ?
+        GROUP BY DATE(traded_at)
+    ), d AS (
+        SELECT date, emotion_tag, user_notes, ai_review
+        FROM daily_diary
+        WHERE strftime('%Y-%m', date) = ?
+    )
+"""
+_CALENDAR_COLUMNS = """
+    SELECT COALESCE(t.trade_date, d.date) AS date,
+           ROUND(COALESCE(t.daily_pnl, 0)) AS daily_pnl,
+           COALESCE(t.trade_count, 0) AS trade_count,
+           ROUND(COALESCE(t.cost, 0)) AS cost,
+           CASE WHEN d.date IS NULL THEN '' ELSE d.emotion_tag END AS emotion_tag,
+           COALESCE(d.user_notes, '') != '' AS has_notes,
+           COALESCE(d.ai_review, '') != '' AS has_ai_review
+"""
+if sqlite3.sqlite_version_info >= (3, 39, 0):
+    _CALENDAR_SQL = _CALENDAR_CTE + _CALENDAR_COLUMNS + """
+    FROM t FULL OUTER JOIN d ON d.date = t.trade_date
+    ORDER BY 1
+"""
+else:
+    # SQLite 3.39 以前沒有 FULL OUTER JOIN（例如 Ubuntu 22.04 的 3.37）：
+    # 有交易的日子 LEFT JOIN 日記，再補上只有日記的日子
+    _CALENDAR_SQL = _CALENDAR_CTE + _CALENDAR_COLUMNS + """
+    FROM t LEFT JOIN d ON d.date = t.trade_date
+    UNION ALL
+""" + _CALENDAR_COLUMNS + """
+    FROM d LEFT JOIN t ON d.date = t.trade_date
+    WHERE t.trade_date IS NULL
+    ORDER BY 1
+"""
+
+
 @router.get("/calendar")
-async def calendar_data(year: Optional[int] = None, month: Optional[int] = None):
+@_cached_response(ttl=_month_ttl)
+async def calendar_data(year: Optional[int] = None, month: Optional[int] = None,
+                        db: aiosqlite.Connection = None):
     """
     日曆視圖資料：每日盈虧 + 情緒 + 交易次數
     """
@@ -192,123 +313,66 @@ async def calendar_data(year: Optional[int] = None, month: Optional[int] = None)
 
     month_str = f"{year}-{month:02d}"
 
-    conn = get_db_sync()
-    try:
-        # 每日交易損益
-        trade_rows = conn.execute("""
-            SELECT DATE(traded_at) as trade_date,
-                   SUM(CASE WHEN action='sell' THEN net_amount ELSE 0 END) -
-                   SUM(CASE WHEN action='buy' THEN net_amount ELSE 0 END) as daily_pnl,
-                   COUNT(*) as trade_count,
-                   SUM(fee) + SUM(tax) as cost
-            FROM trade_log
-            WHERE strftime('%Y-%m', traded_at) = ?
-            GROUP BY DATE(traded_at)
-        """, (month_str,)).fetchall()
-
-        # 每日日記（情緒標記）
-        diary_rows = conn.execute("""
-            SELECT date, emotion_tag, user_notes, ai_review
-            FROM daily_diary
-            WHERE strftime('%Y-%m', date) = ?
-        """, (month_str,)).fetchall()
-
-        diary_map = {}
-        for d in diary_rows:
-            dd = dict(d)
-            diary_map[dd["date"]] = {
-                "emotion_tag": dd.get("emotion_tag", ""),
-                "has_notes": bool(dd.get("user_notes")),
-                "has_ai_review": bool(dd.get("ai_review"))
-            }
+    # 每日交易損益 + 日記（情緒標記）在 SQL 合併、排序好再回傳
+    async with db.execute(_CALENDAR_SQL, (month_str, month_str)) as cursor:
+        rows = await cursor.fetchall()
 
-        calendar = []
-        for r in trade_rows:
-            row = dict(r)
-            d = row["trade_date"]
-            diary_info = diary_map.get(d, {})
-
-            calendar.append({
-                "date": d,
-                "daily_pnl": round(row["daily_pnl"], 0),
-                "trade_count": row["trade_count"],
-                "cost": round(row["cost"], 0),
-                "emotion_tag": diary_info.get("emotion_tag", ""),
-                "has_notes": diary_info.get("has_notes", False),
-                "has_ai_review": diary_info.get("has_ai_review", False)
-            })
-
-        # 補上有日記但沒交易的日期
-        for d, info in diary_map.items():
-            if d not in [c["date"] for c in calendar]:
-                calendar.append({
-                    "date": d,
-                    "daily_pnl": 0,
-                    "trade_count": 0,
-                    "cost": 0,
-                    "emotion_tag": info.get("emotion_tag", ""),
-                    "has_notes": info.get("has_notes", False),
-                    "has_ai_review": info.get("has_ai_review", False)
-                })
-
-        # 按日期排序
-        calendar.sort(key=lambda x: x["date"])
-
-        return {
-            "status": "ok",
-            "year": year,
-            "month": month,
-            "data": calendar
-        }
-    finally:
-        conn.close()
+    calendar = [{
+        "date": r["date"],
+        "daily_pnl": r["daily_pnl"],
+        "trade_count": r["trade_count"],
+        "cost": r["cost"],
+        "emotion_tag": r["emotion_tag"],
+        "has_notes": bool(r["has_notes"]),
+        "has_ai_review": bool(r["has_ai_review"])
+    } for r in rows]
+
+    return {
+        "status": "ok",
+        "year": year,
+        "month": month,
+        "data": calendar
+    }
+
+
+_SUMMARY_SQL = """
+    WITH r AS (
+        SELECT COALESCE(SUM(realized_profit), 0) AS total_realized,
+               COUNT(CASE WHEN total_shares > 0 THEN 1 END) AS active_positions
+        FROM portfolio_summary
+    ), t AS (
+        SELECT COUNT(*) AS total_trades,
+               COALESCE(SUM(fee), 0) AS total_fee,
+               COALESCE(SUM(tax), 0) AS total_tax,
+               COUNT(DISTINCT DATE(traded_at)) AS trading_days
+        FROM trade_log
+    )
+    SELECT * FROM r, t
+"""
 
 
 @router.get("/summary")
-async def overall_summary():
+@_cached_response()
+async def overall_summary(db: aiosqlite.Connection = None):
     """
     總績效摘要（所有時間）
     """
-    conn = get_db_sync()
-    try:
-        # 總已實現損益（從 portfolio_summary）
-        row = conn.execute("""
-            SELECT COALESCE(SUM(realized_profit), 0) as total_realized
-            FROM portfolio_summary
-        """).fetchone()
-        total_realized = dict(row)["total_realized"]
-
-        # 總交易次數和費用
-        row2 = conn.execute("""
-            SELECT COUNT(*) as total_trades,
-                   COALESCE(SUM(fee), 0) as total_fee,
-                   COALESCE(SUM(tax), 0) as total_tax
-            FROM trade_log
-        """).fetchone()
-        stats = dict(row2)
-
-        # 交易天數
-        row3 = conn.execute("""
-            SELECT COUNT(DISTINCT DATE(traded_at)) as trading_days
-            FROM trade_log
-        """).fetchone()
-        trading_days = dict(row3)["trading_days"]
-
-        # 持倉
-        portfolio = get_portfolio()
-        active_positions = len([p for p in portfolio if p["total_shares"] > 0])
-
-        return {
-            "status": "ok",
-            "data": {
-                "total_realized_pnl": round(total_realized, 0),
-                "total_trades": stats["total_trades"],
-                "total_fee": round(stats["total_fee"], 0),
-                "total_tax": round(stats["total_tax"], 0),
-                "total_cost": round(stats["total_fee"] + stats["total_tax"], 0),
-                "trading_days": trading_days,
-                "active_positions": active_positions
-            }
+    # 已實現損益、交易統計、交易天數、持倉數一次查完（1 個查詢取代 4 次來回）
+    async with db.execute(_SUMMARY_SQL) as cursor:
+        stats = await cursor.fetchone()
+    total_realized = stats["total_realized"]
+    trading_days = stats["trading_days"]
+    active_positions = stats["active_positions"]
+
+    return {
+        "status": "ok",
+        "data": {
+            "total_realized_pnl": round(total_realized, 0),
+            "total_trades": stats["total_trades"],
+            "total_fee": round(stats["total_fee"], 0),
+            "total_tax": round(stats["total_tax"], 0),
+            "total_cost": round(stats["total_fee"] + stats["total_tax"], 0),
+            "trading_days": trading_days,
+            "active_positions": active_positions
         }
-    finally:
-        conn.close()
+    }
@@ -5,11 +5,18 @@ routes/routes_settings.py - 設定頁面 API
   - Telegram Chat ID 偵測與測試
   - 手續費折扣設定
 """
+import asyncio
+import hashlib
+import threading
+import time
+
+import orjson
+
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional
-from database.db import get_db_sync
-from workers.telegram_bot import telegram_bot
+from database.db_pool import acquire_read, acquire_write
+from workers.telegram_bot import telegram_bot, normalize_chat_id
 from config import (
     BROKER_FEE_RATE, BROKER_FEE_DISCOUNT,
     TAX_RATE_STOCK, TAX_RATE_ETF,
@@ -23,46 +30,90 @@ router = APIRouter(prefix="/api/settings", tags=["系統設定"])
 # 資料表操作
 # ==========================================
 
-def _ensure_table():
-    """確保 app_settings 表存在"""
-    conn = get_db_sync()
-    try:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS app_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT DEFAULT '',
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-    finally:
-        conn.close()
+# app_settings 表由 init_database（SCHEMA_SQL）建立，這裡直接使用常駐連線池
+
+_ALL_SETTINGS_SQL = "SELECT key, value FROM app_settings"
+_SET_SETTING_SQL = """
+    INSERT INTO app_settings (key, value)
+    VALUES (?, ?)
+    ON CONFLICT(key) DO UPDATE SET
+        value = excluded.value,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+# 設定幾乎不會變：整張表一次讀進記憶體，TTL 內直接查 dict
+# 寫入時同步更新快取；TTL 只是保險（例如有人直接改 DB）
+SETTINGS_CACHE_TTL = 30  # 秒
+_settings_cache = {}
+_settings_expires = 0.0
+_settings_lock = threading.Lock()
+
+
+def _load_settings() -> dict:
+    """快取過期時一次讀出所有設定（1 個查詢取代每個 key 各查一次）"""
+    global _settings_cache, _settings_expires
+    with _settings_lock:
+        if time.monotonic() < _settings_expires:
+            return _settings_cache
+        with acquire_read() as conn:
+            rows = conn.execute(_ALL_SETTINGS_SQL).fetchall()
+        _settings_cache = {row["key"]: row["value"] for row in rows}
+        _settings_expires = time.monotonic() + SETTINGS_CACHE_TTL
+        return _settings_cache
 
 
 def _get_setting(key: str, default: str = "") -> str:
-    conn = get_db_sync()
-    try:
-        row = conn.execute(
-            "SELECT value FROM app_settings WHERE key = ?", (key,)
-        ).fetchone()
-        return dict(row)["value"] if row else default
-    finally:
-        conn.close()
+    value = _load_settings().get(key)
+    return value if value is not None else default
+
+
+def _set_settings(pairs):
+    """一次寫入多筆設定 [(key, value), ...]：單一交易 + executemany，只 commit 一次"""
+    pairs = list(pairs)
+    with acquire_write() as conn:
+        conn.executemany(_SET_SETTING_SQL, pairs)
+    with _settings_lock:
+        _settings_cache.update(pairs)
 
 
 def _set_setting(key: str, value: str):
-    conn = get_db_sync()
+    _set_settings([(key, value)])
+
+
+# ==========================================
+# 偵測過的 Telegram 聊天（getUpdates 只保留 24 小時，重啟或過期後仍可沿用）
+# ==========================================
+
+# 存在 app_settings：{"bot": Token 雜湊, "chats": [{chat_id, username, name}, ...]}
+# 換了 Bot Token 就視為沒有紀錄（舊 Bot 的聊天對新 Bot 無效）
+_KNOWN_CHATS_KEY = "telegram_known_chats"
+_BOT_HASH = hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).hexdigest()[:16]
+
+
+def _load_known_chats() -> list:
+    """讀出目前 Bot 偵測過的聊天（舊到新）"""
     try:
-        conn.execute("""
-            INSERT INTO app_settings (key, value)
-            VALUES (?, ?)
-            ON CONFLICT(key) DO UPDATE SET
-                value = excluded.value,
-                updated_at = CURRENT_TIMESTAMP
-        """, (key, value))
-        conn.commit()
-    finally:
-        conn.close()
+        cached = orjson.loads(_get_setting(_KNOWN_CHATS_KEY, "{}"))
+    except orjson.JSONDecodeError:
+        return []
+    return cached.get("chats", []) if cached.get("bot") == _BOT_HASH else []
+
+
+def _remember_chats(chats: list):
+    """合併新偵測到的聊天並存檔，同時把最新一個設為推播對象"""
+    merged = {c["chat_id"]: c for c in _load_known_chats()}
+    for chat in chats:
+        merged.pop(chat["chat_id"], None)
+        merged[chat["chat_id"]] = chat
+    _set_settings([
+        ("telegram_chat_id", chats[-1]["chat_id"]),
+        (_KNOWN_CHATS_KEY, orjson.dumps({"bot": _BOT_HASH, "chats": list(merged.values())}).decode()),
+    ])
+
+
+def _clear_known_chats():
+    """清除偵測過的聊天紀錄（不影響目前使用中的 Chat ID）"""
+    _set_setting(_KNOWN_CHATS_KEY, "{}")
 
 
 # ==========================================
@@ -72,9 +123,9 @@ def _set_setting(key: str, value: str):
 @router.get("/")
 async def get_settings():
     """取得所有設定"""
-    _ensure_table()
-
     # 從 DB 讀取動態設定，若無則用 .env 預設值
+    # 快取過期時在執行緒池重新載入（不阻塞 event loop），之後的 _get_setting 都是記憶體查詢
+    await asyncio.to_thread(_load_settings)
     tg_chat_id = _get_setting("telegram_chat_id", TELEGRAM_CHAT_ID)
     tg_enabled = _get_setting("telegram_enabled", "true")
     fee_discount = _get_setting("broker_fee_discount", str(BROKER_FEE_DISCOUNT))
@@ -110,8 +161,6 @@ class SettingUpdate(BaseModel):
 @router.post("/update")
 async def update_setting(setting: SettingUpdate):
     """更新單一設定"""
-    _ensure_table()
-
     allowed_keys = [
         "telegram_chat_id", "telegram_enabled",
         "broker_fee_discount",
@@ -121,7 +170,13 @@ async def update_setting(setting: SettingUpdate):
     if setting.key not in allowed_keys:
         raise HTTPException(status_code=400, detail=f"不允許修改此設定: {setting.key}")
 
-    _set_setting(setting.key, setting.value)
+    if setting.key == "telegram_chat_id":
+        try:
+            setting.value = normalize_chat_id(setting.value)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    await asyncio.to_thread(_set_setting, setting.key, setting.value)
 
     # 即時生效：更新 Telegram Bot 的 Chat ID
     if setting.key == "telegram_chat_id":
@@ -137,33 +192,53 @@ async def update_setting(setting: SettingUpdate):
 @router.post("/telegram/detect")
 async def telegram_detect_chat_id():
     """偵測 Telegram Chat ID"""
-    result = telegram_bot.detect_chat_id()
+    # deleteWebhook + getUpdates 長輪詢（最多數秒）在執行緒池執行，不阻塞 event loop
+    result = await asyncio.to_thread(telegram_bot.detect_chat_id)
     if result.get("success"):
-        # 儲存到 DB
-        _ensure_table()
-        _set_setting("telegram_chat_id", result["chat_id"])
+        # 儲存到 DB（連同這次看到的所有聊天）
+        await asyncio.to_thread(_remember_chats, result["chats"])
         return {
             "status": "ok",
             "message": f"偵測成功！Chat ID: {result['chat_id']}",
             "data": result
         }
-    else:
-        raise HTTPException(status_code=400, detail=result.get("error", "偵測失敗"))
+
+    # getUpdates 沒有訊息（超過 24 小時）時，沿用之前偵測到的最新聊天
+    known = await asyncio.to_thread(_load_known_chats) if result.get("no_updates") else []
+    if known:
+        latest = known[-1]
+        telegram_bot.set_chat_id(latest["chat_id"])
+        await asyncio.to_thread(_set_setting, "telegram_chat_id", latest["chat_id"])
+        return {
+            "status": "ok",
+            "message": f"沿用先前偵測到的 Chat ID: {latest['chat_id']}",
+            "data": {"success": True, **latest, "chats": known}
+        }
+    raise HTTPException(status_code=400, detail=result.get("error", "偵測失敗"))
+
+
+@router.delete("/telegram/known-chats")
+async def telegram_clear_known_chats():
+    """清除偵測過的 Telegram 聊天紀錄"""
+    await asyncio.to_thread(_clear_known_chats)
+    return {"status": "ok", "message": "已清除偵測紀錄"}
 
 
 @router.post("/telegram/test")
 async def telegram_test():
     """發送測試訊息"""
     # 先確保使用最新的 Chat ID
-    _ensure_table()
-    chat_id = _get_setting("telegram_chat_id", TELEGRAM_CHAT_ID)
+    chat_id = await asyncio.to_thread(_get_setting, "telegram_chat_id", TELEGRAM_CHAT_ID)
     if chat_id:
-        telegram_bot.set_chat_id(chat_id)
+        try:
+            telegram_bot.set_chat_id(chat_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
     if not telegram_bot.is_ready():
         raise HTTPException(status_code=400, detail="Telegram 尚未設定完成（缺少 Chat ID）")
 
-    success = telegram_bot.send_test()
+    success = await telegram_bot.send_test_async()
     if success:
         return {"status": "ok", "message": "測試訊息已發送，請查看 Telegram"}
     else:
@@ -175,9 +250,12 @@ async def telegram_set_chat_id(chat_id: str):
     """手動設定 Chat ID"""
     if not chat_id or not chat_id.strip():
         raise HTTPException(status_code=400, detail="Chat ID 不能為空")
+    try:
+        chat_id = normalize_chat_id(chat_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    _ensure_table()
-    _set_setting("telegram_chat_id", chat_id.strip())
-    telegram_bot.set_chat_id(chat_id.strip())
+    await asyncio.to_thread(_set_setting, "telegram_chat_id", chat_id)
+    telegram_bot.set_chat_id(chat_id)
 
-    return {"status": "ok", "message": f"Chat ID 已設定: {chat_id.strip()}"}
+    return {"status": "ok", "message": f"Chat ID 已設定: {chat_id}"}
@@ -1,6 +1,8 @@
 """
 routes/routes_tdcc.py - 集保大戶資料 API
 """
+import asyncio
+
 from fastapi import APIRouter, HTTPException
 from typing import Optional
 from workers.tdcc_worker import tdcc_worker
@@ -17,7 +19,7 @@ async def get_tdcc_list():
 
     results = []
     for stock_id in stock_ids:
-        summary = tdcc_worker.get_tdcc_summary(stock_id)
+        summary = tdcc_worker.get_tdcc_summary(stock_id, with_rows=False)
         if summary.get("summary"):
             results.append(summary)
 
@@ -41,7 +43,7 @@ async def fetch_tdcc():
         raise HTTPException(status_code=400, detail="關注清單為空")
 
     try:
-        count = tdcc_worker.fetch_and_save(stock_ids)
+        count = await asyncio.to_thread(tdcc_worker.fetch_and_save, stock_ids)
         return {
             "status": "ok",
             "message": f"已抓取 {count} 筆集保資料",
@@ -1,12 +1,13 @@
 """
 api/routes_trade.py - 交易紀錄 API 路由
 """
+import asyncio
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional
 from datetime import date
 
-from database.models import add_trade, get_trades, calculate_fees
+from database.models import add_trade_async, get_trades_async, count_trades_async, calculate_fees
 from workers.shioaji_worker import worker
 
 router = APIRouter(prefix="/api/trade", tags=["交易紀錄"])
@@ -42,7 +43,7 @@ async def record_trade(req: TradeRequest):
     # 取得股票名稱
     stock_name = worker.get_stock_name(req.stock_id) if worker.is_connected else ""
 
-    fees = add_trade(
+    fees = await add_trade_async(
         stock_id=req.stock_id,
         stock_name=stock_name,
         action=req.action,
@@ -70,13 +71,17 @@ async def list_trades(date_str: Optional[str] = None, stock_id: Optional[str] =
     if not date_str:
         date_str = date.today().isoformat()
 
-    trades = get_trades(date_str=date_str, stock_id=stock_id)
+    trades = await get_trades_async(date_str=date_str, stock_id=stock_id)
 
-    # 計算當日統計
-    total_buy = sum(t["net_amount"] for t in trades if t["action"] == "buy")
-    total_sell = sum(t["net_amount"] for t in trades if t["action"] == "sell")
-    total_fee = sum(t["fee"] for t in trades)
-    total_tax = sum(t["tax"] for t in trades)
+    # 計算當日統計（單次走訪）
+    total_buy = total_sell = total_fee = total_tax = 0
+    for t in trades:
+        if t["action"] == "buy":
+            total_buy += t["net_amount"]
+        elif t["action"] == "sell":
+            total_sell += t["net_amount"]
+        total_fee += t["fee"]
+        total_tax += t["tax"]
 
     return {
         "data": trades,
@@ -99,7 +104,10 @@ async def calc_fees(req: FeeCalcRequest):
 
 
 @router.get("/history")
-async def trade_history(stock_id: Optional[str] = None, limit: int = 50):
-    """查詢歷史交易紀錄（不限日期）"""
-    trades = get_trades(stock_id=stock_id)
-    return {"data": trades[:limit], "count": len(trades)}
+async def trade_history(stock_id: Optional[str] = None, limit: int = 50, offset: int = 0):
+    """查詢歷史交易紀錄（不限日期，SQL 端分頁）"""
+    trades, count = await asyncio.gather(
+        get_trades_async(stock_id=stock_id, limit=limit, offset=offset),
+        count_trades_async(stock_id)
+    )
+    return {"data": trades, "count": count}
@@ -6,8 +6,8 @@ from pydantic import BaseModel
 from typing import Optional
 
 from database.models import (
-    get_watchlist, add_to_watchlist, remove_from_watchlist,
-    update_watchlist_category, get_portfolio
+    get_watchlist_async, add_to_watchlist_async, remove_from_watchlist_async,
+    update_watchlist_category_async, get_portfolio_async
 )
 from workers.shioaji_worker import worker
 
@@ -31,7 +31,7 @@ class UpdateCategoryRequest(BaseModel):
 @router.get("/")
 async def list_watchlist(category: Optional[str] = None):
     """取得關注清單（可篩選 hold/watch）"""
-    items = get_watchlist(category)
+    items = await get_watchlist_async(category)
 
     # 補上即時行情
     cache = worker.get_cache()
@@ -63,7 +63,7 @@ async def add_stock(req: AddStockRequest):
             raise HTTPException(status_code=400, detail=f"無效的股票代號: {stock_id}")
         stock_name = worker.get_stock_name(stock_id)
 
-    success = add_to_watchlist(stock_id, stock_name, req.category, req.notes)
+    success = await add_to_watchlist_async(stock_id, stock_name, req.category, req.notes)
     if not success:
         raise HTTPException(status_code=500, detail="新增失敗")
 
@@ -77,7 +77,7 @@ async def add_stock(req: AddStockRequest):
 @router.delete("/remove/{stock_id}")
 async def remove_stock(stock_id: str):
     """從關注清單移除"""
-    success = remove_from_watchlist(stock_id)
+    success = await remove_from_watchlist_async(stock_id)
     if not success:
         raise HTTPException(status_code=500, detail="移除失敗")
     return {"status": "ok", "message": f"已移除 {stock_id}"}
@@ -89,7 +89,7 @@ async def change_category(stock_id: str, req: UpdateCategoryRequest):
     if req.category not in ("hold", "watch"):
         raise HTTPException(status_code=400, detail="category 必須是 'hold' 或 'watch'")
 
-    success = update_watchlist_category(stock_id, req.category)
+    success = await update_watchlist_category_async(stock_id, req.category)
     return {
         "status": "ok",
         "message": f"{stock_id} 已切換為{'持有' if req.category == 'hold' else '關注'}"
@@ -103,9 +103,11 @@ async def change_category(stock_id: str, req: UpdateCategoryRequest):
 @router.get("/portfolio")
 async def list_portfolio():
     """取得持倉摘要（含未實現損益）"""
-    portfolio = get_portfolio()
+    portfolio = await get_portfolio_async()
     cache = worker.get_cache()
 
+    # 補上即時行情，並在同一次走訪累加總計
+    total_market_value = total_unrealized = total_realized = 0
     for item in portfolio:
         quote = cache.get(item["stock_id"], {})
         current_price = quote.get("price", 0)
@@ -127,10 +129,9 @@ async def list_portfolio():
             item["unrealized_percent"] = 0
             item["market_value"] = 0
 
-    # 計算總計
-    total_market_value = sum(i["market_value"] for i in portfolio)
-    total_unrealized = sum(i["unrealized_profit"] for i in portfolio)
-    total_realized = sum(i.get("realized_profit", 0) for i in portfolio)
+        total_market_value += item["market_value"]
+        total_unrealized += item["unrealized_profit"]
+        total_realized += item.get("realized_profit", 0)
 
     return {
         "data": portfolio,
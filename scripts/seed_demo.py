@@ -5,40 +5,41 @@ seed_demo.py - 產生模擬資料，用於展示系統功能（截圖用）
 """
 import sqlite3
 import os
-import sys
 import random
+import sys
 from datetime import datetime, timedelta
 
 # 加入專案根目錄到 path
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, ROOT)
 
+from database.db import apply_pragmas, STATEMENT_CACHE_SIZE
+
 DB_PATH = os.path.join(ROOT, "stock_game.db")
 
 
 def create_tables(conn):
-    """建立所有資料表"""
+    """建立所有資料表（不含索引與 UNIQUE 約束，見 create_indexes）"""
     conn.executescript("""
-        CREATE TABLE IF NOT EXISTS watchlist (
+        CREATE TABLE watchlist (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             stock_id TEXT NOT NULL,
             stock_name TEXT DEFAULT '',
             category TEXT NOT NULL DEFAULT 'watch',
             notes TEXT DEFAULT '',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(stock_id)
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS portfolio_summary (
+        CREATE TABLE portfolio_summary (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            stock_id TEXT NOT NULL UNIQUE,
+            stock_id TEXT NOT NULL,
             stock_name TEXT DEFAULT '',
             total_shares INTEGER DEFAULT 0,
             avg_cost REAL DEFAULT 0,
             realized_profit REAL DEFAULT 0,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS trade_log (
+        CREATE TABLE trade_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             stock_id TEXT NOT NULL,
             stock_name TEXT DEFAULT '',
@@ -53,9 +54,9 @@ def create_tables(conn):
             note TEXT DEFAULT '',
             traded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS daily_diary (
+        CREATE TABLE daily_diary (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL UNIQUE,
+            date TEXT NOT NULL,
             market_summary TEXT DEFAULT '',
             ai_review TEXT DEFAULT '',
             user_notes TEXT DEFAULT '',
@@ -68,7 +69,7 @@ def create_tables(conn):
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS institutional_data (
+        CREATE TABLE institutional_data (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT NOT NULL,
             stock_id TEXT NOT NULL,
@@ -83,19 +84,18 @@ def create_tables(conn):
             dealer_sell INTEGER DEFAULT 0,
             dealer_net INTEGER DEFAULT 0,
             total_net INTEGER DEFAULT 0,
-            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(date, stock_id)
+            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS market_institutional (
+        CREATE TABLE market_institutional (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL UNIQUE,
+            date TEXT NOT NULL,
             foreign_net REAL DEFAULT 0,
             trust_net REAL DEFAULT 0,
             dealer_net REAL DEFAULT 0,
             total_net REAL DEFAULT 0,
             fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS stock_snapshots (
+        CREATE TABLE stock_snapshots (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             stock_id TEXT NOT NULL,
             stock_name TEXT DEFAULT '',
@@ -114,7 +114,7 @@ def create_tables(conn):
             vwap REAL DEFAULT 0,
             snapshot_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS stock_alerts (
+        CREATE TABLE stock_alerts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             stock_id TEXT NOT NULL,
             stock_name TEXT DEFAULT '',
@@ -124,7 +124,7 @@ def create_tables(conn):
             triggered_at TIMESTAMP,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS margin_data (
+        CREATE TABLE margin_data (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT NOT NULL,
             stock_id TEXT NOT NULL,
@@ -135,10 +135,9 @@ def create_tables(conn):
             short_sell INTEGER DEFAULT 0,
             short_balance INTEGER DEFAULT 0,
             day_trade_ratio REAL DEFAULT 0,
-            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(date, stock_id)
+            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS ai_recommendations (
+        CREATE TABLE ai_recommendations (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT NOT NULL,
             stock_id TEXT DEFAULT '',
@@ -151,12 +150,12 @@ def create_tables(conn):
             actual_result TEXT DEFAULT '',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS app_settings (
+        CREATE TABLE app_settings (
             key TEXT PRIMARY KEY,
             value TEXT DEFAULT '',
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-        CREATE TABLE IF NOT EXISTS tdcc_data (
+        CREATE TABLE tdcc_data (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT NOT NULL,
             stock_id TEXT NOT NULL,
@@ -164,20 +163,37 @@ def create_tables(conn):
             holders INTEGER DEFAULT 0,
             shares INTEGER DEFAULT 0,
             percent REAL DEFAULT 0,
-            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(date, stock_id, level)
+            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
+    """)
+
 
-        CREATE INDEX IF NOT EXISTS idx_trade_log_stock ON trade_log(stock_id);
-        CREATE INDEX IF NOT EXISTS idx_trade_log_date ON trade_log(traded_at);
-        CREATE INDEX IF NOT EXISTS idx_institutional_date ON institutional_data(date);
-        CREATE INDEX IF NOT EXISTS idx_institutional_stock ON institutional_data(stock_id);
-        CREATE INDEX IF NOT EXISTS idx_snapshots_stock ON stock_snapshots(stock_id);
-        CREATE INDEX IF NOT EXISTS idx_snapshots_time ON stock_snapshots(snapshot_at);
-        CREATE INDEX IF NOT EXISTS idx_diary_date ON daily_diary(date);
-        CREATE INDEX IF NOT EXISTS idx_ai_rec_date ON ai_recommendations(date);
-        CREATE INDEX IF NOT EXISTS idx_tdcc_stock ON tdcc_data(stock_id);
-        CREATE INDEX IF NOT EXISTS idx_tdcc_date ON tdcc_data(date);
+def create_indexes(conn):
+    """
+    建立索引（資料寫完後才建，寫入時不必逐筆維護索引）
+    主程式資料表的 UNIQUE 約束也改在這裡用 UNIQUE INDEX 補上，唯一性只在建索引時檢查一次
+    （假資料本身不重複；主程式的 ON CONFLICT upsert 一樣認得 UNIQUE INDEX）
+    """
+    conn.executescript("""
+        BEGIN;
+        CREATE UNIQUE INDEX ux_watchlist_stock ON watchlist(stock_id);
+        CREATE UNIQUE INDEX ux_portfolio_stock ON portfolio_summary(stock_id);
+        CREATE UNIQUE INDEX ux_diary_date ON daily_diary(date);
+        CREATE UNIQUE INDEX ux_institutional_date_stock ON institutional_data(date, stock_id);
+        CREATE UNIQUE INDEX ux_market_institutional_date ON market_institutional(date);
+        CREATE UNIQUE INDEX ux_margin_date_stock ON margin_data(date, stock_id);
+        CREATE UNIQUE INDEX ux_tdcc_date_stock_level ON tdcc_data(date, stock_id, level);
+        CREATE INDEX idx_trade_log_stock ON trade_log(stock_id);
+        CREATE INDEX idx_trade_log_date ON trade_log(traded_at);
+        CREATE INDEX idx_institutional_date ON institutional_data(date);
+        CREATE INDEX idx_institutional_stock ON institutional_data(stock_id);
+        CREATE INDEX idx_snapshots_stock ON stock_snapshots(stock_id);
+        CREATE INDEX idx_snapshots_time ON stock_snapshots(snapshot_at);
+        CREATE INDEX idx_diary_date ON daily_diary(date);
+        CREATE INDEX idx_ai_rec_date ON ai_recommendations(date);
+        CREATE INDEX idx_tdcc_stock ON tdcc_data(stock_id);
+        CREATE INDEX idx_tdcc_date ON tdcc_data(date);
+        COMMIT;
     """)
 
 
@@ -199,20 +215,57 @@ FEE_RATE = 0.001425
 FEE_DISCOUNT = 0.6
 TAX_STOCK = 0.003
 TAX_ETF = 0.001
+# 折扣後的實際手續費率，模組載入時算一次
+FEE_RATE_NET = FEE_RATE * FEE_DISCOUNT
 
 
-def calc_fee(amount):
-    return max(1, round(amount * FEE_RATE * FEE_DISCOUNT))
+# 假資料最多回推的天數
+DAYS_BACK = 40
 
 
-def calc_tax(amount, stock_id):
-    rate = TAX_ETF if stock_id.startswith("00") else TAX_STOCK
-    return round(amount * rate)
+def build_day_strings(today):
+    """預先算好「N 天前」的日期字串 {N: 'YYYY-MM-DD'}，各 seeder 直接查表"""
+    return {n: (today - timedelta(days=n)).strftime("%Y-%m-%d") for n in range(DAYS_BACK)}
 
 
-def seed_watchlist(conn):
+# 固定亂數種子：每次產生的假資料都一樣，截圖可重現
+DEMO_RANDOM_SEED = 42
+
+
+def use_seeded_random(conn, seed=DEMO_RANDOM_SEED):
+    """
+    以獨立的 random.Random 實例覆寫這條連線的 SQL random()
+    SQLite 內建的 random() 無法指定種子，覆寫後 seeder 裡的 random() 每次執行結果都相同
+    """
+    rng = random.Random(seed)
+    conn.create_function("random", 0, lambda: rng.getrandbits(64) - (1 << 63))
+
+
+# 單一 SQL 陳述式可綁定的參數上限（舊版 SQLite 預設 999）
+MAX_BIND_PARAMS = 999
+
+
+def insert_values(cur, insert_sql, rows):
+    """少量固定資料：組成單一多列 INSERT ... VALUES (...),(...) 一次送出（注意 999 個參數上限）"""
+    row_placeholder = "(" + ",".join("?" * len(rows[0])) + ")"
+    cur.execute(
+        f"{insert_sql} VALUES " + ",".join([row_placeholder] * len(rows)),
+        [value for row in rows for value in row]
+    )
+
+
+def insert_rows(cur, insert_sql, rows):
+    """依資料量分派：參數數量在上限內用單一多列 INSERT，超過則改用 executemany"""
+    if len(rows) * len(rows[0]) <= MAX_BIND_PARAMS:
+        insert_values(cur, insert_sql, rows)
+    else:
+        placeholder = "(" + ",".join("?" * len(rows[0])) + ")"
+        cur.executemany(f"{insert_sql} VALUES {placeholder}", rows)
+
+
+def seed_watchlist():
     """關注清單：5 支持有、3 支觀察"""
-    print("  [1/9] 建立觀察清單...")
+    print("  [1/10] 建立觀察清單...")
     data = [
         ("2330", "台積電", "hold", "長期持有核心部位"),
         ("2454", "聯發科", "hold", "AI 晶片題材"),
@@ -223,15 +276,12 @@ def seed_watchlist(conn):
         ("3661", "世芯-KY", "watch", "觀察 AI ASIC 訂單"),
         ("2884", "玉山金", "watch", "金融股觀察"),
     ]
-    conn.executemany(
-        "INSERT OR IGNORE INTO watchlist (stock_id, stock_name, category, notes) VALUES (?,?,?,?)",
-        data
-    )
+    return {"INSERT INTO watchlist (stock_id, stock_name, category, notes)": data}
 
 
-def seed_portfolio(conn):
+def seed_portfolio():
     """持倉彙總"""
-    print("  [2/9] 建立持倉資料...")
+    print("  [2/10] 建立持倉資料...")
     data = [
         ("2330", "台積電", 5000, 890.5, 15200.0),
         ("2454", "聯發科", 2000, 1150.0, 8500.0),
@@ -239,86 +289,53 @@ def seed_portfolio(conn):
         ("2382", "廣達", 2000, 260.0, 0.0),
         ("0050", "元大台灣50", 10000, 148.0, 2100.0),
     ]
-    conn.executemany(
-        "INSERT OR IGNORE INTO portfolio_summary (stock_id, stock_name, total_shares, avg_cost, realized_profit) VALUES (?,?,?,?,?)",
-        data
-    )
+    return {"INSERT INTO portfolio_summary (stock_id, stock_name, total_shares, avg_cost, realized_profit)": data}
 
 
-def seed_trades(conn):
-    """交易紀錄：過去 30 天約 20 筆"""
-    print("  [3/9] 建立交易紀錄...")
-    today = datetime.now()
-    trades = []
-
+# 交易紀錄規格：(代號, 名稱, 買賣, 股數, 價格, 幾天前, 時間, 備註, 是否零股)
+TRADE_SPECS = [
     # 台積電 - 分批買入
-    for i, (days_ago, price, shares) in enumerate([
-        (28, 880.0, 2000), (21, 895.0, 1000), (14, 905.0, 2000),
-    ]):
-        dt = (today - timedelta(days=days_ago)).strftime("%Y-%m-%d 09:%02d:00" % (30 + i))
-        total = price * shares
-        fee = calc_fee(total)
-        trades.append(("2330", "台積電", "buy", shares, price, total, fee, 0, total + fee, 0, "", dt))
-
+    ("2330", "台積電", "buy", 2000, 880.0, 28, "09:30", "", 0),
+    ("2330", "台積電", "buy", 1000, 895.0, 21, "09:31", "", 0),
+    ("2330", "台積電", "buy", 2000, 905.0, 14, "09:32", "", 0),
     # 聯發科 - 買入+部分賣出
-    dt1 = (today - timedelta(days=25)).strftime("%Y-%m-%d 10:15:00")
-    total1 = 1150.0 * 3000
-    fee1 = calc_fee(total1)
-    trades.append(("2454", "聯發科", "buy", 3000, 1150.0, total1, fee1, 0, total1 + fee1, 0, "看好 AI 晶片", dt1))
-
-    dt2 = (today - timedelta(days=10)).strftime("%Y-%m-%d 11:20:00")
-    total2 = 1290.0 * 1000
-    fee2 = calc_fee(total2)
-    tax2 = calc_tax(total2, "2454")
-    trades.append(("2454", "聯發科", "sell", 1000, 1290.0, total2, fee2, tax2, total2 - fee2 - tax2, 0, "部分停利", dt2))
-
+    ("2454", "聯發科", "buy", 3000, 1150.0, 25, "10:15", "看好 AI 晶片", 0),
+    ("2454", "聯發科", "sell", 1000, 1290.0, 10, "11:20", "部分停利", 0),
     # 鴻海 - 買入
-    dt3 = (today - timedelta(days=20)).strftime("%Y-%m-%d 09:45:00")
-    total3 = 165.0 * 3000
-    fee3 = calc_fee(total3)
-    trades.append(("2317", "鴻海", "buy", 3000, 165.0, total3, fee3, 0, total3 + fee3, 0, "AI 伺服器題材", dt3))
-
+    ("2317", "鴻海", "buy", 3000, 165.0, 20, "09:45", "AI 伺服器題材", 0),
     # 廣達 - 買入
-    dt4 = (today - timedelta(days=15)).strftime("%Y-%m-%d 10:30:00")
-    total4 = 260.0 * 2000
-    fee4 = calc_fee(total4)
-    trades.append(("2382", "廣達", "buy", 2000, 260.0, total4, fee4, 0, total4 + fee4, 0, "GB200 題材", dt4))
-
+    ("2382", "廣達", "buy", 2000, 260.0, 15, "10:30", "GB200 題材", 0),
     # 0050 定期定額
-    for days_ago in [27, 20, 13, 6]:
-        dt = (today - timedelta(days=days_ago)).strftime("%Y-%m-%d 09:00:00")
-        total = 148.0 * 2500
-        fee = calc_fee(total)
-        trades.append(("0050", "元大台灣50", "buy", 2500, 148.0, total, fee, 0, total + fee, 0, "定期定額", dt))
-
+    ("0050", "元大台灣50", "buy", 2500, 148.0, 27, "09:00", "定期定額", 0),
+    ("0050", "元大台灣50", "buy", 2500, 148.0, 20, "09:00", "定期定額", 0),
+    ("0050", "元大台灣50", "buy", 2500, 148.0, 13, "09:00", "定期定額", 0),
+    ("0050", "元大台灣50", "buy", 2500, 148.0, 6, "09:00", "定期定額", 0),
     # 長榮 - 短線進出
-    dt5 = (today - timedelta(days=12)).strftime("%Y-%m-%d 10:00:00")
-    total5 = 188.0 * 2000
-    fee5 = calc_fee(total5)
-    trades.append(("2603", "長榮", "buy", 2000, 188.0, total5, fee5, 0, total5 + fee5, 0, "短線波段", dt5))
+    ("2603", "長榮", "buy", 2000, 188.0, 12, "10:00", "短線波段", 0),
+    ("2603", "長榮", "sell", 2000, 198.0, 5, "13:00", "停利出場", 0),
+    # 零股交易
+    ("3661", "世芯-KY", "buy", 100, 2050.0, 8, "09:10", "零股試單", 1),
+]
 
-    dt6 = (today - timedelta(days=5)).strftime("%Y-%m-%d 13:00:00")
-    total6 = 198.0 * 2000
-    fee6 = calc_fee(total6)
-    tax6 = calc_tax(total6, "2603")
-    trades.append(("2603", "長榮", "sell", 2000, 198.0, total6, fee6, tax6, total6 - fee6 - tax6, 0, "停利出場", dt6))
 
-    # 零股交易
-    dt7 = (today - timedelta(days=8)).strftime("%Y-%m-%d 09:10:00")
-    total7 = 2050.0 * 100
-    fee7 = calc_fee(total7)
-    trades.append(("3661", "世芯-KY", "buy", 100, 2050.0, total7, fee7, 0, total7 + fee7, 1, "零股試單", dt7))
-
-    conn.executemany(
-        "INSERT INTO trade_log (stock_id, stock_name, action, shares, price, total_amount, fee, tax, net_amount, is_odd_lot, note, traded_at) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
-        trades
-    )
+def seed_trades(days):
+    """交易紀錄：依 TRADE_SPECS 一次算好金額 / 手續費（最低 1 元）/ 交易稅（只有賣出）"""
+    print("  [3/10] 建立交易紀錄...")
+    trades = [
+        (sid, name, action, shares, price, total, fee, tax,
+         total + fee if action == "buy" else total - fee - tax,
+         odd_lot, note, f"{days[days_ago]} {hhmm}:00")
+        for sid, name, action, shares, price, days_ago, hhmm, note, odd_lot in TRADE_SPECS
+        for total in (price * shares,)
+        for fee in (max(1, round(total * FEE_RATE_NET)),)
+        for tax in (round(total * (TAX_ETF if sid[:2] == "00" else TAX_STOCK)) if action == "sell" else 0,)
+    ]
+    return {"INSERT INTO trade_log (stock_id, stock_name, action, shares, price, total_amount, fee, tax, net_amount, is_odd_lot, note, traded_at)": trades}
 
 
-def seed_diary(conn):
+def seed_diary(days):
     """每日日記：過去 5 個交易日"""
-    print("  [4/9] 建立交易日記...")
-    today = datetime.now()
+    print("  [4/10] 建立交易日記...")
     entries = [
         (1, "大盤下跌 120 點，電子股普遍回檔。台積電守住 940 關卡。",
          "今日市場受美股科技股回檔影響下跌，但跌幅有限。建議持續持有核心部位，避免追高。整體操作評分：B+。",
@@ -336,19 +353,17 @@ def seed_diary(conn):
          "大盤高檔震盪，漲跌互見。金融股受升息預期帶動表現。建議維持均衡配置。整體操作評分：B。",
          "長榮停利出場，獲利約 1.8 萬。", "disciplined", "下週關注 Fed 利率決議"),
     ]
-    for days_ago, summary, review, notes, emotion, plan in entries:
-        d = (today - timedelta(days=days_ago)).strftime("%Y-%m-%d")
-        conn.execute(
-            "INSERT OR IGNORE INTO daily_diary (date, market_summary, ai_review, user_notes, emotion_tag, tomorrow_plan) VALUES (?,?,?,?,?,?)",
-            (d, summary, review, notes, emotion, plan)
-        )
+    rows = [
+        (days[days_ago], summary, review, notes, emotion, plan)
+        for days_ago, summary, review, notes, emotion, plan in entries
+    ]
+    return {"INSERT INTO daily_diary (date, market_summary, ai_review, user_notes, emotion_tag, tomorrow_plan)": rows}
 
 
-def seed_institutional(conn):
+def seed_institutional(now, days):
     """法人資料：大盤 + 個股"""
-    print("  [5/9] 建立法人籌碼...")
-    today = datetime.now()
-    now_str = datetime.now().isoformat()
+    print("  [5/10] 建立法人籌碼...")
+    now_str = now.isoformat()
 
     # 大盤法人 - 近 5 天
     market_data = [
@@ -358,12 +373,8 @@ def seed_institutional(conn):
         (5, 350.20, -35.60, -80.30, 234.30),
         (7, -150.80, 42.30, 55.20, -53.30),
     ]
-    for days_ago, foreign, trust, dealer, total in market_data:
-        d = (today - timedelta(days=days_ago)).strftime("%Y-%m-%d")
-        conn.execute(
-            "INSERT OR IGNORE INTO market_institutional (date, foreign_net, trust_net, dealer_net, total_net, fetched_at) VALUES (?,?,?,?,?,?)",
-            (d, foreign, trust, dealer, total, now_str)
-        )
+    market_rows = [(days[days_ago], foreign, trust, dealer, total, now_str)
+                   for days_ago, foreign, trust, dealer, total in market_data]
 
     # 個股法人
     stock_inst = [
@@ -373,17 +384,17 @@ def seed_institutional(conn):
         ("2382", "廣達", 3000, 1500, 1500, 600, 400, 200, 100, 300, -200, 1500),
         ("0050", "元大台灣50", 20000, 15000, 5000, 0, 0, 0, 1000, 2000, -1000, 4000),
     ]
-    d = (today - timedelta(days=1)).strftime("%Y-%m-%d")
-    for sid, name, fb, fs, fn, tb, ts, tn, db_, ds, dn, total in stock_inst:
-        conn.execute(
-            "INSERT OR IGNORE INTO institutional_data (date, stock_id, stock_name, foreign_buy, foreign_sell, foreign_net, trust_buy, trust_sell, trust_net, dealer_buy, dealer_sell, dealer_net, total_net) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            (d, sid, name, fb, fs, fn, tb, ts, tn, db_, ds, dn, total)
-        )
+    d = days[1]
+    return {
+        "INSERT INTO market_institutional (date, foreign_net, trust_net, dealer_net, total_net, fetched_at)": market_rows,
+        "INSERT INTO institutional_data (date, stock_id, stock_name, foreign_buy, foreign_sell, foreign_net, trust_buy, trust_sell, trust_net, dealer_buy, dealer_sell, dealer_net, total_net)":
+            [(d, *row) for row in stock_inst],
+    }
 
 
-def seed_alerts(conn):
+def seed_alerts():
     """到價提醒"""
-    print("  [6/9] 建立到價提醒...")
+    print("  [6/10] 建立到價提醒...")
     alerts = [
         ("2330", "台積電", "above", 1000.0, 0),
         ("2330", "台積電", "below", 900.0, 0),
@@ -391,16 +402,12 @@ def seed_alerts(conn):
         ("2317", "鴻海", "below", 160.0, 0),
         ("2603", "長榮", "above", 210.0, 0),
     ]
-    conn.executemany(
-        "INSERT INTO stock_alerts (stock_id, stock_name, alert_type, target_price, is_triggered) VALUES (?,?,?,?,?)",
-        alerts
-    )
+    return {"INSERT INTO stock_alerts (stock_id, stock_name, alert_type, target_price, is_triggered)": alerts}
 
 
-def seed_ai_recommendations(conn):
+def seed_ai_recommendations(days):
     """AI 推薦紀錄"""
-    print("  [7/9] 建立 AI 推薦...")
-    today = datetime.now()
+    print("  [7/10] 建立 AI 推薦...")
     recs = [
         (3, "2330", "台積電",
          "AI 需求持續成長，先進製程訂單滿載。外資連續買超，技術面突破前高。",
@@ -418,19 +425,16 @@ def seed_ai_recommendations(conn):
          "GB200 伺服器代工訂單放量，營收有望季增雙位數。",
          "10-15%", "1-3個月", 240.0, 310.0, ""),
     ]
-    for days_ago, sid, name, reason, profit, horizon, sl, tp, result in recs:
-        d = (today - timedelta(days=days_ago)).strftime("%Y-%m-%d")
-        conn.execute(
-            "INSERT INTO ai_recommendations (date, stock_id, stock_name, reason, profit_potential, time_horizon, stop_loss_price, target_price, actual_result) VALUES (?,?,?,?,?,?,?,?,?)",
-            (d, sid, name, reason, profit, horizon, sl, tp, result)
-        )
+    return {
+        "INSERT INTO ai_recommendations (date, stock_id, stock_name, reason, profit_potential, time_horizon, stop_loss_price, target_price, actual_result)":
+            [(days[days_ago], *rec) for days_ago, *rec in recs]
+    }
 
 
-def seed_margin(conn):
+def seed_margin(days):
     """融資融券"""
-    print("  [8/9] 建立融資融券資料...")
-    today = datetime.now()
-    d = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+    print("  [8/10] 建立融資融券資料...")
+    d = days[1]
     margin_data = [
         (d, "2330", 500, 300, 25000, 100, 50, 3000, 8.5),
         (d, "2454", 200, 150, 8000, 30, 20, 1200, 12.3),
@@ -438,28 +442,96 @@ def seed_margin(conn):
         (d, "2382", 300, 200, 12000, 50, 30, 2000, 6.2),
         (d, "2603", 1000, 800, 50000, 500, 300, 15000, 22.1),
     ]
-    conn.executemany(
-        "INSERT OR IGNORE INTO margin_data (date, stock_id, margin_buy, margin_sell, margin_balance, short_buy, short_sell, short_balance, day_trade_ratio) VALUES (?,?,?,?,?,?,?,?,?)",
-        margin_data
+    return {"INSERT INTO margin_data (date, stock_id, margin_buy, margin_sell, margin_balance, short_buy, short_sell, short_balance, day_trade_ratio)": margin_data}
+
+
+# 集保三個級距的隨機範圍：(級距, 人數下限, 人數上限, 股數下限, 股數上限, 占比下限, 占比上限)
+# 亂數直接用 SQLite 的 random() 產生，每列只需綁定日期與股票代號
+_SEED_TDCC_SQL = """
+    WITH levels(level, holders_lo, holders_hi, shares_lo, shares_hi, pct_lo, pct_hi) AS (
+        VALUES ('retail', 300000, 500000, 1000000, 3000000, 15, 25),
+               ('medium', 5000, 15000, 2000000, 5000000, 20, 30),
+               ('big', 500, 2000, 5000000, 15000000, 45, 65)
     )
+    INSERT INTO tdcc_data (date, stock_id, level, holders, shares, percent)
+    SELECT ?, ?, level,
+           holders_lo + ABS(random() % (holders_hi - holders_lo + 1)),
+           shares_lo + ABS(random() % (shares_hi - shares_lo + 1)),
+           ROUND(pct_lo + ABS(random() % 10001) / 10000.0 * (pct_hi - pct_lo), 2)
+    FROM levels
+"""
 
 
-def seed_tdcc(conn):
+def seed_tdcc(cur, days):
     """集保大戶資料"""
-    print("  [9/9] 建立集保資料...")
-    today = datetime.now()
-    d = (today - timedelta(days=3)).strftime("%Y-%m-%d")
-    for sid, name in [("2330", "台積電"), ("2454", "聯發科")]:
-        levels = [
-            ("retail", random.randint(300000, 500000), random.randint(1000000, 3000000), round(random.uniform(15, 25), 2)),
-            ("medium", random.randint(5000, 15000), random.randint(2000000, 5000000), round(random.uniform(20, 30), 2)),
-            ("big", random.randint(500, 2000), random.randint(5000000, 15000000), round(random.uniform(45, 65), 2)),
-        ]
-        for level, holders, shares, pct in levels:
-            conn.execute(
-                "INSERT OR IGNORE INTO tdcc_data (date, stock_id, level, holders, shares, percent) VALUES (?,?,?,?,?,?)",
-                (d, sid, level, holders, shares, pct)
-            )
+    print("  [9/10] 建立集保資料...")
+    d = days[3]
+    cur.executemany(_SEED_TDCC_SQL, [(d, sid) for sid in ("2330", "2454")])
+
+
+# 今日盤中每分鐘一筆（09:00 ~ 13:30），價格在基準價 ±1% 內隨機跳動
+# 遞迴 CTE 產生分鐘序列，與股票表 cross join 後一條 INSERT ... SELECT 在 SQLite 內產生全部資料
+# ticks 必須 MATERIALIZED：否則 random() 在 price 每次被引用時都會重新取值，漲跌與價格對不上
+SNAPSHOT_MINUTES = 270
+
+_SEED_SNAPSHOTS_SQL = """
+    WITH RECURSIVE minutes(n) AS (
+        SELECT 0 UNION ALL SELECT n + 1 FROM minutes WHERE n < ?
+    ),
+    ticks AS MATERIALIZED (
+        SELECT s.stock_id, s.stock_name, s.base_price,
+               ROUND(s.base_price * (1 + (random() % 100) / 10000.0), 2) AS price,
+               ABS(random() % 5000) + 1 AS volume,
+               datetime(?, '+' || m.n || ' minutes') AS snapshot_at
+        FROM demo_stocks s, minutes m
+    )
+    INSERT INTO stock_snapshots (stock_id, stock_name, price, change_price, change_percent, volume, open, snapshot_at)
+    SELECT stock_id, stock_name, price,
+           ROUND(price - base_price, 2),
+           ROUND((price - base_price) / base_price * 100, 2),
+           volume, base_price, snapshot_at
+    FROM ticks
+"""
+
+
+def seed_snapshots(cur, days):
+    """行情快照：DEMO_STOCKS 每支今日盤中每分鐘一筆"""
+    print("  [10/10] 建立行情快照...")
+    cur.execute("CREATE TEMP TABLE demo_stocks (stock_id TEXT, stock_name TEXT, base_price REAL)")
+    insert_values(cur, "INSERT INTO demo_stocks (stock_id, stock_name, base_price)", DEMO_STOCKS)
+    cur.execute(_SEED_SNAPSHOTS_SQL, (SNAPSHOT_MINUTES, days[0] + " 09:00:00"))
+    cur.execute("DROP TABLE demo_stocks")
+
+
+def seed_all(conn, now, days):
+    """
+    依序執行所有 seeder：共用同一個 cursor，全部在同一個交易內寫入，只 commit 一次
+    now / days 由 main 統一取一次，整份假資料以同一個時間點為準
+    固定資料的 seeder 只回傳 {INSERT 樣板: rows}，由這裡統一分派寫入；
+    順序為小的主檔（觀察清單、持倉）先寫，再寫引用同一批 stock_id 的交易紀錄等大表
+    """
+    batches = {}
+    for spec in (
+        seed_watchlist(),
+        seed_portfolio(),
+        seed_trades(days),
+        seed_diary(days),
+        seed_institutional(now, days),
+        seed_alerts(),
+        seed_ai_recommendations(days),
+        seed_margin(days),
+    ):
+        batches.update(spec)
+
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    for insert_sql, rows in batches.items():
+        insert_rows(cur, insert_sql, rows)
+    # 集保 / 行情快照的數值在 SQLite 內產生，直接用 cursor 執行
+    seed_tdcc(cur, days)
+    seed_snapshots(cur, days)
+    cur.execute("COMMIT")
+    cur.close()
 
 
 def main():
@@ -472,26 +544,40 @@ def main():
         if ans != 'y':
             print("取消操作。")
             return
-        os.remove(DB_PATH)
+        # 連同 WAL / SHM 一起刪，確保下面一定是全新的資料庫（因此建表 / 寫入都不需要 IF NOT EXISTS、OR IGNORE）
+        for path in (DB_PATH, DB_PATH + "-wal", DB_PATH + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
         print(f"已刪除舊資料庫。")
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL")
+    # 先在記憶體資料庫建好全部資料，最後用 backup() 一次循序寫到檔案，建置過程完全不碰磁碟
+    # isolation_level=None：交易由這裡明確控制，sqlite3 不再自動插入 BEGIN / COMMIT
+    # 與主程式相同的 statement 快取大小，各資料表的 INSERT 只需 prepare 一次
+    conn = sqlite3.connect(":memory:", isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+    # 與主程式相同的 PRAGMA（auto_vacuum 寫在檔頭，會隨 backup 帶到檔案）
+    apply_pragmas(conn)
+    # 記憶體資料庫不會是 WAL；建置途中失敗就整個重跑，不需要 rollback journal
+    conn.execute("PRAGMA journal_mode=OFF")
+    use_seeded_random(conn)
 
     print(f"\n正在建立模擬資料到: {DB_PATH}\n")
 
+    # executescript 會先自動 COMMIT，所以建表放在交易開始之前
     create_tables(conn)
-    seed_watchlist(conn)
-    seed_portfolio(conn)
-    seed_trades(conn)
-    seed_diary(conn)
-    seed_institutional(conn)
-    seed_alerts(conn)
-    seed_ai_recommendations(conn)
-    seed_margin(conn)
-    seed_tdcc(conn)
-
-    conn.commit()
+
+    now = datetime.now()
+    days = build_day_strings(now)
+
+    seed_all(conn, now, days)
+
+    create_indexes(conn)
+
+    # 寫檔期間不 fsync（中途失敗重跑即可），全部寫完才切成主程式使用的 WAL
+    disk = sqlite3.connect(DB_PATH)
+    disk.execute("PRAGMA synchronous=OFF")
+    conn.backup(disk)
+    disk.execute("PRAGMA journal_mode=WAL")
+    disk.close()
     conn.close()
 
     print(f"\n✅ 完成！模擬資料已寫入 {DB_PATH}")
@@ -0,0 +1,43 @@
+"""
+trade_math.py - 交易費用計算（純運算，無 I/O）
+單筆用 calculate_fees（database/models.py），大量交易（回測、重播）用 calculate_fees_batch 一次算完
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from config import BROKER_FEE_RATE, BROKER_FEE_DISCOUNT, TAX_RATE_STOCK, TAX_RATE_ETF
+
+
+@lru_cache(maxsize=4096)
+def is_etf(stock_id: str) -> bool:
+    """判斷是否為 ETF（代號以 00 開頭）"""
+    return stock_id.startswith("00")
+
+
+def calculate_fees_batch(actions, shares, prices, stock_ids):
+    """
+    向量化計算手續費和交易稅（規則同 calculate_fees）
+    參數皆為等長陣列，回傳 dict，每個欄位都是 numpy 陣列
+    """
+    actions = np.asarray(actions).astype(str)
+    shares = np.asarray(shares, dtype=np.float64)
+    prices = np.asarray(prices, dtype=np.float64)
+    stock_ids = np.asarray(stock_ids).astype(str)
+
+    total = shares * prices
+    # 最低手續費 1 元（零股也適用）
+    fee = np.maximum(np.rint(total * BROKER_FEE_RATE * BROKER_FEE_DISCOUNT), 1)
+
+    tax_rate = np.where(np.char.startswith(stock_ids, "00"), TAX_RATE_ETF, TAX_RATE_STOCK)
+    is_sell = actions == "sell"
+    tax = np.where(is_sell, np.rint(total * tax_rate), 0)
+
+    net = np.where(actions == "buy", total + fee, total - fee - tax)
+
+    return {
+        "total_amount": np.round(total, 2),
+        "fee": fee,
+        "tax": tax,
+        "net_amount": np.round(net, 2)
+    }
@@ -6,19 +6,127 @@ workers/ai_analyzer.py - AI 分析引擎
   B. 每日自動檢討（操作摘要、勝率、情緒、偏離度、明日方案）
   C. 盤後市場總結
 """
+import hashlib
+import json
+import orjson
+import re
+import string
 import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 
 import google.generativeai as genai
 from config import GOOGLE_API_KEY
+from market_calendar import is_trading_day
 from database.models import (
     get_trades, get_diary, save_diary, get_watchlist,
     get_portfolio, get_market_institutional, get_institutional,
     get_latest_snapshots
 )
 
+# generate 失敗時回傳文字的開頭（呼叫端用來判斷是否為錯誤訊息）
+AI_ERROR_PREFIX = "[AI 分析暫時無法使用"
+
+# generate_batch 同時送出的請求上限
+AI_BATCH_WORKERS = 4
+
+# prompt 回應快取：完全相同的 prompt（同樣的持股、法人、行情數字）在 TTL 內直接回傳上次結果
+AI_CACHE_TTL = 1800       # 秒
+AI_CACHE_MAXSIZE = 64
+
+# 每日檢討 prompt 樣板（string.Template，建立 AIAnalyzer 時編譯一次）
+DAILY_REVIEW_TMPL = """你是我的個人股市交易教練。請根據以下資料，為我生成今日（${date_str}）的交易檢討報告。
+
+## 今日交易操作
+${trade_summary}
+
+## 費用統計
+手續費合計：${total_fee} 元
+交易稅合計：${total_tax} 元
+
+## 賣出勝率
+今日：${win_rate}%（${winning_sells}勝 ${losing_sells}敗）
+最大單筆虧損：${max_loss} 元 ${max_loss_stock}
+
+## 目前持倉
+${portfolio_summary}
+
+## 大盤法人動向
+${inst_summary}
+
+## 個股法人籌碼
+${stock_lines}
+${user_notes}
+
+## 請輸出以下格式的檢討報告
+
+### 今日操作摘要
+（用 2-3 句話總結今日的操作邏輯和結果）
+
+### 勝率分析
+- 今日勝率：XX%
+- 交易成本：手續費 XX + 稅 XX = 共 XX 元
+
+### 操作檢討
+（分析每筆交易是否合理，有沒有追高、恐慌賣出、不遵守紀律的情況）
+
+### 情緒評估
+（根據交易行為判斷今日情緒狀態：紀律執行/冷靜/衝動/恐慌/貪婪）
+
+### 與計劃偏離度
+（如果有前一天的計劃，評估今日是否按計劃執行）
+
+### 法人籌碼解讀
+（根據法人資料，分析主力動向對我持股的影響）
+
+### 明日行動方案
+（具體的明日操作建議，包含要觀察的指標、價位）
+
+語氣要直接、專業、有建設性。不要客套，直接點出問題。
+"""
+
+# 推薦 JSON 每檔的欄位與型別（模型偶爾把數字輸出成字串，或漏掉欄位）
+RECOMMENDATION_FIELDS = {
+    "stock_id": str,
+    "stock_name": str,
+    "current_price": float,
+    "reason": str,
+    "profit_potential": str,
+    "time_horizon": str,
+    "stop_loss_price": float,
+    "target_price": float,
+    "risk": str,
+}
+
+# 模型偶爾用 markdown 程式碼區塊包住 JSON（```json ... ```），取出第一個區塊內容
+# 不錨定頭尾：區塊前後常夾帶說明文字（例如照抄提示詞最後的重要聲明）
+_CODE_FENCE_RE = re.compile(r"```[A-Za-z]*\s*(.*?)```", re.DOTALL)
+
+
+def _coerce_recommendation(rec):
+    """依 RECOMMENDATION_FIELDS 整理一檔推薦的型別（無法轉換的值給預設值）；不是物件或沒有 stock_id 回傳 None"""
+    if not isinstance(rec, dict) or not rec.get("stock_id"):
+        return None
+    out = dict(rec)
+    for name, typ in RECOMMENDATION_FIELDS.items():
+        val = rec.get(name)
+        if isinstance(val, bool) or val is None:
+            out[name] = typ()
+        elif not isinstance(val, typ):
+            try:
+                out[name] = typ(val)
+            except (TypeError, ValueError):
+                out[name] = typ()
+    return out
+
+
+def _fmt_stock_inst(s: dict) -> str:
+    """個股法人籌碼一行（每日檢討 prompt 用）"""
+    return f"- {s['stock_id']} {s['stock_name']}: 外資{s['foreign_net']:+d} 投信{s['trust_net']:+d} 合計{s['total_net']:+d}"
+
 
 class AIAnalyzer:
     """AI 分析引擎"""
@@ -26,39 +134,123 @@ class AIAnalyzer:
     def __init__(self):
         self.provider = "gemini"  # 'gemini' / 'claude' / 'local'
         self.model = None
+        # 模型只建立一次；排程執行緒與 API 請求可能同時第一次呼叫 generate
+        self._model_lock = threading.Lock()
+
+        # prompt 快取：sha1(prompt) -> (到期時間, 回應文字)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+        self._review_tmpl = string.Template(DAILY_REVIEW_TMPL)
         self.scheduler = BackgroundScheduler()
         self.is_running = False
         self.last_review_date = None
 
+        # 自動檢討生成後依序呼叫 hook(date_str)（例如 Telegram 推播），由 main.py 註冊
+        self.post_review_hooks = []
+
     # ==========================================
     # 初始化 AI Model
     # ==========================================
 
     def init_model(self):
-        """初始化 AI 模型"""
-        if self.provider == "gemini":
-            genai.configure(api_key=GOOGLE_API_KEY)
-            self.model = genai.GenerativeModel("gemini-2.5-flash")
-            print("[AI] Gemini 2.5 Flash 模型已載入")
-        # 預留其他 provider
-        # elif self.provider == "claude":
-        #     ...
-        # elif self.provider == "local":
-        #     ...
-
-    def generate(self, prompt: str, max_retries: int = 2) -> str:
-        """呼叫 AI 生成回應"""
-        if not self.model:
+        """
+        初始化 AI 模型（整個行程只建立一次）
+        GenerativeModel 底層的 gRPC channel 會持續連線，之後每次呼叫都重用，不必重新做 DNS / TLS 握手
+        """
+        if self.model is not None:
+            return
+        with self._model_lock:
+            if self.model is not None:
+                return
+            if self.provider == "gemini":
+                genai.configure(api_key=GOOGLE_API_KEY)
+                self.model = genai.GenerativeModel("gemini-2.5-flash")
+                print("[AI] Gemini 2.5 Flash 模型已載入")
+            # 預留其他 provider
+            # elif self.provider == "claude":
+            #     ...
+            # elif self.provider == "local":
+            #     ...
+
+    def _cache_get(self, key: str):
+        """取出未過期的快取回應（沒有則回傳 None）"""
+        with self._cache_lock:
+            hit = self._cache.get(key)
+            if hit and hit[0] > time.monotonic():
+                return hit[1]
+        return None
+
+    def _cache_put(self, key: str, text: str):
+        """寫入快取（超過上限時淘汰最舊的一筆）"""
+        with self._cache_lock:
+            if len(self._cache) >= AI_CACHE_MAXSIZE:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = (time.monotonic() + AI_CACHE_TTL, text)
+
+    def generate(self, prompt: str, max_retries: int = 2, use_cache: bool = True) -> str:
+        """呼叫 AI 生成回應（相同 prompt 在 AI_CACHE_TTL 內直接回傳快取，失敗訊息不快取）"""
+        key = hashlib.sha1(prompt.encode()).hexdigest()
+        if use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
+
+        if self.model is None:
             self.init_model()
 
         for attempt in range(max_retries + 1):
             try:
                 response = self.model.generate_content(prompt)
-                return response.text
+                text = response.text
+                self._cache_put(key, text)
+                return text
             except Exception as e:
                 print(f"[AI] 生成失敗 (第{attempt+1}次): {e}")
                 if attempt == max_retries:
-                    return f"[AI 分析暫時無法使用: {e}]"
+                    return f"{AI_ERROR_PREFIX}: {e}]"
+
+    def generate_stream(self, prompt: str, max_retries: int = 2):
+        """
+        串流生成：模型每產生一段文字就 yield 一段（快取命中時一次 yield 全文）
+        還沒收到任何文字前失敗才重試；串流中途失敗就以錯誤訊息結尾
+        """
+        key = hashlib.sha1(prompt.encode()).hexdigest()
+        cached = self._cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        if self.model is None:
+            self.init_model()
+
+        for attempt in range(max_retries + 1):
+            parts = []
+            try:
+                for chunk in self.model.generate_content(prompt, stream=True):
+                    text = chunk.text
+                    if text:
+                        parts.append(text)
+                        yield text
+                self._cache_put(key, "".join(parts))
+                return
+            except Exception as e:
+                print(f"[AI] 串流生成失敗 (第{attempt+1}次): {e}")
+                if parts or attempt == max_retries:
+                    yield f"{AI_ERROR_PREFIX}: {e}]"
+                    return
+
+    def generate_batch(self, prompts: list, max_retries: int = 2) -> list:
+        """
+        多個互不相依的 prompt 同時送出（每個 prompt 一條執行緒），依輸入順序回傳結果
+        總耗時約等於最慢的一個請求，而不是逐一呼叫的加總
+        """
+        if self.model is None:
+            self.init_model()
+        if len(prompts) <= 1:
+            return [self.generate(p, max_retries) for p in prompts]
+        with ThreadPoolExecutor(max_workers=min(len(prompts), AI_BATCH_WORKERS)) as pool:
+            return list(pool.map(lambda p: self.generate(p, max_retries), prompts))
 
     # ==========================================
     # A. 值得關注股票推薦
@@ -69,6 +261,41 @@ class AIAnalyzer:
         推薦值得關注的股票
         回傳：推薦清單 + 獲利空間 + 週期 + 停損價
         """
+        return self._parse_recommendations(self.generate(self._build_recommend_prompt()))
+
+    def recommend_stocks_stream(self):
+        """
+        串流版推薦：模型輸出中每完成一檔推薦（recommendations 陣列裡的一個物件）就先 yield ("recommendation", dict)
+        全部輸出完畢後 yield ("done", 與 recommend_stocks 相同格式的完整結果)
+        """
+        decoder = json.JSONDecoder()
+        buf = ""
+        pos = None  # recommendations 陣列內下一個物件的搜尋起點（None = 還沒找到陣列開頭）
+        for text in self.generate_stream(self._build_recommend_prompt()):
+            buf += text
+            if pos is None:
+                key_at = buf.find('"recommendations"')
+                bracket = buf.find("[", key_at) if key_at >= 0 else -1
+                if bracket < 0:
+                    continue
+                pos = bracket + 1
+            while True:
+                # 跳過物件之間的空白與逗號；遇到 ] 表示陣列結束
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos >= len(buf) or buf[pos] != "{":
+                    break
+                try:
+                    rec, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    break  # 物件還沒輸出完整，等下一段
+                rec = _coerce_recommendation(rec)
+                if rec:
+                    yield "recommendation", rec
+        yield "done", self._parse_recommendations(buf)
+
+    def _build_recommend_prompt(self) -> str:
+        """組裝股票推薦的 prompt"""
         # 收集資料
         portfolio = get_portfolio()
         watchlist = get_watchlist()
@@ -98,7 +325,7 @@ class AIAnalyzer:
                 )
             snapshot_str = "\n".join(lines)
 
-        prompt = f"""你是專業台股分析師。請根據以下市場資料，推薦 2-3 檔值得關注的股票。
+        return f"""你是專業台股分析師。請根據以下市場資料，推薦 2-3 檔值得關注的股票。
 
 ## 目前持有
 {', '.join(hold_ids) if hold_ids else '無'}
@@ -148,21 +375,30 @@ class AIAnalyzer:
 **重要聲明：以上分析僅供參考，不構成任何投資建議。投資有風險，請自行評估。**
 """
 
-        result_text = self.generate(prompt)
-
-        # 嘗試解析 JSON
-        import json
+    def _parse_recommendations(self, result_text: str) -> dict:
+        """解析推薦回應的 JSON 並依 RECOMMENDATION_FIELDS 整理型別（解析失敗則把原文放進 market_outlook）"""
         try:
             # 清理可能的 markdown 包裹
-            clean = result_text.strip()
-            if clean.startswith("```"):
-                clean = clean.split("\n", 1)[1] if "\n" in clean else clean[3:]
-                clean = clean.rsplit("```", 1)[0]
-            result = json.loads(clean)
+            m = _CODE_FENCE_RE.search(result_text)
+            if m:
+                clean = m.group(1)
+            else:
+                clean = result_text.strip()
+                if clean.startswith("```"):
+                    # 區塊沒有結尾（回應被截斷）：去掉開頭那行，剩下的當 JSON
+                    clean = clean.split("\n", 1)[1] if "\n" in clean else clean[3:]
+            result = orjson.loads(clean)
+            if not isinstance(result, dict):
+                raise orjson.JSONDecodeError("推薦回應不是 JSON 物件", clean, 0)
+            recs = result.get("recommendations")
+            result["recommendations"] = [
+                r for r in map(_coerce_recommendation, recs if isinstance(recs, list) else []) if r
+            ]
+            result["market_outlook"] = str(result.get("market_outlook") or "")
             result["disclaimer"] = "以上分析僅供參考，不構成任何投資建議。投資有風險，請自行評估。"
             result["generated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             return result
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             return {
                 "recommendations": [],
                 "market_outlook": result_text,
@@ -175,14 +411,39 @@ class AIAnalyzer:
     # B. 每日自動檢討
     # ==========================================
 
-    def generate_daily_review(self, date_str: str = None) -> str:
+    def generate_daily_review(self, date_str: str = None, with_market_summary: bool = False) -> str:
         """
         生成每日自動檢討報告
         包含：操作摘要、勝率、最大虧損、情緒分析、偏離度、明日方案
+        with_market_summary=True 時同時生成盤後市場總結（兩個請求並行送出），存入日記的 market_summary
         """
         if not date_str:
             date_str = date.today().isoformat()
 
+        prompt, inst_summary = self._build_daily_review_prompt(date_str)
+
+        market_summary = inst_summary
+        summary_prompt = self._build_market_summary_prompt(date_str) if with_market_summary else None
+        if summary_prompt:
+            review_text, summary_text = self.generate_batch([prompt, summary_prompt])
+            if not summary_text.startswith(AI_ERROR_PREFIX):
+                market_summary = summary_text
+        else:
+            review_text = self.generate(prompt)
+
+        # 儲存到資料庫
+        save_diary(
+            date_str=date_str,
+            ai_review=review_text,
+            market_summary=market_summary
+        )
+
+        self.last_review_date = date_str
+        print(f"[AI] 每日檢討已生成並儲存：{date_str}")
+        return review_text
+
+    def _build_daily_review_prompt(self, date_str: str) -> tuple:
+        """組裝每日檢討的 prompt，回傳 (prompt, 法人摘要文字)"""
         # 1. 收集當日交易
         trades = get_trades(date_str=date_str)
 
@@ -191,17 +452,20 @@ class AIAnalyzer:
 
         # 3. 法人籌碼
         market_inst = get_market_institutional(date_str)
-        stock_inst = get_institutional(date_str=date_str)
+        stock_inst = get_institutional(date_str=date_str, limit=10)  # prompt 只列合計買賣超前 10 名
 
-        # 4. 計算當日統計
-        buy_trades = [t for t in trades if t["action"] == "buy"]
-        sell_trades = [t for t in trades if t["action"] == "sell"]
-        total_fee = sum(t["fee"] for t in trades)
-        total_tax = sum(t["tax"] for t in trades)
+        # 4. 計算當日統計（一次走訪累計手續費、交易稅並挑出賣出交易）
+        sell_trades = []
+        total_fee = total_tax = 0
+        for t in trades:
+            total_fee += t["fee"]
+            total_tax += t["tax"]
+            if t["action"] == "sell":
+                sell_trades.append(t)
 
         # 5. 計算勝率（賣出交易中獲利的比例）
-        # 需要對比 portfolio 的 avg_cost
-        portfolio_map = {p["stock_id"]: p for p in portfolio}
+        # 需要對比 portfolio 的 avg_cost（沒有賣出就不用建對照表）
+        portfolio_map = {p["stock_id"]: p for p in portfolio} if sell_trades else {}
         winning_sells = 0
         losing_sells = 0
         max_loss = 0
@@ -265,68 +529,22 @@ class AIAnalyzer:
             user_notes = f"\n使用者自己的筆記：{existing_diary['user_notes']}"
 
         # 10. 生成 AI 檢討
-        prompt = f"""你是我的個人股市交易教練。請根據以下資料，為我生成今日（{date_str}）的交易檢討報告。
-
-## 今日交易操作
-{trade_summary}
-
-## 費用統計
-手續費合計：{total_fee:,.0f} 元
-交易稅合計：{total_tax:,.0f} 元
-
-## 賣出勝率
-今日：{win_rate:.0f}%（{winning_sells}勝 {losing_sells}敗）
-最大單筆虧損：{max_loss:,.0f} 元 {max_loss_stock}
-
-## 目前持倉
-{portfolio_summary}
-
-## 大盤法人動向
-{inst_summary}
-
-## 個股法人籌碼
-{chr(10).join([f"- {s['stock_id']} {s['stock_name']}: 外資{s['foreign_net']:+d} 投信{s['trust_net']:+d} 合計{s['total_net']:+d}" for s in (stock_inst or [])[:10]])}
-{user_notes}
-
-## 請輸出以下格式的檢討報告
-
-### 今日操作摘要
-（用 2-3 句話總結今日的操作邏輯和結果）
-
-### 勝率分析
-- 今日勝率：XX%
-- 交易成本：手續費 XX + 稅 XX = 共 XX 元
-
-### 操作檢討
-（分析每筆交易是否合理，有沒有追高、恐慌賣出、不遵守紀律的情況）
-
-### 情緒評估
-（根據交易行為判斷今日情緒狀態：紀律執行/冷靜/衝動/恐慌/貪婪）
-
-### 與計劃偏離度
-（如果有前一天的計劃，評估今日是否按計劃執行）
-
-### 法人籌碼解讀
-（根據法人資料，分析主力動向對我持股的影響）
-
-### 明日行動方案
-（具體的明日操作建議，包含要觀察的指標、價位）
-
-語氣要直接、專業、有建設性。不要客套，直接點出問題。
-"""
-
-        review_text = self.generate(prompt)
-
-        # 儲存到資料庫
-        save_diary(
+        prompt = self._review_tmpl.substitute(
             date_str=date_str,
-            ai_review=review_text,
-            market_summary=inst_summary
+            trade_summary=trade_summary,
+            total_fee=f"{total_fee:,.0f}",
+            total_tax=f"{total_tax:,.0f}",
+            win_rate=f"{win_rate:.0f}",
+            winning_sells=winning_sells,
+            losing_sells=losing_sells,
+            max_loss=f"{max_loss:,.0f}",
+            max_loss_stock=max_loss_stock,
+            portfolio_summary=portfolio_summary,
+            inst_summary=inst_summary,
+            stock_lines="\n".join(map(_fmt_stock_inst, stock_inst or [])),
+            user_notes=user_notes,
         )
-
-        self.last_review_date = date_str
-        print(f"[AI] 每日檢討已生成並儲存：{date_str}")
-        return review_text
+        return prompt, inst_summary
 
     # ==========================================
     # C. 盤後市場總結（供日記使用）
@@ -337,13 +555,18 @@ class AIAnalyzer:
         if not date_str:
             date_str = date.today().isoformat()
 
-        market_inst = get_market_institutional(date_str)
-        stock_inst = get_institutional(date_str=date_str)
+        prompt = self._build_market_summary_prompt(date_str)
+        if not prompt:
+            return "今日法人資料尚未取得，無法生成市場總結。"
+        return self.generate(prompt)
 
+    def _build_market_summary_prompt(self, date_str: str):
+        """組裝盤後市場總結的 prompt（當日法人資料尚未取得則回傳 None）"""
+        market_inst = get_market_institutional(date_str)
         if not market_inst:
-            return "今日法人資料尚未取得，無法生成市場總結。"
+            return None
 
-        prompt = f"""請用 3-5 句話簡要總結今日（{date_str}）台股盤勢：
+        return f"""請用 3-5 句話簡要總結今日（{date_str}）台股盤勢：
 
 三大法人：外資{market_inst['foreign_net']:+.2f}億 投信{market_inst['trust_net']:+.2f}億 自營{market_inst['dealer_net']:+.2f}億
 
@@ -352,7 +575,6 @@ class AIAnalyzer:
 2. 資金流向（哪些族群受青睞）
 3. 明日盤勢展望
 """
-        return self.generate(prompt)
 
     # ==========================================
     # 排程任務
@@ -361,15 +583,19 @@ class AIAnalyzer:
     def scheduled_daily_review(self):
         """排程：盤後自動生成檢討"""
         today = date.today()
-        if today.weekday() >= 5:
-            return  # 週末跳過
+        if not is_trading_day(today):
+            return  # 週末 / 休市日跳過
 
         if self.last_review_date == today.isoformat():
             return  # 今天已生成過
 
         print("[AI] ===== 開始生成每日自動檢討 =====")
         try:
-            self.generate_daily_review()
+            # 檢討與市場總結兩個請求並行送出
+            self.generate_daily_review(with_market_summary=True)
+            if self.last_review_date:
+                for hook in self.post_review_hooks:
+                    hook(self.last_review_date)
         except Exception as e:
             print(f"[AI] 自動檢討生成失敗: {e}")
             traceback.print_exc()
@@ -389,6 +615,7 @@ class AIAnalyzer:
         self.scheduler.add_job(
             self.scheduled_daily_review,
             trigger="cron",
+            day_of_week="mon-fri",
             hour=18,
             minute=15,
             id="daily_ai_review",
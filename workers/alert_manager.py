@@ -3,13 +3,24 @@ workers/alert_manager.py - 到價提醒管理器
 盤中每次行情更新時檢查是否觸發提醒
 支援：突破/跌破目標價
 """
+import queue
 import threading
 import time
 from datetime import datetime
+
+import numpy as np
+
 from database.models import get_watchlist
+from database.db_pool import acquire_read, acquire_write
 
-import sqlite3
-from config import DB_PATH
+_TRIGGER_ALERT_SQL = """UPDATE stock_alerts
+                        SET is_triggered = 1, triggered_at = CURRENT_TIMESTAMP
+                        WHERE id = ?"""
+
+# 背景寫入執行緒每次最多合併幾筆觸發，寫完稍等一下讓同一波觸發累積成一批
+ALERT_WRITE_BATCH = 256
+ALERT_WRITE_INTERVAL = 0.05  # 秒
+ALERT_WRITE_RETRY_DELAY = 1  # 寫入失敗時放回佇列，等 1 秒再重試
 
 
 class AlertManager:
@@ -18,6 +29,13 @@ class AlertManager:
     def __init__(self):
         self.triggered_alerts = []  # 最近觸發的提醒（前端用 polling 讀取）
         self._lock = threading.Lock()
+        self._active = None  # 未觸發提醒的陣列快取（見 _load_active）
+
+        # 觸發標記改由背景執行緒寫入，行情更新執行緒只做記憶體比對
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._pending_ids = set()  # 已觸發但還沒寫進資料庫的提醒 id
 
     # ==========================================
     # CRUD
@@ -25,113 +43,132 @@ class AlertManager:
 
     def add_alert(self, stock_id: str, stock_name: str, alert_type: str, target_price: float):
         """新增到價提醒"""
-        conn = sqlite3.connect(DB_PATH)
         try:
-            conn.execute(
-                """INSERT INTO stock_alerts (stock_id, stock_name, alert_type, target_price)
-                   VALUES (?, ?, ?, ?)""",
-                (stock_id, stock_name, alert_type, target_price)
-            )
-            conn.commit()
+            with acquire_write() as conn:
+                conn.execute(
+                    """INSERT INTO stock_alerts (stock_id, stock_name, alert_type, target_price)
+                       VALUES (?, ?, ?, ?)""",
+                    (stock_id, stock_name, alert_type, target_price)
+                )
+            self._invalidate_active()
             return True
         except Exception as e:
             print(f"[Alert] 新增提醒失敗: {e}")
             return False
-        finally:
-            conn.close()
 
     def get_active_alerts(self):
         """取得所有未觸發的提醒"""
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        try:
+        with acquire_read() as conn:
             rows = conn.execute(
                 "SELECT * FROM stock_alerts WHERE is_triggered = 0 ORDER BY created_at DESC"
             ).fetchall()
-            return [dict(r) for r in rows]
-        finally:
-            conn.close()
+        return [dict(r) for r in rows]
 
     def get_all_alerts(self, limit: int = 50):
         """取得所有提醒（含已觸發）"""
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        try:
+        with acquire_read() as conn:
             rows = conn.execute(
                 "SELECT * FROM stock_alerts ORDER BY created_at DESC LIMIT ?", (limit,)
             ).fetchall()
-            return [dict(r) for r in rows]
-        finally:
-            conn.close()
+        return [dict(r) for r in rows]
 
     def delete_alert(self, alert_id: int):
         """刪除提醒"""
-        conn = sqlite3.connect(DB_PATH)
-        try:
+        with acquire_write() as conn:
             conn.execute("DELETE FROM stock_alerts WHERE id = ?", (alert_id,))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
+        self._invalidate_active()
+        return True
 
     # ==========================================
     # 檢查觸發
     # ==========================================
 
+    def _load_active(self):
+        """
+        未觸發提醒的陣列快取：(提醒清單, 不重複股票代號, 每筆對應的代號索引, 是否突破, 是否跌破, 目標價)
+        只在新增 / 刪除 / 觸發後重建，盤中每次行情更新不必再查資料庫
+        """
+        with self._lock:
+            if self._active is not None:
+                return self._active
+            pending = set(self._pending_ids)
+
+        # 還在寫入佇列裡的觸發不算未觸發，避免重建快取後重複通知
+        alerts = [a for a in self.get_active_alerts() if a["id"] not in pending]
+        active = self._build_active(alerts)
+        with self._lock:
+            self._active = active
+        return active
+
+    @staticmethod
+    def _build_active(alerts: list):
+        """由提醒清單建立 _load_active 的陣列快取"""
+        types = np.array([a["alert_type"] for a in alerts], dtype=object)
+        stock_ids, stock_index = np.unique(
+            np.array([a["stock_id"] for a in alerts], dtype=object), return_inverse=True
+        )
+        return (
+            alerts,
+            stock_ids,
+            stock_index,
+            types == "above",
+            types == "below",
+            np.array([a["target_price"] for a in alerts], dtype=np.float64),
+        )
+
+    def _invalidate_active(self):
+        """提醒有增刪，下次檢查時重建陣列快取"""
+        with self._lock:
+            self._active = None
+
     def check_alerts(self, quotes: dict):
         """
         檢查是否有提醒被觸發
         quotes: {stock_id: {price, ...}}
+        價格比對用 NumPy 一次算完所有提醒，只對觸發的提醒組訊息
         """
-        active_alerts = self.get_active_alerts()
-        if not active_alerts:
+        active = self._load_active()
+        alerts, stock_ids, stock_index, is_above, is_below, targets = active
+        if not alerts:
             return []
 
-        newly_triggered = []
-        conn = sqlite3.connect(DB_PATH)
+        # 每支股票只查一次報價，再展開到每筆提醒（沒有報價視為 0，不觸發）
+        prices = np.fromiter(
+            ((quotes.get(sid) or {}).get("price", 0) or 0 for sid in stock_ids),
+            dtype=np.float64, count=len(stock_ids)
+        )
+        currents = prices[stock_index]
+        hit = (currents > 0) & ((is_above & (currents >= targets)) | (is_below & (currents <= targets)))
 
-        try:
-            for alert in active_alerts:
-                stock_id = alert["stock_id"]
-                quote = quotes.get(stock_id)
-                if not quote:
-                    continue
-
-                current_price = quote.get("price", 0)
-                if current_price <= 0:
-                    continue
-
-                triggered = False
-
-                if alert["alert_type"] == "above" and current_price >= alert["target_price"]:
-                    triggered = True
-                elif alert["alert_type"] == "below" and current_price <= alert["target_price"]:
-                    triggered = True
-
-                if triggered:
-                    # 標記為已觸發
-                    conn.execute(
-                        """UPDATE stock_alerts
-                           SET is_triggered = 1, triggered_at = CURRENT_TIMESTAMP
-                           WHERE id = ?""",
-                        (alert["id"],)
-                    )
-
-                    alert_msg = {
-                        "id": alert["id"],
-                        "stock_id": stock_id,
-                        "stock_name": alert["stock_name"],
-                        "alert_type": alert["alert_type"],
-                        "target_price": alert["target_price"],
-                        "current_price": current_price,
-                        "message": self._format_alert_message(alert, current_price),
-                        "triggered_at": datetime.now().strftime("%H:%M:%S")
-                    }
-                    newly_triggered.append(alert_msg)
-
-            conn.commit()
-        finally:
-            conn.close()
+        newly_triggered = []
+        triggered_ids = []
+
+        for i in np.flatnonzero(hit):
+            alert = alerts[i]
+            stock_id = alert["stock_id"]
+            current_price = quotes[stock_id]["price"]
+            triggered_ids.append(alert["id"])
+
+            alert_msg = {
+                "id": alert["id"],
+                "stock_id": stock_id,
+                "stock_name": alert["stock_name"],
+                "alert_type": alert["alert_type"],
+                "target_price": alert["target_price"],
+                "current_price": current_price,
+                "message": self._format_alert_message(alert, current_price),
+                "triggered_at": datetime.now().strftime("%H:%M:%S")
+            }
+            newly_triggered.append(alert_msg)
+
+        # 標記為已觸發：直接從記憶體快取移除，資料庫寫入交給背景執行緒
+        if triggered_ids:
+            remaining = [alerts[i] for i in np.flatnonzero(~hit)]
+            with self._lock:
+                self._pending_ids.update(triggered_ids)
+                if self._active is active:
+                    self._active = self._build_active(remaining)
+            self._enqueue_triggered(triggered_ids)
 
         # 存到記憶體供前端讀取
         if newly_triggered:
@@ -142,6 +179,46 @@ class AlertManager:
 
         return newly_triggered
 
+    # ==========================================
+    # 背景寫入
+    # ==========================================
+
+    def _enqueue_triggered(self, alert_ids: list):
+        """把觸發的提醒 id 丟進寫入佇列（立即返回，由單一背景執行緒寫入）"""
+        for alert_id in alert_ids:
+            self._write_queue.put(alert_id)
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(
+                    target=self._writer_loop, daemon=True, name="alert-writer"
+                )
+                self._writer.start()
+
+    def _writer_loop(self):
+        """
+        寫入執行緒：每批最多 ALERT_WRITE_BATCH 筆，一次 executemany + 單一交易
+        寫入成功才移出 _pending_ids；失敗就放回佇列稍後重試（否則重建快取時會重新啟用、重複通知）
+        """
+        while True:
+            ids = [self._write_queue.get()]
+            while len(ids) < ALERT_WRITE_BATCH:
+                try:
+                    ids.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with acquire_write() as conn:
+                    conn.executemany(_TRIGGER_ALERT_SQL, [(i,) for i in ids])
+            except Exception as e:
+                print(f"[Alert] 標記已觸發失敗，{ALERT_WRITE_RETRY_DELAY} 秒後重試: {e}")
+                for alert_id in ids:
+                    self._write_queue.put(alert_id)
+                time.sleep(ALERT_WRITE_RETRY_DELAY)
+                continue
+            with self._lock:
+                self._pending_ids.difference_update(ids)
+            time.sleep(ALERT_WRITE_INTERVAL)
+
     def get_recent_triggers(self, clear: bool = True):
         """取得最近觸發的提醒（前端 polling 用）"""
         with self._lock:
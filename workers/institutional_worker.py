@@ -2,19 +2,82 @@
 workers/institutional_worker.py - 法人籌碼自動排程 Worker
 每日 18:05 自動從 TWSE/TPEx 抓取三大法人買賣超
 """
+import asyncio
 import httpx
-import time
+import numpy as np
+import orjson
 import threading
 import traceback
 from datetime import datetime, date, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 
+from market_calendar import is_trading_day
+
 from database.models import (
     save_market_institutional,
-    save_stock_institutional,
+    save_stock_institutional_bulk,
     get_watchlist
 )
 
+TWSE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+}
+TWSE_TIMEOUT = 30
+# TWSE 有速率限制：同一批的第二個請求至少間隔 3 秒
+TWSE_REQUEST_GAP = 3
+# TWSE 偶爾回 429 / 5xx 或逾時：最多嘗試 3 次，間隔 2、4 秒…（指數退避，上限 30 秒）
+TWSE_MAX_ATTEMPTS = 3
+TWSE_BACKOFF_MIN = 2
+TWSE_BACKOFF_MAX = 30
+# 重試用盡後仍失敗的預期錯誤（網路、HTTP 狀態、TWSE 回傳錯誤頁而非 JSON）
+TWSE_EXPECTED_ERRORS = (httpx.HTTPError, orjson.JSONDecodeError)
+
+# T86 需要的數字欄位：外資買/賣、投信買/賣、自營商(自行)買/賣、自營商(避險)買/賣、三大法人合計
+T86_INT_COLS = (2, 3, 8, 9, 11, 12, 14, 15, 17)
+
+
+async def _get_twse_json(client: httpx.AsyncClient, url: str):
+    """GET TWSE API 並解析 JSON；逾時、429、5xx 這類暫時性錯誤以指數退避重試"""
+    for attempt in range(TWSE_MAX_ATTEMPTS):
+        try:
+            resp = await client.get(url)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                resp.raise_for_status()
+            return orjson.loads(resp.content)
+        except (httpx.TimeoutException, httpx.HTTPStatusError) as e:
+            if attempt == TWSE_MAX_ATTEMPTS - 1:
+                raise
+            wait = min(TWSE_BACKOFF_MAX, TWSE_BACKOFF_MIN * 2 ** attempt)
+            print(f"[Institutional] TWSE 請求失敗（{e.__class__.__name__}），{wait} 秒後重試")
+            await asyncio.sleep(wait)
+
+
+def _t86_int_cells(row):
+    """取出 T86 一列的數字欄位字串（舊格式沒有 [17] 三大法人合計時以 0 計）"""
+    return [row[i] for i in T86_INT_COLS[:-1]] + [row[17] if len(row) > 17 else "0"]
+
+
+def _parse_int_columns(rows):
+    """
+    把 T86 各列的數字欄位（"1,234" 字串）整批轉成 int64 矩陣，回傳 (矩陣, 每列是否解析成功)
+    正常情況一次 NumPy 轉換完成；有格式異常的列時才逐列解析，只剔除壞掉的列
+    """
+    try:
+        cells = np.array([_t86_int_cells(row) for row in rows], dtype=str)
+        return np.char.replace(cells, ",", "").astype(np.int64), np.ones(len(rows), dtype=bool)
+    except (ValueError, IndexError):
+        pass
+
+    matrix = np.zeros((len(rows), len(T86_INT_COLS)), dtype=np.int64)
+    valid = np.ones(len(rows), dtype=bool)
+    for i, row in enumerate(rows):
+        try:
+            matrix[i] = [int(str(val).replace(",", "").strip()) for val in _t86_int_cells(row)]
+        except (ValueError, IndexError) as e:
+            print(f"[Institutional] 解析 {row[0].strip()} 失敗: {e}")
+            valid[i] = False
+    return matrix, valid
+
 
 class InstitutionalWorker:
     """法人籌碼自動抓取引擎"""
@@ -25,11 +88,14 @@ class InstitutionalWorker:
         self.last_fetch_date = None
         self.last_fetch_status = "idle"
 
+        # 排程抓取成功後依序呼叫 hook(date_str)（例如 Telegram 推播），由 main.py 註冊
+        self.post_fetch_hooks = []
+
     # ==========================================
     # TWSE API 抓取 - 大盤三大法人
     # ==========================================
 
-    def fetch_market_institutional(self, date_str: str = None):
+    async def fetch_market_institutional(self, client: httpx.AsyncClient, date_str: str = None):
         """
         抓取大盤三大法人買賣金額
         API: https://www.twse.com.tw/fund/BFI82U?response=json&date=YYYYMMDD
@@ -44,10 +110,7 @@ class InstitutionalWorker:
 
         try:
             print(f"[Institutional] 抓取大盤法人資料: {date_str}")
-            resp = httpx.get(url, timeout=30, headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-            })
-            data = resp.json()
+            data = await _get_twse_json(client, url)
 
             if data.get("stat") != "OK" or not data.get("data"):
                 print(f"[Institutional] 大盤法人資料尚未公布或無資料: {date_str}")
@@ -105,6 +168,10 @@ class InstitutionalWorker:
                 "total_net": round(foreign_yi + trust_yi + dealer_yi, 2)
             }
 
+        except TWSE_EXPECTED_ERRORS as e:
+            # 網路 / 限流 / 回傳非 JSON 是預期中的失敗，一行訊息就夠，不印堆疊
+            print(f"[Institutional] 抓取大盤法人失敗（{e.__class__.__name__}）: {e}")
+            return None
         except Exception as e:
             print(f"[Institutional] 抓取大盤法人失敗: {e}")
             traceback.print_exc()
@@ -114,7 +181,7 @@ class InstitutionalWorker:
     # TWSE API 抓取 - 個股三大法人
     # ==========================================
 
-    def fetch_stock_institutional(self, date_str: str = None):
+    async def fetch_stock_institutional(self, client: httpx.AsyncClient, date_str: str = None):
         """
         抓取個股三大法人買賣超
         API: https://www.twse.com.tw/fund/T86?response=json&date=YYYYMMDD&selectType=ALLBUT0999
@@ -127,22 +194,18 @@ class InstitutionalWorker:
         url = f"https://www.twse.com.tw/fund/T86?response=json&date={date_str}&selectType=ALLBUT0999"
 
         try:
+            # TWSE 有速率限制，先等一下（等待期間大盤法人的請求同時進行）
+            await asyncio.sleep(TWSE_REQUEST_GAP)
             print(f"[Institutional] 抓取個股法人資料: {date_str}")
-            # TWSE 有速率限制，先等一下
-            time.sleep(3)
 
-            resp = httpx.get(url, timeout=30, headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-            })
-            data = resp.json()
+            data = await _get_twse_json(client, url)
 
             if data.get("stat") != "OK" or not data.get("data"):
                 print(f"[Institutional] 個股法人資料尚未公布: {date_str}")
                 return []
 
-            # 取得關注清單的股票代號
-            watchlist = get_watchlist()
-            watch_ids = set(w["stock_id"] for w in watchlist)
+            # 取得關注清單的股票代號（get_watchlist 本身有 TTL 快取，新增 / 刪除時自動失效）
+            watch_ids = frozenset(w["stock_id"] for w in get_watchlist())
 
             if not watch_ids:
                 print("[Institutional] 關注清單為空，跳過個股法人抓取")
@@ -150,6 +213,7 @@ class InstitutionalWorker:
 
             save_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
             results = []
+            pending_rows = []
 
             # data["data"] 每列格式：
             # [0]證券代號, [1]證券名稱, [2]外資買超股數, [3]外資賣超股數, [4]外資買賣超,
@@ -158,54 +222,65 @@ class InstitutionalWorker:
             # [11]自營商買超(自行), [12]自營商賣超(自行), [13]自營商買賣超(自行),
             # [14]自營商買超(避險), [15]自營商賣超(避險), [16]自營商買賣超(避險),
             # [17]三大法人合計
-            for row in data["data"]:
-                stock_id = row[0].strip()
+            # 先篩出關注清單的列，數字欄位再用 NumPy 整批轉換
+            selected = [row for row in data["data"] if row[0].strip() in watch_ids]
+            numbers, valid = _parse_int_columns(selected)
 
-                if stock_id not in watch_ids:
-                    continue
-
-                try:
-                    stock_name = row[1].strip()
-
-                    def parse_int(val):
-                        return int(str(val).replace(",", "").strip())
-
-                    foreign_buy = parse_int(row[2])
-                    foreign_sell = parse_int(row[3])
-                    trust_buy = parse_int(row[8])
-                    trust_sell = parse_int(row[9])
-                    # 自營商 = 自行 + 避險
-                    dealer_buy = parse_int(row[11]) + parse_int(row[14])
-                    dealer_sell = parse_int(row[12]) + parse_int(row[15])
-
-                    save_stock_institutional(
-                        save_date, stock_id, stock_name,
-                        foreign_buy, foreign_sell,
-                        trust_buy, trust_sell,
-                        dealer_buy, dealer_sell
-                    )
-
-                    results.append({
-                        "stock_id": stock_id,
-                        "stock_name": stock_name,
-                        "foreign_net": foreign_buy - foreign_sell,
-                        "trust_net": trust_buy - trust_sell,
-                        "dealer_net": dealer_buy - dealer_sell,
-                        "total_net": parse_int(row[17]) if len(row) > 17 else 0
-                    })
-
-                except (ValueError, IndexError) as e:
-                    print(f"[Institutional] 解析 {stock_id} 失敗: {e}")
+            for row, nums, ok in zip(selected, numbers.tolist(), valid.tolist()):
+                if not ok:
                     continue
 
+                stock_id = row[0].strip()
+                stock_name = row[1].strip()
+                (foreign_buy, foreign_sell, trust_buy, trust_sell,
+                 dealer_self_buy, dealer_self_sell, dealer_hedge_buy, dealer_hedge_sell,
+                 total_net) = nums
+                # 自營商 = 自行 + 避險
+                dealer_buy = dealer_self_buy + dealer_hedge_buy
+                dealer_sell = dealer_self_sell + dealer_hedge_sell
+
+                pending_rows.append((
+                    save_date, stock_id, stock_name,
+                    foreign_buy, foreign_sell,
+                    trust_buy, trust_sell,
+                    dealer_buy, dealer_sell
+                ))
+
+                results.append({
+                    "stock_id": stock_id,
+                    "stock_name": stock_name,
+                    "foreign_net": foreign_buy - foreign_sell,
+                    "trust_net": trust_buy - trust_sell,
+                    "dealer_net": dealer_buy - dealer_sell,
+                    "total_net": total_net
+                })
+
+            # 整批寫入，一次 commit
+            save_stock_institutional_bulk(pending_rows)
             print(f"[Institutional] 已儲存 {len(results)} 檔個股法人資料")
             return results
 
+        except TWSE_EXPECTED_ERRORS as e:
+            # 網路 / 限流 / 回傳非 JSON 是預期中的失敗，一行訊息就夠，不印堆疊
+            print(f"[Institutional] 抓取個股法人失敗（{e.__class__.__name__}）: {e}")
+            return []
         except Exception as e:
             print(f"[Institutional] 抓取個股法人失敗: {e}")
             traceback.print_exc()
             return []
 
+    async def fetch_all(self, date_str: str = None):
+        """
+        大盤 + 個股法人一起抓：共用同一個 AsyncClient（連線 / TLS 重用）
+        個股請求在 asyncio.sleep 間隔後送出，間隔期間大盤請求已在進行，不再逐一等待
+        回傳 (大盤結果, 個股結果)
+        """
+        async with httpx.AsyncClient(timeout=TWSE_TIMEOUT, headers=TWSE_HEADERS) as client:
+            return await asyncio.gather(
+                self.fetch_market_institutional(client, date_str),
+                self.fetch_stock_institutional(client, date_str),
+            )
+
     # ==========================================
     # 統一排程任務
     # ==========================================
@@ -214,9 +289,9 @@ class InstitutionalWorker:
         """排程任務：抓取所有法人資料"""
         today = date.today()
 
-        # 週末不抓
-        if today.weekday() >= 5:
-            print(f"[Institutional] 今天是週末，跳過抓取")
+        # 週末 / 休市日不抓
+        if not is_trading_day(today):
+            print(f"[Institutional] 今天休市，跳過抓取")
             return
 
         # 避免重複抓取
@@ -228,28 +303,27 @@ class InstitutionalWorker:
         print(f"[Institutional] ===== 開始自動排程抓取法人資料 =====")
 
         try:
-            # 1. 大盤法人
-            market_result = self.fetch_market_institutional()
-
-            # 2. 個股法人（間隔 3 秒避免被封鎖）
-            stock_results = self.fetch_stock_institutional()
+            # 大盤法人 + 個股法人（個股間隔 3 秒避免被封鎖）
+            market_result, stock_results = asyncio.run(self.fetch_all())
 
             self.last_fetch_date = today.isoformat()
             self.last_fetch_status = "success"
             print(f"[Institutional] ===== 法人資料抓取完成 =====")
 
+            for hook in self.post_fetch_hooks:
+                hook(self.last_fetch_date)
+
         except Exception as e:
             self.last_fetch_status = f"error: {e}"
             print(f"[Institutional] 排程任務失敗: {e}")
 
     def manual_fetch(self, date_str: str = None):
-        """手動觸發抓取（可指定日期）"""
+        """手動觸發抓取（可指定日期；會自己跑 event loop，async 路由請用 asyncio.to_thread 呼叫）"""
         print(f"[Institutional] 手動觸發抓取: {date_str or '今日'}")
         self.last_fetch_status = "fetching"
 
         try:
-            market = self.fetch_market_institutional(date_str)
-            stocks = self.fetch_stock_institutional(date_str)
+            market, stocks = asyncio.run(self.fetch_all(date_str))
             self.last_fetch_status = "success"
             return {"market": market, "stocks": stocks}
         except Exception as e:
@@ -269,6 +343,7 @@ class InstitutionalWorker:
         self.scheduler.add_job(
             self.scheduled_fetch,
             trigger="cron",
+            day_of_week="mon-fri",
             hour=18,
             minute=5,
             id="fetch_institutional",
@@ -3,14 +3,98 @@ workers/margin_worker.py - 融資融券資料抓取
 從 TWSE 抓取信用交易資料（融資/融券/當沖比）
 每日盤後自動排程
 """
+import atexit
 import httpx
+import numpy as np
+import orjson
+import threading
 import time
-import sqlite3
 import traceback
 from datetime import datetime, date
 
-from config import DB_PATH
+from database.db import json_rows_sql
+from database.db_pool import acquire_read, acquire_write
 from database.models import get_watchlist
+from market_calendar import is_trading_day
+
+_UPSERT_MARGIN_SQL = """INSERT INTO margin_data
+   (date, stock_id, margin_buy, margin_sell, margin_balance,
+    short_buy, short_sell, short_balance, day_trade_ratio)
+   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+   ON CONFLICT(date, stock_id) DO UPDATE SET
+       margin_buy=excluded.margin_buy,
+       margin_sell=excluded.margin_sell,
+       margin_balance=excluded.margin_balance,
+       short_buy=excluded.short_buy,
+       short_sell=excluded.short_sell,
+       short_balance=excluded.short_balance,
+       day_trade_ratio=excluded.day_trade_ratio,
+       fetched_at=CURRENT_TIMESTAMP"""
+
+_MARGIN_BY_STOCK_SQL = "SELECT * FROM margin_data WHERE date = ? AND stock_id = ?"
+
+_MARGIN_COLUMNS = ("id", "date", "stock_id", "margin_buy", "margin_sell", "margin_balance",
+                   "short_buy", "short_sell", "short_balance", "day_trade_ratio", "fetched_at")
+
+# 清單查詢直接由 SQLite 輸出 JSON 陣列
+_MARGIN_BY_DATE_SQL = json_rows_sql(
+    _MARGIN_COLUMNS,
+    "SELECT * FROM margin_data WHERE date = ? ORDER BY stock_id"
+)
+_MARGIN_LATEST_SQL = json_rows_sql(
+    _MARGIN_COLUMNS,
+    """SELECT * FROM margin_data
+       WHERE date = (SELECT MAX(date) FROM margin_data)
+       ORDER BY day_trade_ratio DESC"""
+)
+
+TWSE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+}
+
+# 整個程式共用一個 Client：每日抓取（含手動重抓）重用到 TWSE 的 TCP / TLS 連線
+_http = httpx.Client(timeout=30, headers=TWSE_HEADERS,
+                     limits=httpx.Limits(max_keepalive_connections=10, max_connections=20))
+atexit.register(_http.close)
+
+
+# 查詢結果快取：今天 / 最新一天的資料 TTL 秒後過期，過去日期的資料不會再變、一直保留（抓取成功時全部清除）
+MARGIN_CACHE_TTL = 300    # 秒
+MARGIN_CACHE_MAXSIZE = 256
+
+# MI_MARGN 需要的數字欄位：融資買進、融資賣出、融資今日餘額、融券買進、融券賣出、融券今日餘額、資券互抵
+MARGIN_INT_COLS = (2, 3, 6, 8, 9, 12, 14)
+
+
+def _parse_int(val):
+    """TWSE 數字欄位（"1,234" 字串，空值以 0 計）轉 int"""
+    return int(str(val).replace(",", "").strip()) if val else 0
+
+
+def _margin_int_cells(row):
+    """取出 MI_MARGN 一列的數字欄位字串（空值、舊格式沒有 [14] 資券互抵時以 0 計）"""
+    return [row[i] or "0" for i in MARGIN_INT_COLS[:-1]] + [(row[14] or "0") if len(row) > 14 else "0"]
+
+
+def _parse_int_columns(rows):
+    """
+    把各列的數字欄位整批轉成 int64 矩陣，回傳 (矩陣, 每列是否解析成功)
+    正常情況一次 NumPy 轉換完成；有格式異常的列時才逐列解析，只剔除壞掉的列
+    """
+    try:
+        cells = np.array([_margin_int_cells(row) for row in rows], dtype=str).reshape(len(rows), len(MARGIN_INT_COLS))
+        return np.char.strip(np.char.replace(cells, ",", "")).astype(np.int64), np.ones(len(rows), dtype=bool)
+    except (ValueError, IndexError):
+        pass
+
+    matrix = np.zeros((len(rows), len(MARGIN_INT_COLS)), dtype=np.int64)
+    valid = np.ones(len(rows), dtype=bool)
+    for i, row in enumerate(rows):
+        try:
+            matrix[i] = [_parse_int(val) for val in _margin_int_cells(row)]
+        except (ValueError, IndexError):
+            valid[i] = False
+    return matrix, valid
 
 
 class MarginWorker:
@@ -20,6 +104,10 @@ class MarginWorker:
         self.last_fetch_date = None
         self.last_fetch_status = "idle"
 
+        # 查詢快取：(date_str, stock_id) -> (到期時間, 結果)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
     # ==========================================
     # TWSE 融資融券 API
     # ==========================================
@@ -30,6 +118,10 @@ class MarginWorker:
         API: https://www.twse.com.tw/exchangeReport/MI_MARGN?response=json&date=YYYYMMDD&selectType=ALL
         """
         if not date_str:
+            # 排程呼叫（未指定日期）：休市日沒有資料，不必發請求
+            if not is_trading_day():
+                print("[Margin] 今天休市，跳過抓取")
+                return []
             date_str = date.today().strftime("%Y%m%d")
         else:
             date_str = date_str.replace("-", "")
@@ -38,10 +130,8 @@ class MarginWorker:
 
         try:
             print(f"[Margin] 抓取融資融券資料: {date_str}")
-            resp = httpx.get(url, timeout=30, headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-            })
-            data = resp.json()
+            resp = _http.get(url)
+            data = orjson.loads(resp.content)
 
             if data.get("stat") != "OK" or not data.get("data"):
                 print(f"[Margin] 融資融券資料尚未公布: {date_str}")
@@ -57,74 +147,62 @@ class MarginWorker:
 
             save_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
             results = []
-            conn = sqlite3.connect(DB_PATH)
+            pending_rows = []
 
             # data["data"] 融資融券格式：
             # [0]股票代號 [1]股票名稱
             # [2]融資買進 [3]融資賣出 [4]融資現金償還 [5]融資前日餘額 [6]融資今日餘額 [7]融資限額
             # [8]融券買進 [9]融券賣出 [10]融券現金償還 [11]融券前日餘額 [12]融券今日餘額 [13]融券限額
             # [14]資券互抵
-            for row in data["data"]:
-                try:
-                    stock_id = row[0].strip()
-                    if stock_id not in watch_ids:
-                        continue
-
-                    def parse_int(val):
-                        return int(str(val).replace(",", "").strip()) if val else 0
-
-                    margin_buy = parse_int(row[2])
-                    margin_sell = parse_int(row[3])
-                    margin_balance = parse_int(row[6])
-                    short_buy = parse_int(row[8])
-                    short_sell = parse_int(row[9])
-                    short_balance = parse_int(row[12])
-                    offset = parse_int(row[14]) if len(row) > 14 else 0
-
-                    # 當沖比 = 資券互抵 / (融資買+融券賣) * 100
-                    total_trade = margin_buy + short_sell
-                    day_trade_ratio = round(offset / total_trade * 100, 2) if total_trade > 0 else 0
-
-                    conn.execute(
-                        """INSERT INTO margin_data
-                           (date, stock_id, margin_buy, margin_sell, margin_balance,
-                            short_buy, short_sell, short_balance, day_trade_ratio)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                           ON CONFLICT(date, stock_id) DO UPDATE SET
-                               margin_buy=excluded.margin_buy,
-                               margin_sell=excluded.margin_sell,
-                               margin_balance=excluded.margin_balance,
-                               short_buy=excluded.short_buy,
-                               short_sell=excluded.short_sell,
-                               short_balance=excluded.short_balance,
-                               day_trade_ratio=excluded.day_trade_ratio,
-                               fetched_at=CURRENT_TIMESTAMP""",
-                        (save_date, stock_id, margin_buy, margin_sell, margin_balance,
-                         short_buy, short_sell, short_balance, day_trade_ratio)
-                    )
-
-                    results.append({
-                        "stock_id": stock_id,
-                        "margin_buy": margin_buy,
-                        "margin_sell": margin_sell,
-                        "margin_balance": margin_balance,
-                        "short_buy": short_buy,
-                        "short_sell": short_sell,
-                        "short_balance": short_balance,
-                        "day_trade_ratio": day_trade_ratio
-                    })
-
-                except (ValueError, IndexError) as e:
+            # 先篩出關注清單的列，數字欄位再用 NumPy 整批轉換
+            selected = [row for row in data["data"] if row[0].strip() in watch_ids]
+            numbers, valid = _parse_int_columns(selected)
+
+            # 當沖比 = 資券互抵 / (融資買+融券賣) * 100（整批計算，分母為 0 的列下面給 0）
+            total_trade = numbers[:, 0] + numbers[:, 4]
+            ratios = np.round(numbers[:, 6] / np.where(total_trade > 0, total_trade, 1) * 100, 2)
+
+            for row, nums, total, ratio, ok in zip(selected, numbers.tolist(), total_trade.tolist(),
+                                                   ratios.tolist(), valid.tolist()):
+                if not ok:
                     continue
 
-            conn.commit()
-            conn.close()
+                stock_id = row[0].strip()
+                margin_buy, margin_sell, margin_balance, short_buy, short_sell, short_balance, _ = nums
+                day_trade_ratio = ratio if total > 0 else 0
+
+                pending_rows.append(
+                    (save_date, stock_id, margin_buy, margin_sell, margin_balance,
+                     short_buy, short_sell, short_balance, day_trade_ratio)
+                )
+
+                results.append({
+                    "stock_id": stock_id,
+                    "margin_buy": margin_buy,
+                    "margin_sell": margin_sell,
+                    "margin_balance": margin_balance,
+                    "short_buy": short_buy,
+                    "short_sell": short_sell,
+                    "short_balance": short_balance,
+                    "day_trade_ratio": day_trade_ratio
+                })
+
+            # 整批寫入：一次 executemany + 單一交易（寫入連線已設定 WAL / synchronous=NORMAL）
+            with acquire_write() as conn:
+                conn.executemany(_UPSERT_MARGIN_SQL, pending_rows)
+            with self._cache_lock:
+                self._cache.clear()
 
             self.last_fetch_date = save_date
             self.last_fetch_status = "success"
             print(f"[Margin] 已儲存 {len(results)} 檔融資融券資料")
             return results
 
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            # 網路 / TWSE 回傳錯誤頁是預期中的失敗，一行訊息就夠，不印堆疊
+            self.last_fetch_status = f"error: {e}"
+            print(f"[Margin] 抓取融資融券失敗（{e.__class__.__name__}）: {e}")
+            return []
         except Exception as e:
             self.last_fetch_status = f"error: {e}"
             print(f"[Margin] 抓取融資融券失敗: {e}")
@@ -136,31 +214,32 @@ class MarginWorker:
     # ==========================================
 
     def get_margin_data(self, date_str: str = None, stock_id: str = None):
-        """查詢融資融券資料"""
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        try:
+        """查詢融資融券資料（結果與快取共用，呼叫端請勿修改）"""
+        key = (date_str, stock_id)
+        now = time.monotonic()
+        with self._cache_lock:
+            hit = self._cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+
+        result = self._query_margin_data(date_str, stock_id)
+        past = bool(date_str) and date_str < date.today().isoformat()
+        with self._cache_lock:
+            if len(self._cache) >= MARGIN_CACHE_MAXSIZE:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = (float("inf") if past else now + MARGIN_CACHE_TTL, result)
+        return result
+
+    def _query_margin_data(self, date_str: str = None, stock_id: str = None):
+        """實際查詢資料庫"""
+        with acquire_read() as conn:
             if stock_id and date_str:
-                row = conn.execute(
-                    "SELECT * FROM margin_data WHERE date = ? AND stock_id = ?",
-                    (date_str, stock_id)
-                ).fetchone()
+                row = conn.execute(_MARGIN_BY_STOCK_SQL, (date_str, stock_id)).fetchone()
                 return dict(row) if row else None
             elif date_str:
-                rows = conn.execute(
-                    "SELECT * FROM margin_data WHERE date = ? ORDER BY stock_id",
-                    (date_str,)
-                ).fetchall()
-                return [dict(r) for r in rows]
+                return orjson.loads(conn.execute(_MARGIN_BY_DATE_SQL, (date_str,)).fetchone()[0])
             else:
-                rows = conn.execute(
-                    """SELECT * FROM margin_data
-                       WHERE date = (SELECT MAX(date) FROM margin_data)
-                       ORDER BY day_trade_ratio DESC"""
-                ).fetchall()
-                return [dict(r) for r in rows]
-        finally:
-            conn.close()
+                return orjson.loads(conn.execute(_MARGIN_LATEST_SQL).fetchone()[0])
 
 
 # 全域單例
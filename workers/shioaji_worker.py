@@ -7,11 +7,32 @@ import shioaji as sj
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time as dt_time
 from collections import defaultdict
 
 from config import SHIOAJI_API_KEY, SHIOAJI_SECRET_KEY, TRADING_SESSIONS
-from database.models import save_snapshot, get_watchlist
+from database.models import save_snapshots_bulk, get_watchlist
+
+# 盤中 polling 連續出錯時，完整堆疊最多每 60 秒印一次（每次仍印一行錯誤訊息）
+TRACEBACK_INTERVAL = 60
+
+# api.snapshots 單次最多送幾檔；關注清單超過時分批並行送出，讓網路往返重疊
+SNAPSHOT_CHUNK_SIZE = 50
+SNAPSHOT_WORKERS = 4
+
+
+def _parse_hhmm(text: str) -> dt_time:
+    """"HH:MM" 字串轉 datetime.time"""
+    h, m = map(int, text.split(":"))
+    return dt_time(h, m)
+
+
+# 交易時段啟動時解析一次：[(時段名稱, 開始, 結束)]
+_SESSIONS = [
+    (name, _parse_hhmm(start_str), _parse_hhmm(end_str))
+    for name, (start_str, end_str) in TRADING_SESSIONS.items()
+]
 
 
 class ShioajiWorker:
@@ -25,14 +46,24 @@ class ShioajiWorker:
         self._lock = threading.Lock()
 
         # 記憶體快取：最新行情（前端直接讀這裡，毫秒級回應）
+        # 寫入端每輪 polling 建好新 dict 後整個換掉（已發布的 dict 不再修改），讀取端不必上鎖
         self.cache = {}          # {stock_id: {price, change_percent, ...}}
         self.last_update = None  # 最後更新時間
         self.subscribed_stocks = set()
 
+        # 合約查詢快取：關注清單沒變就沿用上次查好的 (contracts, valid_ids)，重連時清除
+        self._contract_cache_key = None
+        self._contract_cache = ([], [])
+        self._contract_by_id = {}  # 單檔合約查詢結果（登入 / 斷線時清除）
+
+        # 抓完快照後依序呼叫 hook(results)（例如到價提醒），由 main.py 註冊
+        self.post_fetch_hooks = []
+
         # 斷線重連
         self._retry_count = 0
         self._max_retry = 10
         self._retry_delays = [5, 10, 15, 30, 60, 60, 120, 120, 300, 300]
+        self._last_traceback = float("-inf")
 
     # ==========================================
     # 連線管理
@@ -64,6 +95,7 @@ class ShioajiWorker:
 
                 self.is_connected = True
                 self._retry_count = 0
+                self._contract_by_id.clear()
                 print("[Shioaji] 連線成功！合約已載入")
                 return True
 
@@ -84,6 +116,8 @@ class ShioajiWorker:
             finally:
                 self.is_connected = False
                 self.subscribed_stocks.clear()
+                self._contract_cache_key = None
+                self._contract_by_id.clear()
 
     def reconnect(self):
         """斷線重連（漸進式延遲）"""
@@ -113,28 +147,16 @@ class ShioajiWorker:
             return {}
 
         try:
-            contracts = []
-            valid_ids = []
-            for sid in stock_ids:
-                try:
-                    contract = self.api.Contracts.Stocks[sid]
-                    if contract:
-                        contracts.append(contract)
-                        valid_ids.append(sid)
-                except Exception:
-                    continue
-
+            contracts, valid_ids = self._get_contracts(stock_ids)
             if not contracts:
                 return {}
 
-            snapshots = self.api.snapshots(contracts)
+            snapshots = self._snapshots(contracts)
             now_str = datetime.now().strftime("%H:%M:%S")
             results = {}
+            new_cache = dict(self.cache)
 
-            for i, snap in enumerate(snapshots):
-                sid = valid_ids[i]
-                contract = contracts[i]
-
+            for sid, contract, snap in zip(valid_ids, contracts, snapshots):
                 price = snap.close
                 volume = snap.total_volume
                 total_amount = getattr(snap, 'total_amount', 0) or 0
@@ -153,42 +175,102 @@ class ShioajiWorker:
                     "stock_id": sid,
                     "stock_name": contract.name,
                     "price": price,
-                    "change_price": snap.change_price if hasattr(snap, 'change_price') else 0,
+                    "change_price": getattr(snap, 'change_price', 0),
                     "change_percent": snap.change_rate if snap.change_rate is not None else 0,
-                    "volume": snap.volume if hasattr(snap, 'volume') else 0,
+                    "volume": getattr(snap, 'volume', 0),
                     "total_volume": volume,
                     "amount": total_amount,
                     "high": snap.high,
                     "low": snap.low,
                     "open": snap.open,
                     "close": price,
-                    "buy_price": snap.buy_price if hasattr(snap, 'buy_price') else 0,
-                    "sell_price": snap.sell_price if hasattr(snap, 'sell_price') else 0,
+                    "buy_price": getattr(snap, 'buy_price', 0),
+                    "sell_price": getattr(snap, 'sell_price', 0),
                     "vwap": round(vwap, 2),
                     "update_time": now_str,
                 }
 
                 results[sid] = data
+                new_cache[sid] = data
+
+            # 一次發布新快取（換參照是原子操作）
+            if results:
+                self.cache = new_cache
+                self.last_update = datetime.now()
 
-                # 寫入記憶體快取
-                with self._lock:
-                    self.cache[sid] = data
-                    self.last_update = datetime.now()
+            if results:
+                for hook in self.post_fetch_hooks:
+                    try:
+                        hook(results)
+                    except Exception as e:
+                        print(f"[Shioaji] 快照 hook 執行失敗: {e}")
 
             return results
 
         except Exception as e:
             print(f"[Shioaji] 抓取快照失敗: {e}")
-            traceback.print_exc()
+            self._print_traceback()
             return {}
 
-    def save_snapshots_to_db(self, results: dict):
-        """將快照存入資料庫（每分鐘一次）"""
-        for sid, data in results.items():
+    def _snapshots(self, contracts: list) -> list:
+        """呼叫 api.snapshots；超過 SNAPSHOT_CHUNK_SIZE 檔時分批並行，結果順序與 contracts 相同"""
+        if len(contracts) <= SNAPSHOT_CHUNK_SIZE:
+            return self.api.snapshots(contracts)
+
+        chunks = [contracts[i:i + SNAPSHOT_CHUNK_SIZE]
+                  for i in range(0, len(contracts), SNAPSHOT_CHUNK_SIZE)]
+        with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as executor:
+            snap_lists = list(executor.map(self.api.snapshots, chunks))
+        return [snap for snaps in snap_lists for snap in snaps]
+
+    def _print_traceback(self):
+        """印出目前例外的堆疊（限流：TRACEBACK_INTERVAL 秒內只印第一次）"""
+        now = time.monotonic()
+        if now - self._last_traceback >= TRACEBACK_INTERVAL:
+            self._last_traceback = now
+            traceback.print_exc()
+
+    def _get_contract(self, stock_id: str):
+        """取得單檔合約（查到後記住，之後直接查 dict）；查不到回傳 None"""
+        contract = self._contract_by_id.get(stock_id)
+        if contract is None:
             try:
-                save_snapshot(sid, data["stock_name"], data)
-            except Exception as e:
-                print(f"[Shioaji] 存入快照失敗 {sid}: {e}")
+                contract = self.api.Contracts.Stocks[stock_id]
+            except Exception:
+                return None
+            if contract:
+                self._contract_by_id[stock_id] = contract
+        return contract
+
+    def _get_contracts(self, stock_ids: list):
+        """
+        查出關注清單每檔的合約，回傳 (contracts, valid_ids)（查不到的代號略過）
+        同一份清單只查一次，之後每 15 秒的 polling 直接用快取
+        """
+        key = tuple(stock_ids)
+        if key == self._contract_cache_key:
+            return self._contract_cache
+
+        contracts = []
+        valid_ids = []
+        for sid in stock_ids:
+            contract = self._get_contract(sid)
+            if contract:
+                contracts.append(contract)
+                valid_ids.append(sid)
+
+        self._contract_cache = (contracts, valid_ids)
+        self._contract_cache_key = key
+        return self._contract_cache
+
+    def save_snapshots_to_db(self, results: dict):
+        """將快照存入資料庫（每分鐘一次，整批一個交易）"""
+        try:
+            save_snapshots_bulk([
+                (sid, data["stock_name"], data) for sid, data in results.items()
+            ])
+        except Exception as e:
+            print(f"[Shioaji] 存入快照失敗: {e}")
 
     # ==========================================
     # 交易時間判斷
@@ -198,21 +280,14 @@ class ShioajiWorker:
     def is_trading_time():
         """判斷是否在交易時間（含盤前試搓 + 盤後零股）"""
         now = datetime.now().time()
-        for session_name, (start_str, end_str) in TRADING_SESSIONS.items():
-            h1, m1 = map(int, start_str.split(":"))
-            h2, m2 = map(int, end_str.split(":"))
-            if dt_time(h1, m1) <= now <= dt_time(h2, m2):
-                return True
-        return False
+        return any(start <= now <= end for _, start, end in _SESSIONS)
 
     @staticmethod
     def get_session_name():
         """取得目前交易時段"""
         now = datetime.now().time()
-        for session_name, (start_str, end_str) in TRADING_SESSIONS.items():
-            h1, m1 = map(int, start_str.split(":"))
-            h2, m2 = map(int, end_str.split(":"))
-            if dt_time(h1, m1) <= now <= dt_time(h2, m2):
+        for session_name, start, end in _SESSIONS:
+            if start <= now <= end:
                 return session_name
         return "closed"
 
@@ -260,7 +335,7 @@ class ShioajiWorker:
 
             except Exception as e:
                 print(f"[Shioaji Worker] 迴圈異常: {e}")
-                traceback.print_exc()
+                self._print_traceback()
                 # 嘗試重連
                 if not self.reconnect():
                     time.sleep(120)
@@ -293,34 +368,25 @@ class ShioajiWorker:
         print("[Shioaji Worker] 已停止")
 
     def get_cache(self):
-        """取得快取中的所有行情（前端用）"""
-        with self._lock:
-            return dict(self.cache)
+        """取得快取中的所有行情（前端用；複製目前發布的 dict，不必上鎖）"""
+        return self.cache.copy()
 
     def get_stock_cache(self, stock_id: str):
         """取得單一股票的快取行情"""
-        with self._lock:
-            return self.cache.get(stock_id)
+        return self.cache.get(stock_id)
 
     def get_stock_name(self, stock_id: str) -> str:
         """透過 API 取得股票名稱"""
         if not self.is_connected or not self.api:
             return ""
-        try:
-            contract = self.api.Contracts.Stocks[stock_id]
-            return contract.name if contract else ""
-        except Exception:
-            return ""
+        contract = self._get_contract(stock_id)
+        return contract.name if contract else ""
 
     def is_valid_stock(self, stock_id: str) -> bool:
         """檢查股票代號是否有效"""
         if not self.is_connected or not self.api:
             return False
-        try:
-            contract = self.api.Contracts.Stocks[stock_id]
-            return contract is not None
-        except Exception:
-            return False
+        return self._get_contract(stock_id) is not None
 
 
 # 全域單例
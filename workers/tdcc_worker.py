@@ -3,10 +3,42 @@ workers/tdcc_worker.py - 集保大戶資料
 TDCC (台灣集中保管結算所) 持股分級資料
 每週五更新，顯示持股分級變化（散戶/中實戶/大戶/千張大戶比例）
 """
+import asyncio
 import httpx
-import traceback
+import orjson
 from datetime import datetime, date, timedelta
-from database.db import get_db_sync
+from database.db import json_rows_sql
+from database.db_pool import acquire_read, acquire_write
+
+_UPSERT_TDCC_SQL = """INSERT INTO tdcc_data (date, stock_id, level, holders, shares, percent)
+   VALUES (?, ?, ?, ?, ?, ?)
+   ON CONFLICT(date, stock_id, level) DO UPDATE SET
+       holders = excluded.holders,
+       shares = excluded.shares,
+       percent = excluded.percent,
+       fetched_at = CURRENT_TIMESTAMP"""
+
+# 單一股票最新一期的分級明細，直接由 SQLite 輸出 JSON 陣列
+_TDCC_LATEST_SQL = json_rows_sql(
+    ("id", "date", "stock_id", "level", "holders", "shares", "percent", "fetched_at"),
+    """SELECT * FROM tdcc_data
+       WHERE stock_id = ? AND date = (
+           SELECT MAX(date) FROM tdcc_data WHERE stock_id = ?
+       )
+       ORDER BY level"""
+)
+
+# 單一股票最新一期依持股分級（bucket 生成欄位）加總股數
+_TDCC_BUCKET_SUM_SQL = """SELECT date, bucket, SUM(shares) AS shares FROM tdcc_data
+   WHERE stock_id = ? AND date = (
+       SELECT MAX(date) FROM tdcc_data WHERE stock_id = ?
+   )
+   GROUP BY bucket"""
+
+TDCC_TIMEOUT = 15
+# 批次抓取時同時進行的股票數；每個名額抓完一檔後仍等 TDCC_REQUEST_GAP 秒才接下一檔，避免請求過快
+TDCC_CONCURRENCY = 5
+TDCC_REQUEST_GAP = 2
 
 
 class TDCCWorker:
@@ -20,7 +52,7 @@ class TDCCWorker:
     # 抓取集保資料
     # ==========================================
 
-    def fetch_tdcc_data(self, stock_id: str, target_date: str = None) -> list:
+    async def fetch_tdcc_data(self, client: httpx.AsyncClient, stock_id: str, target_date: str = None) -> list:
         """
         抓取指定股票的集保分級資料
         資料來源: TDCC 開放資料 API
@@ -38,61 +70,59 @@ class TDCCWorker:
             url = f"https://www.tdcc.com.tw/api/v1/opendata/getOD"
             # 嘗試 TDCC OpenData API
             # 備案：使用公開的 CSV 資料
-            with httpx.Client(timeout=15) as client:
-                # 嘗試 TDCC 官方 API
-                resp = client.get(
-                    "https://www.tdcc.com.tw/portal/zh/smWeb/qryStock",
-                    params={
-                        "scaDates": target_date,
-                        "scaDate": target_date,
-                        "SqlMethod": "StockNo",
-                        "StockNo": stock_id,
-                        "REession": ""
-                    },
-                    headers={
-                        "User-Agent": "Mozilla/5.0",
-                        "Accept": "application/json"
-                    },
-                    follow_redirects=True
-                )
-
-                if resp.status_code == 200:
-                    # 嘗試解析
-                    try:
-                        data = resp.json()
-                        return self._parse_tdcc_json(stock_id, target_date, data)
-                    except Exception:
-                        # 非 JSON，嘗試 HTML 解析或備用方案
-                        return self._fetch_tdcc_backup(stock_id, target_date)
-                else:
-                    return self._fetch_tdcc_backup(stock_id, target_date)
+            # 嘗試 TDCC 官方 API
+            resp = await client.get(
+                "https://www.tdcc.com.tw/portal/zh/smWeb/qryStock",
+                params={
+                    "scaDates": target_date,
+                    "scaDate": target_date,
+                    "SqlMethod": "StockNo",
+                    "StockNo": stock_id,
+                    "REession": ""
+                },
+                headers={
+                    "User-Agent": "Mozilla/5.0",
+                    "Accept": "application/json"
+                },
+                follow_redirects=True
+            )
+
+            if resp.status_code == 200:
+                # 嘗試解析
+                try:
+                    data = orjson.loads(resp.content)
+                    return self._parse_tdcc_json(stock_id, target_date, data)
+                except Exception:
+                    # 非 JSON，嘗試 HTML 解析或備用方案
+                    return await self._fetch_tdcc_backup(client, stock_id, target_date)
+            else:
+                return await self._fetch_tdcc_backup(client, stock_id, target_date)
 
         except Exception as e:
             print(f"[TDCC] 抓取 {stock_id} 失敗: {e}")
-            return self._fetch_tdcc_backup(stock_id, target_date)
+            return await self._fetch_tdcc_backup(client, stock_id, target_date)
 
-    def _fetch_tdcc_backup(self, stock_id: str, target_date: str) -> list:
+    async def _fetch_tdcc_backup(self, client: httpx.AsyncClient, stock_id: str, target_date: str) -> list:
         """
         備用方案：使用公開資料 API
         goodinfo 或 finmind 等替代來源
         """
         try:
             # 使用 FinMind 開放資料
-            with httpx.Client(timeout=15) as client:
-                resp = client.get(
-                    "https://api.finmindtrade.com/api/v4/data",
-                    params={
-                        "dataset": "TaiwanStockHoldingSharesPer",
-                        "data_id": stock_id,
-                        "start_date": (date.today() - timedelta(days=14)).isoformat(),
-                        "end_date": date.today().isoformat()
-                    }
-                )
-
-                if resp.status_code == 200:
-                    data = resp.json()
-                    if data.get("status") == 200 and data.get("data"):
-                        return self._parse_finmind_data(stock_id, data["data"])
+            resp = await client.get(
+                "https://api.finmindtrade.com/api/v4/data",
+                params={
+                    "dataset": "TaiwanStockHoldingSharesPer",
+                    "data_id": stock_id,
+                    "start_date": (date.today() - timedelta(days=14)).isoformat(),
+                    "end_date": date.today().isoformat()
+                }
+            )
+
+            if resp.status_code == 200:
+                data = orjson.loads(resp.content)
+                if data.get("status") == 200 and data.get("data"):
+                    return self._parse_finmind_data(stock_id, data["data"])
 
         except Exception as e:
             print(f"[TDCC] 備用 API 也失敗: {e}")
@@ -147,41 +177,44 @@ class TDCCWorker:
         if not data_list:
             return 0
 
-        conn = get_db_sync()
+        params = [(
+            item["date"], item["stock_id"], item["level"],
+            item["holders"], item["shares"], item["percent"]
+        ) for item in data_list]
         try:
-            count = 0
-            for item in data_list:
-                conn.execute("""
-                    INSERT INTO tdcc_data (date, stock_id, level, holders, shares, percent)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(date, stock_id, level) DO UPDATE SET
-                        holders = excluded.holders,
-                        shares = excluded.shares,
-                        percent = excluded.percent,
-                        fetched_at = CURRENT_TIMESTAMP
-                """, (
-                    item["date"], item["stock_id"], item["level"],
-                    item["holders"], item["shares"], item["percent"]
-                ))
-                count += 1
-            conn.commit()
-            print(f"[TDCC] 已儲存 {count} 筆集保資料")
-            return count
+            # 一次 executemany + 單一交易
+            with acquire_write() as conn:
+                conn.executemany(_UPSERT_TDCC_SQL, params)
+            print(f"[TDCC] 已儲存 {len(params)} 筆集保資料")
+            return len(params)
         except Exception as e:
             print(f"[TDCC] 儲存失敗: {e}")
             return 0
-        finally:
-            conn.close()
+
+    async def _fetch_limited(self, client: httpx.AsyncClient, sem: asyncio.Semaphore, stock_id: str) -> list:
+        """取得並行名額後抓一檔，抓完等 TDCC_REQUEST_GAP 秒再釋出名額"""
+        async with sem:
+            data = await self.fetch_tdcc_data(client, stock_id)
+            await asyncio.sleep(TDCC_REQUEST_GAP)
+            return data
+
+    async def fetch_all(self, stock_ids: list) -> list:
+        """
+        多檔股票同時抓（最多 TDCC_CONCURRENCY 檔），共用同一個 AsyncClient（連線 / TLS 重用）
+        回傳所有股票的分級資料（攤平成一個 list）
+        """
+        limits = httpx.Limits(max_keepalive_connections=TDCC_CONCURRENCY * 2)
+        async with httpx.AsyncClient(timeout=TDCC_TIMEOUT, limits=limits) as client:
+            sem = asyncio.Semaphore(TDCC_CONCURRENCY)
+            results = await asyncio.gather(
+                *(self._fetch_limited(client, sem, stock_id) for stock_id in stock_ids)
+            )
+        return [item for data in results for item in data]
 
     def fetch_and_save(self, stock_ids: list) -> int:
-        """批次抓取並儲存"""
-        import time
-        total = 0
-        for stock_id in stock_ids:
-            data = self.fetch_tdcc_data(stock_id)
-            if data:
-                total += self.save_tdcc_data(data)
-            time.sleep(2)  # 避免請求過快
+        """批次抓取並儲存（會自己跑 event loop，async 路由請用 asyncio.to_thread 呼叫）"""
+        data = asyncio.run(self.fetch_all(stock_ids))
+        total = self.save_tdcc_data(data)
 
         self.last_fetch_date = date.today().isoformat()
         print(f"[TDCC] 批次抓取完成，共 {total} 筆")
@@ -191,73 +224,34 @@ class TDCCWorker:
     # 查詢
     # ==========================================
 
-    def get_tdcc_summary(self, stock_id: str) -> dict:
+    def get_tdcc_summary(self, stock_id: str, with_rows: bool = True) -> dict:
         """
         取得集保摘要：大戶(400張以上)、中實戶(100-400張)、散戶(100張以下) 的持股比例
+        分級由 tdcc_data.bucket 生成欄位判斷，SQLite 直接 GROUP BY 加總
+        with_rows=False 時不回傳分級明細（清單頁只用摘要）
         """
-        conn = get_db_sync()
-        try:
-            # 取最新資料
-            rows = conn.execute("""
-                SELECT * FROM tdcc_data
-                WHERE stock_id = ? AND date = (
-                    SELECT MAX(date) FROM tdcc_data WHERE stock_id = ?
-                )
-                ORDER BY level
-            """, (stock_id, stock_id)).fetchall()
-
+        with acquire_read() as conn:
+            rows = conn.execute(_TDCC_BUCKET_SUM_SQL, (stock_id, stock_id)).fetchall()
             if not rows:
                 return {"stock_id": stock_id, "data": [], "summary": None}
 
-            data = [dict(r) for r in rows]
-            data_date = data[0]["date"] if data else ""
+            result = {"stock_id": stock_id, "date": rows[0]["date"]}
+            if with_rows:
+                result["data"] = orjson.loads(conn.execute(_TDCC_LATEST_SQL, (stock_id, stock_id)).fetchone()[0])
 
-            # 嘗試分類（依等級名稱分析）
-            retail_shares = 0  # 散戶 (< 100張)
-            medium_shares = 0  # 中實戶 (100-400張)
-            big_shares = 0     # 大戶 (> 400張)
-            total_shares = sum(d["shares"] for d in data)
+        bucket_shares = {r["bucket"]: r["shares"] or 0 for r in rows}
+        total_shares = sum(bucket_shares.values())
 
-            for d in data:
-                level = d["level"]
-                shares = d["shares"]
-                # 判斷等級（依持股數分類）
-                # FinMind 格式：「1-999」「1,000-5,000」...
-                try:
-                    # 嘗試解析等級範圍
-                    level_clean = level.replace(",", "").replace(" ", "")
-                    if "-" in level_clean:
-                        parts = level_clean.split("-")
-                        upper = int(parts[-1]) if parts[-1].isdigit() else 999999
-                    elif "以上" in level_clean:
-                        upper = 999999
-                    else:
-                        upper = int(level_clean) if level_clean.isdigit() else 0
-
-                    # 以「張」為單位 (1張=1000股)
-                    upper_zhang = upper / 1000
-                    if upper_zhang < 100:
-                        retail_shares += shares
-                    elif upper_zhang < 400:
-                        medium_shares += shares
-                    else:
-                        big_shares += shares
-                except Exception:
-                    retail_shares += shares
+        def percent(bucket):
+            return round(bucket_shares.get(bucket, 0) / total_shares * 100, 1) if total_shares > 0 else 0
 
-            return {
-                "stock_id": stock_id,
-                "date": data_date,
-                "data": data,
-                "summary": {
-                    "retail_percent": round(retail_shares / total_shares * 100, 1) if total_shares > 0 else 0,
-                    "medium_percent": round(medium_shares / total_shares * 100, 1) if total_shares > 0 else 0,
-                    "big_percent": round(big_shares / total_shares * 100, 1) if total_shares > 0 else 0,
-                    "total_shares": total_shares
-                }
-            }
-        finally:
-            conn.close()
+        result["summary"] = {
+            "retail_percent": percent("retail"),
+            "medium_percent": percent("medium"),
+            "big_percent": percent("big"),
+            "total_shares": total_shares
+        }
+        return result
 
 
 # 全域單例
@@ -7,31 +7,216 @@ workers/telegram_bot.py - Telegram 通知推送
   - AI 檢討完成後推播
   - 支援從設定頁面一鍵偵測 Chat ID
 """
+import asyncio
+import atexit
 import httpx
+import orjson
+import queue
+import random
+import threading
+import time
 import traceback
 from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID
 
 # 動態 Chat ID（可從設定頁修改）
 _chat_id = TELEGRAM_CHAT_ID
 
+TG_MAX_LEN = 4096      # Telegram 單則訊息字元上限
+TG_MAX_RETRIES = 3     # 逾時 / 連線錯誤 / 429 限流時最多嘗試次數
+TG_BACKOFF_BASE = 0.5  # 連線錯誤重試間隔 0.5、1、2 秒…（指數退避，另加少量隨機）
+TG_TIMEOUT = 10
+TG_POLL_TIMEOUT = 30   # getUpdates 長輪詢會在伺服器端等待，逾時要比推播寬
+TG_FLUSH_INTERVAL = 0.5           # 背景佇列收到第一則後再等 0.5 秒，期間進來的通知合併成一則送出
+TG_BATCH_SEPARATOR = "\n\n---\n\n"
+
+# 請求內容用 orjson 編碼後直接送 bytes（httpx 的 json= 走標準庫 json.dumps）
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# ==========================================
+# 推播訊息範本（模組載入時建好，推播時只做 format）
+# ==========================================
+
+# 插入 HTML 範本的資料欄位要跳脫 & < >，否則 parse_mode=HTML 整則會被 Telegram 拒收
+# 預先建好轉換表，str.translate 單次掃過
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+def _esc(value) -> str:
+    """資料欄位轉成可放進 HTML 訊息的字串"""
+    return str(value).translate(_HTML_ESCAPE)
+
+
+# 到價方向 → (圖示, 文字)；非 above 一律視為跌破
+_ALERT_META = {"above": ("📈", "突破"), "below": ("📉", "跌破")}
+
+_ALERT_TPL = (
+    "{emoji} <b>到價提醒觸發</b>\n\n"
+    "股票: <b>{stock_id} {stock_name}</b>\n"
+    "類型: {type_text} {target_price}{price_info}\n"
+    "目標價: {target_price}"
+)
+_ALERT_BATCH_HEADER_TPL = "🔔 <b>到價提醒觸發（{count} 筆）</b>\n"
+_ALERT_BATCH_LINE_TPL = "{emoji} <b>{stock_id} {stock_name}</b> {type_text} {target_price}{price_info}"
+
+_INSTITUTIONAL_TPL = "📊 <b>法人籌碼更新完成</b>\n日期: {date}\n"
+_INSTITUTIONAL_MARKET_TPL = (
+    "\n三大法人買賣超:\n"
+    "  外資: {foreign_net:+.2f} 億\n"
+    "  投信: {trust_net:+.2f} 億\n"
+    "  自營: {dealer_net:+.2f} 億\n"
+    "  合計: {total_net:+.2f} 億"
+)
+
+_AI_REVIEW_TPL = (
+    "🤖 <b>AI 每日檢討已生成</b>\n"
+    "日期: {date}\n\n"
+    "{summary}\n\n"
+    "完整報告請到戰情室查看"
+)
+# 檢討摘要可用的字數：單則上限扣掉範本本身（日期以 YYYY-MM-DD 計）與截斷記號
+_AI_SUMMARY_MAX = TG_MAX_LEN - len(_AI_REVIEW_TPL.format(date="YYYY-MM-DD", summary="")) - len("...")
+
+_MARGIN_TPL = (
+    "💳 <b>融資融券資料更新完成</b>\n"
+    "日期: {date}\n"
+    "更新股票數: {count} 檔"
+)
+
+# 設定頁「發送測試」的訊息內容
+TEST_MESSAGE = (
+    "✅ <b>台股戰情室 Telegram 通知測試</b>\n\n"
+    "恭喜！通知功能已設定成功。\n"
+    "你將會在以下時機收到推播:\n"
+    "  - 到價提醒觸發\n"
+    "  - 法人籌碼更新完成 (18:05)\n"
+    "  - AI 每日檢討完成 (18:15)\n"
+    "  - 融資融券更新完成 (18:10)"
+)
+
+
+def normalize_chat_id(chat_id) -> str:
+    """Chat ID 去空白並檢查格式：數字（群組 / 頻道為負數）或 @頻道名稱；空字串代表未設定"""
+    cid = str(chat_id).strip()
+    if cid and not (cid.lstrip("-").isdigit() or (cid.startswith("@") and len(cid) > 1)):
+        raise ValueError(f"Chat ID 格式錯誤: {cid}")
+    return cid
+
+
+def _pack_messages(texts: list, limit: int = TG_MAX_LEN) -> list:
+    """把多則通知依序用分隔線接起來，每則合併後不超過 limit 字元（單則本身超長的留給 _split_message 切）"""
+    batches = []
+    current = ""
+    for text in texts:
+        candidate = f"{current}{TG_BATCH_SEPARATOR}{text}" if current else text
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            if current:
+                batches.append(current)
+            current = text
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _split_message(text: str, limit: int = TG_MAX_LEN) -> list:
+    """依換行把長訊息切成多則，每則不超過 limit 字元"""
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        # 單行本身超長時硬切
+        for i in range(0, max(len(line), 1), limit):
+            piece = line[i:i + limit]
+            if current and len(current) + 1 + len(piece) > limit:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
 
 class TelegramBot:
     """Telegram 通知機器人"""
 
-    def __init__(self):
+    def __init__(self, send_pool_size: int = 16, poll_pool_size: int = 4):
         self.token = TELEGRAM_BOT_TOKEN
-        self.chat_id = _chat_id
+        self.chat_id = ""
+        self._chat_id_json = b'""'  # chat_id 預先編碼好的 JSON 字串，組請求內容時直接接上
         self.base_url = f"https://api.telegram.org/bot{self.token}"
         self.enabled = bool(self.token)
 
+        # 共用連線（keep-alive），每則推播不必重新 TCP + TLS 握手
+        # 推播與 getUpdates 長輪詢分開兩個連線池，長輪詢佔住連線時推播不會等到 Pool timeout
+        self._send_client = httpx.Client(
+            base_url=self.base_url, timeout=TG_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=send_pool_size // 2,
+                                max_connections=send_pool_size, keepalive_expiry=60)
+        )
+        self._poll_client = httpx.Client(
+            base_url=self.base_url, timeout=TG_POLL_TIMEOUT,
+            limits=httpx.Limits(max_connections=poll_pool_size)
+        )
+        # 非同步推播用（綁定事件迴圈，第一次在 FastAPI 迴圈內使用時才建立）
+        self._send_pool_size = send_pool_size
+        self._async_client = None
+        atexit.register(self.close)
+
+        # 背景推送佇列（到價提醒等高頻通知不卡住呼叫端執行緒）
+        self._queue = queue.Queue()
+        self._sender = None
+        self._sender_lock = threading.Lock()
+
+        # 偵測 Chat ID 時已讀到的最大 update_id；下次帶 offset 只取新訊息，舊的由 Telegram 確認後丟棄
+        self._last_update_id = 0
+
+        # 測試訊息內容固定，請求 bytes 編碼一次重複使用（Chat ID 變更時清掉）
+        self._test_body = None
+
+        # 就緒狀態只在 Chat ID 變更時更新，高頻路徑只檢查一個旗標
+        # （呼叫端多在 Worker 執行緒，用 threading.Event 而非 asyncio.Event）
+        self.ready_event = threading.Event()
+        try:
+            self._store_chat_id(_chat_id)
+        except ValueError as e:
+            print(f"[TG] {e}（.env 的 TELEGRAM_CHAT_ID），請到設定頁重新設定")
+            self._update_ready()
+
+    def close(self):
+        """關閉共用連線（程式結束時呼叫）"""
+        self._send_client.close()
+        self._poll_client.close()
+
+    async def aclose(self):
+        """關閉非同步推播連線（lifespan 結束時呼叫）"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def _update_ready(self):
+        """依 Token / Chat ID 更新就緒旗標"""
+        if self.token and self.chat_id:
+            self.ready_event.set()
+        else:
+            self.ready_event.clear()
+
+    def _store_chat_id(self, chat_id: str):
+        """檢查格式後記下 Chat ID 與其 JSON 編碼（格式錯誤拋 ValueError，原設定不變）"""
+        cid = normalize_chat_id(chat_id)
+        self.chat_id = cid
+        self._chat_id_json = orjson.dumps(cid)
+        self._test_body = None
+        self._update_ready()
+
     def set_chat_id(self, chat_id: str):
-        """設定 Chat ID"""
-        self.chat_id = str(chat_id)
+        """設定 Chat ID（格式錯誤拋 ValueError）"""
+        self._store_chat_id(chat_id)
         print(f"[TG] Chat ID 已設定: {self.chat_id}")
 
     def is_ready(self) -> bool:
         """檢查是否已設定完成"""
-        return bool(self.token and self.chat_id)
+        return self.ready_event.is_set()
 
     # ==========================================
     # 核心：發送訊息
@@ -46,29 +231,171 @@ class TelegramBot:
             print("[TG] 未設定完成（缺少 Token 或 Chat ID），跳過推播")
             return False
 
+        return self._send(text, parse_mode)
+
+    def _send(self, text: str, parse_mode: str = "HTML", body: bytes = None) -> bool:
+        """
+        呼叫 sendMessage（暫時性錯誤由 _post_with_retry 重試），回傳是否成功
+        body：已編碼好的請求內容（固定訊息重複使用），未給則由 text 編碼
+        """
+        if body is None:
+            body = self._message_body(text, parse_mode)
         try:
-            with httpx.Client(timeout=10) as client:
-                resp = client.post(
-                    f"{self.base_url}/sendMessage",
-                    json={
-                        "chat_id": self.chat_id,
-                        "text": text,
-                        "parse_mode": parse_mode,
-                        "disable_web_page_preview": True
-                    }
-                )
-                data = resp.json()
-                if data.get("ok"):
-                    print(f"[TG] 訊息已推送 (長度: {len(text)})")
-                    return True
-                else:
-                    print(f"[TG] 推送失敗: {data.get('description', 'unknown error')}")
-                    return False
+            data = self._post_with_retry("/sendMessage", body=body)
+            return self._parse_send_result(data, text)
         except Exception as e:
             print(f"[TG] 推送異常: {e}")
             traceback.print_exc()
             return False
 
+    def _post_with_retry(self, path: str, *, body: bytes = None, params: dict = None) -> dict:
+        """
+        POST Bot API 並解析回應
+        逾時 / 連線錯誤以指數退避重試；429 限流依回應的 retry_after 等待後重試
+        重試用盡：連線錯誤往外拋，429 則回傳最後一次的回應
+        body：orjson 編碼好的 JSON 請求內容
+        """
+        headers = _JSON_HEADERS if body is not None else None
+        for attempt in range(TG_MAX_RETRIES):
+            last = attempt == TG_MAX_RETRIES - 1
+            try:
+                resp = self._send_client.post(path, content=body, headers=headers, params=params)
+                data = orjson.loads(resp.content)
+            except httpx.TransportError as e:
+                if last:
+                    raise
+                time.sleep(self._backoff_delay(attempt, e))
+                continue
+
+            retry_after = 0 if last else self._rate_limit_delay(data)
+            if retry_after:
+                time.sleep(retry_after)
+                continue
+            return data
+
+    @staticmethod
+    def _backoff_delay(attempt: int, error: Exception) -> float:
+        """連線錯誤第 attempt 次（從 0 起算）後要等的秒數：指數退避加少量隨機"""
+        wait = TG_BACKOFF_BASE * 2 ** attempt + random.uniform(0, 0.1)
+        print(f"[TG] 連線失敗（{error.__class__.__name__}），{wait:.1f} 秒後重試")
+        return wait
+
+    @staticmethod
+    def _rate_limit_delay(data: dict) -> float:
+        """429 限流回應要等的秒數（retry_after）；不是限流回 0"""
+        retry_after = (data.get("parameters") or {}).get("retry_after", 0)
+        if data.get("error_code") == 429 and retry_after:
+            print(f"[TG] 被限流，{retry_after} 秒後重試")
+            return retry_after
+        return 0
+
+    def _message_body(self, text: str, parse_mode: str) -> bytes:
+        """sendMessage 的請求內容（JSON bytes）：欄位固定，直接接上預先編碼的 chat_id，不另建 dict"""
+        return (
+            b'{"chat_id":' + self._chat_id_json
+            + b',"text":' + orjson.dumps(text)
+            + b',"parse_mode":' + orjson.dumps(parse_mode)
+            + b',"disable_web_page_preview":true}'
+        )
+
+    @staticmethod
+    def _parse_send_result(data: dict, text: str) -> bool:
+        """解讀 sendMessage 回應，回傳是否成功"""
+        if data.get("ok"):
+            print(f"[TG] 訊息已推送 (長度: {len(text)})")
+            return True
+        print(f"[TG] 推送失敗: {data.get('description', 'unknown error')}")
+        return False
+
+    # ==========================================
+    # 非同步推播（FastAPI 路由內使用，不佔用事件迴圈）
+    # ==========================================
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """取得非同步推播連線（第一次呼叫時建立）"""
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=TG_TIMEOUT,
+                limits=httpx.Limits(max_keepalive_connections=self._send_pool_size // 2,
+                                    max_connections=self._send_pool_size, keepalive_expiry=60)
+            )
+        return self._async_client
+
+    async def send_message_async(self, text: str, parse_mode: str = "HTML") -> bool:
+        """send_message 的非同步版本"""
+        if not self.is_ready():
+            print("[TG] 未設定完成（缺少 Token 或 Chat ID），跳過推播")
+            return False
+
+        return await self._send_async(text, self._message_body(text, parse_mode))
+
+    async def _send_async(self, text: str, body: bytes) -> bool:
+        """非同步呼叫 sendMessage（body 為已編碼的請求內容，暫時性錯誤由 _post_with_retry_async 重試），回傳是否成功"""
+        try:
+            data = await self._post_with_retry_async("/sendMessage", body=body)
+            return self._parse_send_result(data, text)
+        except Exception as e:
+            print(f"[TG] 推送異常: {e}")
+            traceback.print_exc()
+            return False
+
+    async def _post_with_retry_async(self, path: str, *, body: bytes = None, params: dict = None) -> dict:
+        """_post_with_retry 的非同步版本（重試規則相同，等待時不佔用事件迴圈）"""
+        headers = _JSON_HEADERS if body is not None else None
+        for attempt in range(TG_MAX_RETRIES):
+            last = attempt == TG_MAX_RETRIES - 1
+            try:
+                resp = await self._get_async_client().post(path, content=body, headers=headers, params=params)
+                data = orjson.loads(resp.content)
+            except httpx.TransportError as e:
+                if last:
+                    raise
+                await asyncio.sleep(self._backoff_delay(attempt, e))
+                continue
+
+            retry_after = 0 if last else self._rate_limit_delay(data)
+            if retry_after:
+                await asyncio.sleep(retry_after)
+                continue
+            return data
+
+    # ==========================================
+    # 背景推送佇列
+    # ==========================================
+
+    def enqueue_message(self, text: str):
+        """把訊息丟進背景佇列（立即返回，由單一推送執行緒依序送出）"""
+        if not self.is_ready():
+            print("[TG] 未設定完成（缺少 Token 或 Chat ID），跳過推播")
+            return
+        self._queue.put(text)
+        with self._sender_lock:
+            if self._sender is None or not self._sender.is_alive():
+                self._sender = threading.Thread(
+                    target=self._sender_loop, daemon=True, name="tg-sender"
+                )
+                self._sender.start()
+
+    def _sender_loop(self):
+        """
+        推送執行緒：TG_FLUSH_INTERVAL 內陸續進來的通知合併成一則，超過 4096 字切段依序送出
+        （限流 / 連線錯誤的重試在 _send 內處理）
+        """
+        while True:
+            texts = [self._queue.get()]
+            deadline = time.monotonic() + TG_FLUSH_INTERVAL
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    texts.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            for batch in _pack_messages(texts):
+                for chunk in _split_message(batch):
+                    self._send(chunk)
+
     # ==========================================
     # 偵測 Chat ID（設定頁使用）
     # ==========================================
@@ -82,44 +409,51 @@ class TelegramBot:
             return {"success": False, "error": "未設定 Bot Token"}
 
         try:
-            with httpx.Client(timeout=10) as client:
-                # 先清除 webhook 避免衝突
-                client.post(f"{self.base_url}/deleteWebhook")
-
-                # 取得更新
-                resp = client.get(
-                    f"{self.base_url}/getUpdates",
-                    params={"timeout": 5, "allowed_updates": '["message"]'}
-                )
-                data = resp.json()
+            # 先清除 webhook 避免衝突
+            self._poll_client.post("/deleteWebhook")
 
-                if not data.get("ok"):
-                    return {"success": False, "error": data.get("description", "API 錯誤")}
+            # 取得更新
+            resp = self._poll_client.get(
+                "/getUpdates",
+                params={"timeout": 5, "offset": self._last_update_id + 1,
+                        "allowed_updates": '["message"]'}
+            )
+            data = orjson.loads(resp.content)
 
-                results = data.get("result", [])
-                if not results:
-                    return {
-                        "success": False,
-                        "error": "沒有收到訊息。請先在 Telegram 對 Bot 發送任意訊息，然後再試一次。"
-                    }
+            if not data.get("ok"):
+                return {"success": False, "error": data.get("description", "API 錯誤")}
 
-                # 取最後一則訊息的 chat_id
-                last_msg = results[-1].get("message", {})
-                chat = last_msg.get("chat", {})
-                chat_id = str(chat.get("id", ""))
-                username = chat.get("username", "")
-                first_name = chat.get("first_name", "")
-
-                if chat_id:
-                    self.set_chat_id(chat_id)
-                    return {
-                        "success": True,
+            results = data.get("result", [])
+            if not results:
+                return {
+                    "success": False,
+                    "no_updates": True,
+                    "error": "沒有收到訊息。請先在 Telegram 對 Bot 發送任意訊息，然後再試一次。"
+                }
+
+            results.sort(key=lambda u: u.get("update_id", 0))
+            self._last_update_id = max(self._last_update_id, results[-1].get("update_id", 0))
+
+            # 這批更新裡出現過的所有聊天（同一 chat 只留最後一次，依 update_id 由舊到新）
+            chats = {}
+            for update in results:
+                chat = update.get("message", {}).get("chat", {})
+                if chat.get("id") is not None:
+                    chat_id = str(chat["id"])
+                    chats.pop(chat_id, None)
+                    chats[chat_id] = {
                         "chat_id": chat_id,
-                        "username": username,
-                        "name": first_name
+                        "username": chat.get("username", ""),
+                        "name": chat.get("first_name", "")
                     }
-                else:
-                    return {"success": False, "error": "無法解析 Chat ID"}
+
+            if not chats:
+                return {"success": False, "error": "無法解析 Chat ID"}
+
+            # 取最新一則訊息的 chat_id
+            latest = list(chats.values())[-1]
+            self.set_chat_id(latest["chat_id"])
+            return {"success": True, **latest, "chats": list(chats.values())}
 
         except Exception as e:
             return {"success": False, "error": str(e)}
@@ -131,67 +465,76 @@ class TelegramBot:
     def notify_alert_triggered(self, stock_id: str, stock_name: str,
                                 alert_type: str, target_price: float,
                                 current_price: float = 0):
-        """到價提醒觸發"""
-        type_text = "突破" if alert_type == "above" else "跌破"
-        emoji = "📈" if alert_type == "above" else "📉"
-        price_info = f"\n現價: {current_price}" if current_price else ""
-
-        text = (
-            f"{emoji} <b>到價提醒觸發</b>\n\n"
-            f"股票: <b>{stock_id} {stock_name}</b>\n"
-            f"類型: {type_text} {target_price}{price_info}\n"
-            f"目標價: {target_price}"
-        )
-        self.send_message(text)
+        """到價提醒觸發（走背景佇列，同時觸發的多檔會合併成一則）"""
+        emoji, type_text = _ALERT_META.get(alert_type, _ALERT_META["below"])
+        self.enqueue_message(_ALERT_TPL.format(
+            emoji=emoji, type_text=type_text,
+            stock_id=_esc(stock_id), stock_name=_esc(stock_name), target_price=_esc(target_price),
+            price_info=f"\n現價: {_esc(current_price)}" if current_price else ""
+        ))
+
+    def notify_alerts_batch(self, triggered: list):
+        """多筆到價提醒合併成一則訊息，背景送出（不阻塞行情抓取）"""
+        if not triggered:
+            return
+        lines = [_ALERT_BATCH_HEADER_TPL.format(count=len(triggered))]
+        for t in triggered:
+            emoji, type_text = _ALERT_META.get(t.get("alert_type", ""), _ALERT_META["below"])
+            current_price = t.get("current_price", 0)
+            lines.append(_ALERT_BATCH_LINE_TPL.format(
+                emoji=emoji, type_text=type_text,
+                stock_id=_esc(t.get("stock_id", "")), stock_name=_esc(t.get("stock_name", "")),
+                target_price=_esc(t.get("target_price", 0)),
+                price_info=f" → 現價 {_esc(current_price)}" if current_price else ""
+            ))
+        self.enqueue_message("\n".join(lines))
 
     def notify_institutional_done(self, date_str: str, market_data: dict = None):
         """法人資料抓取完成"""
-        text = f"📊 <b>法人籌碼更新完成</b>\n日期: {date_str}\n"
+        text = _INSTITUTIONAL_TPL.format(date=_esc(date_str))
 
         if market_data:
-            text += (
-                f"\n三大法人買賣超:\n"
-                f"  外資: {market_data.get('foreign_net', 0):+.2f} 億\n"
-                f"  投信: {market_data.get('trust_net', 0):+.2f} 億\n"
-                f"  自營: {market_data.get('dealer_net', 0):+.2f} 億\n"
-                f"  合計: {market_data.get('total_net', 0):+.2f} 億"
+            text += _INSTITUTIONAL_MARKET_TPL.format(
+                foreign_net=market_data.get("foreign_net", 0),
+                trust_net=market_data.get("trust_net", 0),
+                dealer_net=market_data.get("dealer_net", 0),
+                total_net=market_data.get("total_net", 0)
             )
 
         self.send_message(text)
 
     def notify_ai_review_done(self, date_str: str, review_summary: str = ""):
         """AI 檢討完成"""
-        # 截取前 500 字避免 Telegram 4096 字元限制
-        summary = review_summary[:500] + "..." if len(review_summary) > 500 else review_summary
-
-        text = (
-            f"🤖 <b>AI 每日檢討已生成</b>\n"
-            f"日期: {date_str}\n\n"
-            f"{summary}\n\n"
-            f"完整報告請到戰情室查看"
-        )
-        self.send_message(text)
+        # 超過單則上限才截斷，其餘整段送出
+        # 先截斷再跳脫：Telegram 以解析後的字數計算上限，&lt; 只算 1 字，也不會切壞跳脫序列
+        tail = "..." if len(review_summary) > _AI_SUMMARY_MAX else ""
+        summary = _esc(review_summary[:_AI_SUMMARY_MAX]) + tail
+
+        self.send_message(_AI_REVIEW_TPL.format(date=_esc(date_str), summary=summary))
 
     def notify_margin_done(self, date_str: str, count: int = 0):
         """融資融券資料完成"""
-        text = (
-            f"💳 <b>融資融券資料更新完成</b>\n"
-            f"日期: {date_str}\n"
-            f"更新股票數: {count} 檔"
-        )
-        self.send_message(text)
+        self.send_message(_MARGIN_TPL.format(date=_esc(date_str), count=count))
+
+    def _get_test_body(self) -> bytes:
+        """測試訊息的請求 bytes（第一次使用時編碼）"""
+        if self._test_body is None:
+            self._test_body = self._message_body(TEST_MESSAGE, "HTML")
+        return self._test_body
 
     def send_test(self) -> bool:
         """發送測試訊息"""
-        return self.send_message(
-            "✅ <b>台股戰情室 Telegram 通知測試</b>\n\n"
-            "恭喜！通知功能已設定成功。\n"
-            "你將會在以下時機收到推播:\n"
-            "  - 到價提醒觸發\n"
-            "  - 法人籌碼更新完成 (18:05)\n"
-            "  - AI 每日檢討完成 (18:15)\n"
-            "  - 融資融券更新完成 (18:10)"
-        )
+        if not self.is_ready():
+            print("[TG] 未設定完成（缺少 Token 或 Chat ID），跳過推播")
+            return False
+        return self._send(TEST_MESSAGE, body=self._get_test_body())
+
+    async def send_test_async(self) -> bool:
+        """發送測試訊息（非同步，設定頁路由使用）"""
+        if not self.is_ready():
+            print("[TG] 未設定完成（缺少 Token 或 Chat ID），跳過推播")
+            return False
+        return await self._send_async(TEST_MESSAGE, self._get_test_body())
 
 
 # 全域單例